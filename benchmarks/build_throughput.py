@@ -0,0 +1,534 @@
+"""
+End-to-end benchmark of builds through HarborPilot, without Docker.
+
+Generates Git repos (:mod:`makerepo`), starts a fake engine on a UNIX
+socket (:mod:`fakeengine`) and HarborPilot configured to build on it, in
+processes of their own, then pushes builds at it: each of
+``concurrency`` clients commits to the repo of its own build name, POSTs
+to ``/apis/builds/NAME``, and follows the build's log until it ends.
+
+Reports, for the builds after the warm-up round (which clones the
+mirrors):
+
+-   The latency of the POST, and of the whole build, up to the end of
+    its log, as p50/p99/max.
+-   The time from the POST to the first byte of log output.
+-   Builds finished a second.
+-   HarborPilot's peak and final RSS, its workers included.
+-   HarborPilot's event loop lag, from its own metrics.
+
+Usage::
+
+    python benchmarks/build_throughput.py [--builds N] [--concurrency N]
+        [--workers N] [--files N] [--file-bytes N] [--messages N]
+        [--rate N] [--stream FILE] [--keep] [--json]
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+import aiohttp
+
+import makerepo
+
+
+# Seconds to wait for the fake engine and HarborPilot to start
+START_TIMEOUT = 30.0
+
+# Seconds between samples of HarborPilot's RSS
+RSS_INTERVAL = 0.1
+
+_LOOP_LAG_METRIC = 'harborpilot_event_loop_lag_seconds'
+
+_HARBORPILOT_MAIN = 'from harborpilot.cli import main; main()'
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile ``fraction`` (0 to 1) of the
+    non-empty ``values``.
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def process_tree_rss(pid):
+    """
+    Return the resident set size in bytes of process ``pid`` and its
+    descendants, or ``None`` where that can't be found out.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+            return sum(p.memory_info().rss for p in processes)
+        except psutil.Error:
+            return None
+    if not os.path.isdir('/proc'):
+        return None
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open('/proc/{0}/status'.format(current)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            with open('/proc/{0}/task/{0}/children'.format(current)) as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def parse_histogram(text, name):
+    """
+    Return (dict of upper bound -> cumulative count, sum, count) of the
+    histogram ``name`` in the Prometheus ``text``, added up over its
+    label sets (one per worker).
+    """
+    buckets = {}
+    total = 0.0
+    count = 0
+    for line in text.splitlines():
+        if not line.startswith(name):
+            continue
+        series, value = line.rsplit(' ', 1)
+        metric = series.split('{', 1)[0]
+        if metric == name + '_bucket':
+            bound = float(series.split('le="', 1)[1].split('"', 1)[0])
+            buckets[bound] = buckets.get(bound, 0) + float(value)
+        elif metric == name + '_sum':
+            total += float(value)
+        elif metric == name + '_count':
+            count += int(float(value))
+    return buckets, total, count
+
+
+def summarize_loop_lag(before, after):
+    """
+    Return a dict of the mean and approximate p99 and max of the loop lag
+    recorded between the ``before`` and ``after`` scrapes of the metrics.
+    """
+    buckets_before, sum_before, count_before = before
+    buckets_after, sum_after, count_after = after
+    count = count_after - count_before
+    if not count:
+        return {'samples': 0}
+    differences = sorted(
+        (bound, buckets_after[bound] - buckets_before.get(bound, 0))
+        for bound in buckets_after
+    )
+
+    def bound_for(rank):
+        for bound, cumulative in differences:
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    return {
+        'samples': count,
+        'mean': (sum_after - sum_before) / count,
+        # Upper bounds of the buckets they fell in
+        'p99_at_most': bound_for(max(1, 0.99 * count)),
+        'max_at_most': bound_for(count),
+    }
+
+
+def summarize(values):
+    """
+    Return a dict of the p50, p99 and max of the non-empty ``values``.
+    """
+    return {
+        'p50': percentile(values, 0.5),
+        'p99': percentile(values, 0.99),
+        'max': max(values),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Services:
+    """
+    The fake engine, run with the extra ``engine_args``, and HarborPilot
+    with ``workers`` worker processes, using files in ``root``.
+    """
+    def __init__(self, root, *, workers=1, engine_args=()):
+        self.root = root
+        self.workers = workers
+        self.engine_args = list(engine_args)
+        self.engine_socket = os.path.join(root, 'engine.sock')
+        self.port = free_port()
+        self.base_url = 'http://127.0.0.1:{0}'.format(self.port)
+        self.processes = []
+        self.harborpilot = None
+        self.rss_samples = []
+
+    def config(self, builds, **settings):
+        """
+        Return the structure of a HarborPilot config file with these
+        ``builds`` and other ``settings``, building on the fake engine.
+        """
+        structure = {
+            'address': '127.0.0.1',
+            'port': self.port,
+            'state_dir': os.path.join(self.root, 'state'),
+            'engines': {
+                'endpoints': [{'url': 'unix://' + self.engine_socket}],
+            },
+            'builds': builds,
+        }
+        structure.update(settings)
+        return structure
+
+    def start(self, config):
+        """
+        Start the fake engine, then HarborPilot with the ``config``
+        structure.
+        """
+        config_path = os.path.join(self.root, 'harborpilot.conf')
+        with open(config_path, 'w') as conffile:
+            yaml.safe_dump(config, conffile)
+        self.processes.append(subprocess.Popen([
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fakeengine.py'),
+            '--socket', self.engine_socket,
+        ] + self.engine_args))
+        # Before HarborPilot, whose first health check would fail
+        deadline = time.monotonic() + START_TIMEOUT
+        while not os.path.exists(self.engine_socket):
+            self.check_processes()
+            if time.monotonic() > deadline:
+                raise RuntimeError('The fake engine did not start')
+            time.sleep(0.05)
+        log_file = open(os.path.join(self.root, 'harborpilot.log'), 'wb')
+        with log_file:
+            self.harborpilot = subprocess.Popen(
+                [
+                    sys.executable, '-c', _HARBORPILOT_MAIN,
+                    '--config', config_path,
+                    '--workers', str(self.workers),
+                ],
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+        self.processes.append(self.harborpilot)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def check_processes(self):
+        for process in self.processes:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    '{0} exited with status {1}, see {2}'.format(
+                        process.args[1], process.returncode, self.root))
+
+    async def wait_until_up(self, session):
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            self.check_processes()
+            try:
+                async with session.get(
+                        self.base_url + '/apis/scheduler') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientConnectionError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError('HarborPilot did not start')
+            await asyncio.sleep(0.1)
+
+    async def loop_lag(self, session):
+        """
+        Return HarborPilot's loop lag histogram, see
+        :func:`parse_histogram`.
+        """
+        async with session.get(self.base_url + '/metrics') as response:
+            text = await response.text()
+        return parse_histogram(text, _LOOP_LAG_METRIC)
+
+    async def sample_rss(self):
+        """
+        Add HarborPilot's RSS to :attr:`rss_samples` now and then, until
+        cancelled.
+        """
+        while True:
+            self.rss_samples.append(process_tree_rss(self.harborpilot.pid))
+            await asyncio.sleep(RSS_INTERVAL)
+
+    def peak_rss(self):
+        return max(
+            (rss for rss in self.rss_samples if rss is not None),
+            default=None)
+
+    def rss(self):
+        return process_tree_rss(self.harborpilot.pid)
+
+
+class Benchmark:
+    """
+    One run of the benchmark, in the directory ``root``. See the module
+    docstring, and :func:`main` for the arguments.
+    """
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.build_names = [
+            'bench-{0}'.format(index) for index in range(args.concurrency)]
+        engine_args = [
+            '--messages', str(args.messages),
+            '--rate', str(args.rate),
+        ]
+        if args.stream:
+            engine_args += ['--stream', args.stream]
+        self.services = Services(
+            root, workers=args.workers, engine_args=engine_args)
+        self.base_url = self.services.base_url
+        self.results = []
+        self.failures = []
+
+    def prepare(self):
+        """
+        Create the repos, and return the config to start HarborPilot
+        with.
+        """
+        base_repo = os.path.join(self.root, 'repos', 'base')
+        makerepo.make_repo(
+            base_repo,
+            files=self.args.files,
+            file_bytes=self.args.file_bytes,
+        )
+        for build_name in self.build_names:
+            subprocess.run(
+                ['git', 'clone', '-q', base_repo, self._repo(build_name)],
+                check=True,
+            )
+        return self.services.config(
+            {
+                build_name: {
+                    'image_name': build_name,
+                    'git': {'remote': self._repo(build_name)},
+                }
+                for build_name in self.build_names
+            },
+            scheduler={
+                'max_concurrent_builds': self.args.concurrency,
+                'max_queued_builds': self.args.builds + 1,
+            },
+        )
+
+    async def run(self):
+        services = self.services
+        async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None)) as session:
+            await services.wait_until_up(session)
+            # The first build of each name clones its mirror.
+            await asyncio.gather(*(
+                self._build(session, build_name, record=False)
+                for build_name in self.build_names
+            ))
+            lag_before = await services.loop_lag(session)
+            rss_sampler = asyncio.ensure_future(services.sample_rss())
+            remaining = [self.args.builds]
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                self._client(session, build_name, remaining)
+                for build_name in self.build_names
+            ))
+            self.elapsed = time.perf_counter() - start
+            rss_sampler.cancel()
+            self.final_rss = services.rss()
+            lag_after = await services.loop_lag(session)
+        self.loop_lag = summarize_loop_lag(lag_before, lag_after)
+
+    def report(self):
+        report = {
+            'builds': len(self.results),
+            'failed': len(self.failures),
+            'failures': self.failures[:10],
+            'concurrency': self.args.concurrency,
+            'workers': self.args.workers,
+            'seconds': self.elapsed,
+            'builds_per_second': len(self.results) / self.elapsed,
+            'peak_rss_bytes': self.services.peak_rss(),
+            'final_rss_bytes': self.final_rss,
+            'loop_lag_seconds': self.loop_lag,
+        }
+        for key in ['post_seconds', 'first_byte_seconds', 'build_seconds']:
+            values = [
+                result[key] for result in self.results
+                if result[key] is not None
+            ]
+            if values:
+                report[key] = summarize(values)
+        return report
+
+    async def _client(self, session, build_name, remaining):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await self._build(session, build_name)
+
+    async def _build(self, session, build_name, *, record=True):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            None, makerepo.push, self._repo(build_name))
+        start = time.perf_counter()
+        first_byte = None
+        async with session.post(
+                '{0}/apis/builds/{1}'.format(self.base_url, build_name),
+            ) as response:
+            body = await response.json(content_type=None)
+        posted = time.perf_counter()
+        if response.status != 202:
+            self._fail(build_name, 'POST answered {0}: {1}'.format(
+                response.status, body), record)
+            return
+        async with session.get(
+                self.base_url + body['log_url'], params={'follow': '1'},
+            ) as response:
+            async for chunk in response.content.iter_any():
+                if first_byte is None and chunk:
+                    first_byte = time.perf_counter()
+        finished = time.perf_counter()
+        async with session.get(self.base_url + body['status_url']) as response:
+            status = await response.json()
+        if status['status'] != 'succeeded':
+            self._fail(build_name, 'Build {0}: {1}'.format(
+                status['status'], status['error']), record)
+            return
+        if record:
+            self.results.append({
+                'post_seconds': posted - start,
+                'first_byte_seconds': (
+                    first_byte - start if first_byte is not None else None),
+                'build_seconds': finished - start,
+            })
+
+    def _fail(self, build_name, message, record):
+        if not record:
+            raise RuntimeError('Warm-up build of {0} failed: {1}'.format(
+                build_name, message))
+        self.failures.append('{0}: {1}'.format(build_name, message))
+
+    def _repo(self, build_name):
+        return os.path.join(self.root, 'repos', build_name)
+
+
+def format_latencies(report, labels):
+    """
+    Return lines for the summaries in ``report`` of the ``labels``, a
+    list of (key, label).
+    """
+    return [
+        '{0:<15} p50 {1[p50]:8.4f}s  p99 {1[p99]:8.4f}s  '
+        'max {1[max]:8.4f}s'.format(label, report[key])
+        for key, label in labels if key in report
+    ]
+
+
+def format_resources(report):
+    """
+    Return lines for the RSS and loop lag in ``report``.
+    """
+    lines = []
+    for key, label in [
+            ('peak_rss_bytes', 'Peak RSS'), ('final_rss_bytes', 'Final RSS')]:
+        if report[key] is not None:
+            lines.append('{0:<15} {1:.1f} MiB'.format(
+                label, report[key] / 1024 ** 2))
+    lag = report['loop_lag_seconds']
+    if lag['samples']:
+        lines.append(
+            'Loop lag        mean {mean:.4f}s  p99 <= {p99_at_most}s  '
+            'max <= {max_at_most}s ({samples} samples)'.format(**lag))
+    return lines
+
+
+def format_report(report):
+    lines = [
+        '{builds} builds ({failed} failed) in {seconds:.2f}s with '
+        '{concurrency} clients and {workers} workers: '
+        '{builds_per_second:.1f} builds/s'.format(**report),
+    ]
+    lines.extend(format_latencies(report, [
+        ('post_seconds', 'POST'),
+        ('first_byte_seconds', 'First log byte'),
+        ('build_seconds', 'Whole build'),
+    ]))
+    lines.extend(format_resources(report))
+    for failure in report['failures']:
+        lines.append('Failed: {0}'.format(failure))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--builds', type=int, default=200,
+                        help='Builds to measure (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Clients, each with its own build name')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='HarborPilot worker processes')
+    parser.add_argument('--files', type=int, default=200,
+                        help='Files in each repo')
+    parser.add_argument('--file-bytes', type=int, default=4096,
+                        help='Bytes in each file')
+    parser.add_argument('--messages', type=int, default=200,
+                        help='Messages in each build output')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Build messages a second, 0 for no limit')
+    parser.add_argument('--stream',
+                        help='Recorded build output to send instead')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the repos, state and logs')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args()
+    root = tempfile.mkdtemp(prefix='harborpilot-bench-')
+    benchmark = Benchmark(root, args)
+    try:
+        benchmark.services.start(benchmark.prepare())
+        asyncio.get_event_loop().run_until_complete(benchmark.run())
+    finally:
+        benchmark.services.stop()
+        if args.keep:
+            print('Kept {0}'.format(root), file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    report = benchmark.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
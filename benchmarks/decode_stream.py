@@ -0,0 +1,156 @@
+"""
+Micro-benchmark of decoding a Docker Engine /build response stream.
+
+Compares the original line-at-a-time loop (readline, decode, json.loads,
+one consumer call per message) with :class:`harborpilot.docker.ImageBuild`'s
+batched decoding, on a recorded stream (line-delimited JSON, as saved from
+the engine's response) or a synthetic one resembling a verbose build.
+
+Usage::
+
+    python benchmarks/decode_stream.py [--stream FILE] [--messages N]
+"""
+import io
+import json
+import time
+import asyncio
+import argparse
+
+from harborpilot import docker
+
+
+def synthetic_stream(message_count):
+    """
+    Return bytes of line-delimited JSON resembling a verbose build: steps,
+    lots of output lines, and layer pull progress.
+    """
+    lines = []
+    for i in range(message_count):
+        kind = i % 10
+        if kind == 0:
+            message = {'stream': 'Step {0}/{1} : RUN make -j8\n'.format(
+                i // 10 + 1, message_count // 10)}
+        elif kind < 7:
+            message = {'stream': (
+                'gcc -O2 -Wall -c src/module_{0}.c -o build/module_{0}.o\n'
+            ).format(i)}
+        else:
+            message = {
+                'status': 'Downloading',
+                'progressDetail': {'current': i * 1024, 'total': 10 ** 8},
+                'progress': '[=====>     ]  {0}kB/100MB'.format(i),
+                'id': '{0:012x}'.format(i),
+            }
+        lines.append(json.dumps(message).encode('utf-8'))
+    lines.append(json.dumps({'aux': {'ID': 'sha256:' + '0' * 64}}).encode())
+    return b'\n'.join(lines) + b'\n'
+
+
+class _FakeContent:
+    """
+    Stands in for ``aiohttp.ClientResponse.content``, handing out data in
+    network-sized pieces.
+    """
+    read_size = 64 * 1024
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    async def readline(self):
+        return self._data.readline()
+
+    async def readany(self):
+        return self._data.read(self.read_size)
+
+
+class _FakeResponse:
+    status = 200
+    headers = {}
+
+    def __init__(self, data):
+        self.content = _FakeContent(data)
+
+
+class _CountingConsumer:
+    def __init__(self):
+        self.count = 0
+
+    def message_received(self, message):
+        self.count += 1
+
+    async def last_message_received(self):
+        pass
+
+
+class _BatchCountingConsumer(_CountingConsumer):
+    def messages_received(self, messages):
+        self.count += len(messages)
+
+
+async def _line_at_a_time(data, consumer):
+    """
+    The decoding loop as it was before batching.
+    """
+    response = _FakeResponse(data)
+    while True:
+        line = await response.content.readline()
+        if not line:
+            await consumer.last_message_received()
+            break
+        linetext = line.decode('utf-8')
+        message = json.loads(linetext)
+        consumer.message_received(message)
+
+
+async def _batched(data, consumer):
+    build = docker.ImageBuild(None, b'', image_name='benchmark')
+    build._messages_consumer = consumer
+    build._ready_to_receive.set()
+    await build._process_response(_FakeResponse(data))
+
+
+def _time(loop, decode, data, consumer_class, repeat):
+    best = None
+    for _ in range(repeat):
+        consumer = consumer_class()
+        started = time.perf_counter()
+        loop.run_until_complete(decode(data, consumer))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, consumer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--stream', help='recorded response body to decode')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_stream(args.messages)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print('JSON backend: {0}'.format(
+        'orjson' if docker.orjson is not None else 'json'))
+    print('Stream: {0:.1f} MiB'.format(len(data) / 1024 ** 2))
+    results = [
+        ('line at a time', _line_at_a_time, _CountingConsumer),
+        ('batched, per-message consumer', _batched, _CountingConsumer),
+        ('batched, batch consumer', _batched, _BatchCountingConsumer),
+    ]
+    baseline = None
+    for name, decode, consumer_class in results:
+        seconds, count = _time(loop, decode, data, consumer_class, args.repeat)
+        baseline = baseline or seconds
+        print('{0:32} {1:8.3f}s {2:10.0f} msg/s  {3:5.2f}x'.format(
+            name, seconds, count / seconds, baseline / seconds))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
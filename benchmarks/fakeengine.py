@@ -0,0 +1,216 @@
+"""
+A fake Docker Engine on a UNIX socket, with just enough of the Engine
+API for HarborPilot's builds, so they can be benchmarked without Docker.
+
+``/build`` reads the uploaded context, then answers with a line-delimited
+JSON stream: a recorded one (as saved from an engine's response), or a
+synthetic one resembling a verbose build. It's sent at ``rate`` messages
+a second, in batches, or as fast as possible with a rate of 0, and ends
+with the ID of an image made up from the context's digest.
+
+Given HarborPilot traces (see :mod:`harborpilot.trace`), builds of an
+image named like a build in them get its recorded engine output instead,
+with the same timing ``speed`` times faster; the recorded builds of each
+name are sent in turn.
+
+Usage::
+
+    python benchmarks/fakeengine.py --socket PATH [--stream FILE]
+        [--messages N] [--rate N] [--delay SECONDS]
+        [--trace FILE [--trace FILE...] [--speed N]]
+"""
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import itertools
+
+import aiohttp.web as aweb
+
+from harborpilot import trace
+from decode_stream import synthetic_stream
+
+
+# Seconds between batches of messages, when the rate is limited
+BATCH_INTERVAL = 0.01
+
+
+class FakeEngine:
+    """
+    Answers builds with ``stream`` (bytes of line-delimited JSON, without
+    the final image ID), sending ``rate`` messages a second (0 for no
+    limit) after waiting ``delay`` seconds, and keeps the images built in
+    memory.
+
+    Builds of images named in ``recorded``, a dict of image name -> list
+    of recorded ``chunks`` of trace stream events, get those instead,
+    ``speed`` times faster.
+    """
+    def __init__(self, stream, *, rate=0, delay=0.0, recorded=None,
+                 speed=1.0):
+        self.lines = stream.splitlines(keepends=True)
+        self.rate = rate
+        self.delay = delay
+        self.speed = speed
+        self._recorded = {
+            name: itertools.cycle(streams)
+            for name, streams in (recorded or {}).items()
+        }
+        self.images = {}  # ID -> {'Id': ..., 'Labels': ..., 'Tags': [...]}
+        self.build_count = 0
+        self.context_bytes = 0
+
+    def make_app(self):
+        app = aweb.Application(client_max_size=0)
+        app.add_routes([
+            aweb.get('/_ping', self.ping),
+            aweb.post('/build', self.build),
+            aweb.get('/images/json', self.list_images),
+            aweb.get('/images/{name:.+}/json', self.inspect_image),
+            aweb.post('/images/{name:.+}/tag', self.tag_image),
+        ])
+        return app
+
+    async def ping(self, request):
+        return aweb.Response(text='OK')
+
+    async def build(self, request):
+        self.build_count += 1
+        digest = hashlib.sha256()
+        async for chunk in request.content.iter_any():
+            digest.update(chunk)
+            self.context_bytes += len(chunk)
+        image_id = 'sha256:' + digest.hexdigest()
+        response = aweb.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        image_name = request.query.get('t', '').rsplit(':', 1)[0]
+        if image_name in self._recorded:
+            await self._send_recorded(
+                response, next(self._recorded[image_name]))
+        else:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            await self._send_lines(response)
+        aux = {'aux': {'ID': image_id}}
+        await response.write(json.dumps(aux).encode('utf-8') + b'\n')
+        self._tag(image_id, request.query.get('t', image_id))
+        self.images[image_id]['Labels'] = json.loads(
+            request.query.get('labels', '{}'))
+        await response.write_eof()
+        return response
+
+    async def list_images(self, request):
+        filters = json.loads(request.query.get('filters', '{}'))
+        wanted = set(filters.get('label', []))
+        return aweb.json_response([
+            {'Id': image['Id']}
+            for image in self.images.values()
+            if wanted <= {
+                '{0}={1}'.format(name, value)
+                for name, value in image['Labels'].items()
+            }
+        ])
+
+    async def inspect_image(self, request):
+        image = self._find(request.match_info['name'])
+        if image is None:
+            raise aweb.HTTPNotFound()
+        return aweb.json_response(
+            {'Id': image['Id'], 'Config': {'Labels': image['Labels']}})
+
+    async def tag_image(self, request):
+        image = self._find(request.match_info['name'])
+        if image is None:
+            raise aweb.HTTPNotFound()
+        self._tag(image['Id'], '{0}:{1}'.format(
+            request.query['repo'], request.query.get('tag', 'latest')))
+        return aweb.Response(status=201)
+
+    async def _send_lines(self, response):
+        if not self.rate:
+            await response.write(b''.join(self.lines))
+            return
+        batch_size = max(1, round(self.rate * BATCH_INTERVAL))
+        interval = batch_size / self.rate
+        next_batch = time.monotonic()
+        for start in range(0, len(self.lines), batch_size):
+            await response.write(
+                b''.join(self.lines[start:start + batch_size]))
+            # Against the schedule rather than after each write, so slow
+            # writes don't lower the rate.
+            next_batch += interval
+            delay = next_batch - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _send_recorded(self, response, chunks):
+        start = time.monotonic()
+        for seconds, text in chunks:
+            delay = start + seconds / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await response.write(text.encode('utf-8'))
+        # Its own image ID follows, after any line left unfinished
+        if chunks and not chunks[-1][1].endswith('\n'):
+            await response.write(b'\n')
+
+    def _find(self, name):
+        if name in self.images:
+            return self.images[name]
+        if ':' not in name.rsplit('/', 1)[-1]:
+            name += ':latest'
+        for image in self.images.values():
+            if name in image['Tags']:
+                return image
+        return None
+
+    def _tag(self, image_id, ref):
+        for image in self.images.values():
+            if ref in image['Tags']:
+                image['Tags'].remove(ref)
+        image = self.images.setdefault(
+            image_id, {'Id': image_id, 'Labels': {}, 'Tags': []})
+        image['Tags'].append(ref)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--socket', required=True,
+                        help='UNIX socket to listen on')
+    parser.add_argument('--stream', help='Recorded response body to send')
+    parser.add_argument('--messages', type=int, default=200,
+                        help='Messages of the synthetic stream')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages a second, 0 for no limit')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='Seconds before the first message')
+    parser.add_argument('--trace', action='append', default=[],
+                        help='HarborPilot trace to replay builds from')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How much faster to replay them')
+    args = parser.parse_args()
+    if args.stream:
+        with open(args.stream, 'rb') as stream_file:
+            stream = stream_file.read()
+    else:
+        # Without its image ID, which is made up for each build
+        stream = synthetic_stream(args.messages).rsplit(b'\n', 2)[0] + b'\n'
+    recorded = {}
+    for event in trace.read_events(args.trace):
+        if event['type'] == 'stream':
+            recorded.setdefault(event['build_name'], []).append(
+                event['chunks'])
+    engine = FakeEngine(
+        stream,
+        rate=args.rate,
+        delay=args.delay,
+        recorded=recorded,
+        speed=args.speed,
+    )
+    aweb.run_app(engine.make_app(), path=args.socket, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Generates Git repositories to build, of a given number and size of files
+spread over directories, with a Dockerfile at the top.
+
+Usage::
+
+    python benchmarks/makerepo.py PATH [--files N] [--file-bytes N]
+        [--files-per-dir N] [--seed N]
+"""
+import os
+import random
+import argparse
+import tempfile
+import subprocess
+
+
+DOCKERFILE = 'FROM scratch\nCOPY . /src\n'
+
+# So commits don't depend on the user's Git configuration
+_GIT_CONFIG = [
+    '-c', 'user.name=HarborPilot Benchmarks',
+    '-c', 'user.email=benchmarks@harborpilot.invalid',
+    '-c', 'commit.gpgsign=false',
+]
+
+
+def git(repo, *args):
+    subprocess.run(
+        ['git'] + _GIT_CONFIG + list(args),
+        cwd=str(repo),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def make_repo(path, *, files=100, file_bytes=4096, files_per_dir=50,
+              seed=0):
+    """
+    Create a Git repo at ``path`` with a Dockerfile and ``files`` files
+    of ``file_bytes`` random bytes each (so they don't compress), at
+    most ``files_per_dir`` to a directory, committed on ``master``.
+
+    The same ``seed`` gives the same contents.
+    """
+    rng = random.Random(seed)
+    os.makedirs(str(path))
+    for index in range(files):
+        directory = os.path.join(
+            str(path), 'src', 'd{0:04d}'.format(index // files_per_dir))
+        if index % files_per_dir == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'f{0:06d}'.format(index)),
+                  'wb') as data_file:
+            data_file.write(
+                rng.getrandbits(8 * file_bytes).to_bytes(file_bytes, 'big')
+                if file_bytes else b'')
+    with open(os.path.join(str(path), 'Dockerfile'), 'w') as dockerfile:
+        dockerfile.write(DOCKERFILE)
+    git(path, 'init', '-q')
+    git(path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Generated')
+
+
+def push(repo, message='Push'):
+    """
+    Add an empty commit to ``repo``, giving it a new commit to build.
+    """
+    git(repo, 'commit', '-q', '--allow-empty', '-m', message)
+
+
+def make_commits(repo, count):
+    """
+    Return the hashes of ``count`` new empty commits in ``repo``, each
+    the child of the one before, the first of ``master``'s. They're on
+    no branch until :func:`set_branch` puts one there.
+
+    They're all made by one ``git fast-import``, so it's quick even for
+    thousands.
+    """
+    if not count:
+        return []
+    head = subprocess.run(
+        ['git', 'rev-parse', 'refs/heads/master'],
+        cwd=str(repo), check=True, stdout=subprocess.PIPE,
+    ).stdout.decode('ascii').strip()
+    commands = []
+    for index in range(1, count + 1):
+        message = 'Push {0}'.format(index)
+        commands.append(
+            'commit refs/harborpilot-bench/pushes\n'
+            'mark :{0}\n'
+            'committer Benchmarks <benchmarks@harborpilot.invalid> '
+            '{1} +0000\n'
+            'data {2}\n{3}\n'.format(index, index, len(message), message))
+        if index == 1:
+            commands.append('from {0}\n'.format(head))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Written anew by Git, so read by name once it's done
+        marks_path = os.path.join(temp_dir, 'marks')
+        subprocess.run(
+            ['git', 'fast-import', '--quiet',
+             '--export-marks={0}'.format(marks_path)],
+            input=''.join(commands).encode('utf-8'),
+            cwd=str(repo),
+            check=True,
+        )
+        with open(marks_path) as marks:
+            hashes = dict(line.split() for line in marks)
+    return [hashes[':{0}'.format(index)] for index in range(1, count + 1)]
+
+
+def set_branch(repo, commit_hash, branch='master'):
+    """
+    Point ``branch`` of ``repo`` at ``commit_hash``, by writing the ref
+    file, which is much quicker than running Git.
+    """
+    ref_path = os.path.join(str(repo), '.git', 'refs', 'heads', branch)
+    temp_path = ref_path + '.tmp'
+    with open(temp_path, 'w') as ref_file:
+        ref_file.write(commit_hash + '\n')
+    os.replace(temp_path, ref_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='Where to create the repo')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--file-bytes', type=int, default=4096)
+    parser.add_argument('--files-per-dir', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_repo(
+        args.path,
+        files=args.files,
+        file_bytes=args.file_bytes,
+        files_per_dir=args.files_per_dir,
+        seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Replays HarborPilot traces (see :mod:`harborpilot.trace`) against a
+local HarborPilot building on a fake engine, to reproduce a production
+push storm, faster if wanted, without Docker.
+
+Every build request in the traces is sent at the same offset from the
+first one, divided by ``speed`` (1, 10, 100...), for a build of the
+same name, each with a new commit to build. The fake engine answers
+each build with the engine output recorded for builds of its name,
+just as sped up. Builds named in the traces without any recorded
+output get a synthetic one.
+
+Reports how the service kept up:
+
+-   Requests accepted and refused with 503, and how many were refused
+    when recorded.
+-   How the builds ended, and how long they waited in the queue and took
+    in all, as p50/p99/max.
+-   The latency of the POSTs, and how far behind schedule the replay
+    sent them (if much, the replay rather than the service was the
+    bottleneck).
+-   HarborPilot's peak RSS and event loop lag.
+
+Usage::
+
+    python benchmarks/replay.py TRACE [TRACE...] [--speed N] [--workers N]
+        [--max-concurrent-builds N] [--max-concurrent-per-build N]
+        [--max-queued-builds N] [--files N] [--file-bytes N] [--keep]
+        [--json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+import collections
+
+import aiohttp
+
+from harborpilot import trace
+
+import makerepo
+from build_throughput import (
+    Services, summarize, summarize_loop_lag, format_latencies,
+    format_resources,
+)
+
+
+# Build statuses of builds that haven't ended
+_ACTIVE_STATUSES = frozenset(['queued', 'preparing', 'building'])
+
+# Seconds between checks on the builds still running after the last
+# request
+POLL_INTERVAL = 0.25
+
+
+class Replay:
+    """
+    One replay of the build requests in ``events`` (from
+    :func:`harborpilot.trace.read_events`), in the directory ``root``.
+    See :func:`main` for the arguments.
+    """
+    def __init__(self, root, events, args):
+        self.root = root
+        self.args = args
+        self.requests = [
+            event for event in events if event['type'] == 'request']
+        if not self.requests:
+            raise ValueError('The traces have no build requests')
+        self.build_names = sorted(set(
+            event['build_name'] for event in self.requests))
+        self._repos = {
+            build_name: os.path.join(self.root, 'repos', str(index))
+            for index, build_name in enumerate(self.build_names)
+        }
+        engine_args = ['--speed', str(args.speed)]
+        for path in args.traces:
+            engine_args += ['--trace', os.path.abspath(path)]
+        self.services = Services(
+            root, workers=args.workers, engine_args=engine_args)
+        self.base_url = self.services.base_url
+        self.results = []
+        self.builds = {}  # build_id -> description
+        self._build_names = {}  # build_id -> build_name
+
+    def prepare(self):
+        """
+        Create the repos with a commit for each request, and return the
+        config to start HarborPilot with.
+        """
+        base_repo = os.path.join(self.root, 'repos', 'base')
+        makerepo.make_repo(
+            base_repo,
+            files=self.args.files,
+            file_bytes=self.args.file_bytes,
+        )
+        counts = collections.Counter(
+            event['build_name'] for event in self.requests)
+        self._commits = {}
+        for build_name, repo in self._repos.items():
+            makerepo.git(self.root, 'clone', '-q', base_repo, repo)
+            self._commits[build_name] = collections.deque(
+                makerepo.make_commits(repo, counts[build_name]))
+        scheduler = {
+            name: value for name, value in [
+                ('max_concurrent_builds', self.args.max_concurrent_builds),
+                ('max_concurrent_per_build',
+                 self.args.max_concurrent_per_build),
+                ('max_queued_builds', self.args.max_queued_builds),
+            ]
+            if value is not None
+        }
+        return self.services.config(
+            {
+                build_name: {
+                    'image_name': build_name,
+                    'git': {'remote': repo},
+                }
+                for build_name, repo in self._repos.items()
+            },
+            scheduler=scheduler,
+        )
+
+    async def run(self):
+        services = self.services
+        async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None)) as session:
+            await services.wait_until_up(session)
+            # The mirrors are cloned by the first build of each name,
+            # which in production happened long before.
+            warm_up = []
+            for build_name in self.build_names:
+                status, body = await self._post(session, build_name)
+                if status != 202:
+                    raise RuntimeError(
+                        'Warm-up build of {0} answered {1}: {2}'.format(
+                            build_name, status, body))
+                warm_up.append(body['build_id'])
+            await self._wait_for_builds(session, warm_up)
+            self.builds.clear()
+
+            lag_before = await services.loop_lag(session)
+            rss_sampler = asyncio.ensure_future(services.sample_rss())
+            first = self.requests[0]['time']
+            start = time.perf_counter()
+            sends = []
+            for event in self.requests:
+                scheduled = (event['time'] - first) / self.args.speed
+                delay = start + scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                sends.append(asyncio.ensure_future(self._send(
+                    session, event, start + scheduled)))
+            await asyncio.gather(*sends)
+            accepted = set(
+                result['build_id'] for result in self.results
+                if result['build_id'] is not None
+            )
+            await self._wait_for_builds(session, accepted)
+            self.elapsed = time.perf_counter() - start
+            rss_sampler.cancel()
+            self.final_rss = services.rss()
+            lag_after = await services.loop_lag(session)
+        self.loop_lag = summarize_loop_lag(lag_before, lag_after)
+
+    def report(self):
+        statuses = collections.Counter(
+            result['status'] for result in self.results)
+        outcomes = collections.Counter(
+            build['status'] for build in self.builds.values())
+        first = self.requests[0]['time']
+        report = {
+            'speed': self.args.speed,
+            'workers': self.args.workers,
+            'requests': len(self.results),
+            'trace_seconds': self.requests[-1]['time'] - first,
+            'seconds': self.elapsed,
+            'accepted': statuses[202],
+            'refused': statuses[503],
+            'refused_when_recorded': sum(
+                1 for event in self.requests if event['status'] == 503),
+            'other_responses': {
+                str(status): count for status, count in statuses.items()
+                if status not in (202, 503)
+            },
+            'builds': len(self.builds),
+            'build_outcomes': dict(outcomes),
+            'peak_rss_bytes': self.services.peak_rss(),
+            'final_rss_bytes': self.final_rss,
+            'loop_lag_seconds': self.loop_lag,
+        }
+        report['post_seconds'] = summarize(
+            [result['post_seconds'] for result in self.results])
+        report['late_seconds'] = summarize(
+            [result['late_seconds'] for result in self.results])
+        queue_waits = [
+            build['queue_wait_seconds'] for build in self.builds.values()
+            if build['queue_wait_seconds'] is not None
+        ]
+        if queue_waits:
+            report['queue_wait_seconds'] = summarize(queue_waits)
+        build_seconds = [
+            _seconds_between(build['created_at'], build['finished_at'])
+            for build in self.builds.values()
+            if build['finished_at'] is not None
+        ]
+        if build_seconds:
+            report['build_seconds'] = summarize(build_seconds)
+        return report
+
+    async def _send(self, session, event, scheduled):
+        build_name = event['build_name']
+        makerepo.set_branch(
+            self._repos[build_name], self._commits[build_name].popleft())
+        sent = time.perf_counter()
+        try:
+            status, body = await self._post(session, build_name)
+        except aiohttp.ClientError as e:
+            status = type(e).__name__
+            body = {}
+        self.results.append({
+            'status': status,
+            'build_id': body.get('build_id') if status == 202 else None,
+            'post_seconds': time.perf_counter() - sent,
+            'late_seconds': max(0.0, sent - scheduled),
+        })
+
+    async def _post(self, session, build_name):
+        """
+        Request a build of ``build_name``, and return the response status
+        and body.
+        """
+        async with session.post(
+                '{0}/apis/builds/{1}'.format(self.base_url, build_name),
+            ) as response:
+            try:
+                body = await response.json(content_type=None)
+            except ValueError:
+                body = {}
+        if response.status == 202:
+            self._build_names[body['build_id']] = build_name
+        return response.status, body
+
+    async def _wait_for_builds(self, session, build_ids):
+        """
+        Wait for the builds ``build_ids`` to end, keeping their last
+        descriptions in :attr:`builds`.
+        """
+        pending = set(build_ids)
+        while pending:
+            for build_id in list(pending):
+                build = self.builds.get(build_id)
+                if build is not None and (
+                        build['status'] not in _ACTIVE_STATUSES):
+                    pending.discard(build_id)
+            if not pending:
+                break
+            await asyncio.gather(*(
+                self._describe(session, build_id) for build_id in pending))
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _describe(self, session, build_id):
+        async with session.get('{0}/apis/builds/{1}/{2}'.format(
+                self.base_url, self._build_names[build_id], build_id,
+            )) as response:
+            response.raise_for_status()
+            self.builds[build_id] = await response.json()
+
+
+def _seconds_between(start, end):
+    return (
+        datetime.datetime.fromisoformat(end)
+        - datetime.datetime.fromisoformat(start)
+    ).total_seconds()
+
+
+def format_report(report):
+    lines = [
+        '{requests} requests over {trace_seconds:.1f}s recorded, replayed '
+        'at {speed:g}x with {workers} workers in {seconds:.2f}s'.format(
+            **report),
+        'Accepted {accepted}, refused {refused} (refused when recorded: '
+        '{refused_when_recorded})'.format(**report),
+        '{0} builds: {1}'.format(report['builds'], ', '.join(
+            '{0} {1}'.format(count, status) for status, count
+            in sorted(report['build_outcomes'].items())) or 'none'),
+    ]
+    for status, count in sorted(report['other_responses'].items()):
+        lines.append('Answered {0}: {1}'.format(status, count))
+    lines.extend(format_latencies(report, [
+        ('post_seconds', 'POST'),
+        ('late_seconds', 'Sent late by'),
+        ('queue_wait_seconds', 'Queue wait'),
+        ('build_seconds', 'Whole build'),
+    ]))
+    lines.extend(format_resources(report))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('traces', nargs='+', metavar='TRACE',
+                        help='Trace files, such as each worker\'s')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How much faster than recorded, like 10 or 100')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='HarborPilot worker processes')
+    parser.add_argument('--max-concurrent-builds', type=int,
+                        help='Scheduler setting to replay with')
+    parser.add_argument('--max-concurrent-per-build', type=int,
+                        help='Scheduler setting to replay with')
+    parser.add_argument('--max-queued-builds', type=int,
+                        help='Scheduler setting to replay with')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files in each repo')
+    parser.add_argument('--file-bytes', type=int, default=4096,
+                        help='Bytes in each file')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the repos, state and logs')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    root = tempfile.mkdtemp(prefix='harborpilot-replay-')
+    try:
+        replay = Replay(root, trace.read_events(args.traces), args)
+        replay.services.start(replay.prepare())
+        try:
+            asyncio.get_event_loop().run_until_complete(replay.run())
+        finally:
+            replay.services.stop()
+    finally:
+        if args.keep:
+            print('Kept {0}'.format(root), file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    report = replay.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,216 @@
-import asyncio
+import pathlib
 
 import aiohttp.web as aweb
 
 from harborpilot import handlers
 from harborpilot import docker
+from harborpilot import builds
+from harborpilot import git
+from harborpilot import dedup
+from harborpilot import scheduler
+from harborpilot import history
+from harborpilot import logstore
+from harborpilot import metrics
+from harborpilot import contextcache
+from harborpilot import reloader
+from harborpilot import trace
 
 
-async def build_app(config):
+async def build_app(
+        config, *, client_session=None, base_url=docker.DEFAULT_BASE_URL,
+        worker=None, config_path=None
+    ):
+    """
+    Return the application for ``config``.
+
+    Builds run on the engines in the config; pass ``client_session``
+    and ``base_url`` to use just that one instead.
+
+    Pass ``worker`` (a :class:`.workers.Worker`) when the application is
+    one of several worker processes, and ``config_path`` (the file
+    ``config`` was read from) to reload the builds from it on SIGHUP or
+    when it changes.
+    """
     app = aweb.Application()
-    app['push_receiver_client_session'] = docker.make_session()
-    app.on_cleanup.append(dispose_push_receiver_client_session)
+    shared_state = None
+    if worker is not None:
+        shared_state = worker.shared_state
+    if client_session is None:
+        engine_pool = docker.EnginePool(
+            [
+                docker.Engine.from_url(
+                    endpoint.url,
+                    max_connections=endpoint.max_connections,
+                    keepalive_timeout=endpoint.keepalive_timeout,
+                )
+                for endpoint in config.engines.endpoints
+            ],
+            placement=config.engines.placement,
+            health_check_interval=config.engines.health_check_interval,
+        )
+    else:
+        engine_pool = docker.EnginePool(
+            [docker.Engine(client_session, base_url=base_url)])
+    app['engine_pool'] = engine_pool
+    app.on_startup.append(start_engine_pool)
+    app.on_cleanup.append(close_engine_pool)
+    mirror_cache = git.MirrorCache(
+        pathlib.Path(config.state_dir) / 'mirrors',
+        max_bytes=config.git_cache.max_bytes,
+        partial=config.git_cache.partial_clone,
+    )
+    context_cache = None
+    if config.context_cache.enabled:
+        context_cache = contextcache.ContextCache(
+            pathlib.Path(config.state_dir) / 'contexts',
+            max_bytes=config.context_cache.max_bytes,
+        )
+    build_index = dedup.BuildIndex(
+        pathlib.Path(config.state_dir) / 'build-index.jsonl')
+    build_history = history.BuildHistory(
+        pathlib.Path(config.state_dir) / 'history.sqlite')
+    app['build_history'] = build_history
+    app.on_cleanup.append(close_build_history)
+    log_store = logstore.LogStore(
+        pathlib.Path(config.state_dir) / 'logs',
+        max_age_seconds=config.logs.max_age_days * 24 * 60 * 60,
+        max_total_bytes=config.logs.max_disk_bytes,
+    )
+    log_store.evict()
+    app['log_store'] = log_store
+    app.on_cleanup.append(close_log_store)
+    build_scheduler = scheduler.BuildScheduler(
+        max_concurrent=config.scheduler.max_concurrent_builds,
+        max_per_build=config.scheduler.max_concurrent_per_build,
+        max_queued=config.scheduler.max_queued_builds,
+        shared_state=shared_state,
+    )
+    registry = metrics.Registry(
+        const_labels=(
+            {'worker': str(worker.index)} if worker is not None else None),
+    )
+    build_metrics = metrics.BuildMetrics(
+        registry, build_scheduler, engine_pool=engine_pool)
+    app['loop_lag_monitor'] = metrics.LoopLagMonitor(
+        build_metrics.loop_lag_seconds)
+    app.on_startup.append(start_loop_lag_monitor)
+    app.on_cleanup.append(stop_loop_lag_monitor)
+    trace_recorder = None
+    if config.trace.enabled:
+        trace_recorder = trace.TraceRecorder(
+            trace.trace_path(config.state_dir),
+            max_stream_bytes=config.trace.max_stream_bytes,
+        )
+        app['trace_recorder'] = trace_recorder
+        app.on_cleanup.append(close_trace_recorder)
+    build_coordinator = builds.BuildCoordinator(
+        engine_pool,
+        mirror_cache,
+        build_index,
+        build_scheduler,
+        max_output_bytes=config.logs.max_memory_bytes,
+        build_history=build_history,
+        log_store=log_store,
+        build_metrics=build_metrics,
+        context_cache=context_cache,
+        shared_state=shared_state,
+        trace_recorder=trace_recorder,
+    )
     push_receiver = handlers.ImagePushHookReceiver(
-        app['push_receiver_client_session'],
+        build_coordinator,
         config.builds,
+        build_history=build_history,
+        log_store=log_store,
+        worker=worker,
+        trace_recorder=trace_recorder,
     )
     app.add_routes([
         aweb.post(
             '/apis/builds/{build_name}',
             push_receiver.build_image_from_git,
         ),
+        # Before the build status route, which would match it too
+        aweb.get(
+            '/apis/builds/{build_name}/history',
+            push_receiver.get_build_history,
+            name='build_history',
+        ),
+        aweb.get(
+            '/apis/builds/{build_name}/{build_id}',
+            push_receiver.get_build_status,
+            name='build_status',
+        ),
+        aweb.get(
+            '/apis/builds/{build_name}/{build_id}/log',
+            push_receiver.get_build_log,
+            name='build_log',
+        ),
+        aweb.get(
+            '/apis/builds/{build_name}/{build_id}/events',
+            push_receiver.get_build_events,
+        ),
+        aweb.get(
+            '/apis/builds/{build_name}/{build_id}/ws',
+            push_receiver.get_build_websocket,
+        ),
+        aweb.get(
+            '/apis/scheduler',
+            handlers.SchedulerStatus(build_scheduler).get_status,
+        ),
+        aweb.get(
+            '/metrics',
+            handlers.MetricsExporter(registry, worker=worker).get_metrics,
+        ),
     ])
+    if config_path is not None:
+        config_reloader = reloader.ConfigReloader(config_path, config)
+        config_reloader.listeners.append(
+            lambda new: push_receiver.update_configs(new.builds))
+        app['config_reloader'] = config_reloader
+        app.on_startup.append(start_config_reloader)
+        app.on_cleanup.append(stop_config_reloader)
+    if worker is not None:
+        # Last, since the rest may still update the shared state
+        app['worker'] = worker
+        app.on_cleanup.append(close_worker)
     return app
 
 
-async def dispose_push_receiver_client_session(app):
-    session = app['push_receiver_client_session']
-    del app['push_receiver_client_session']
-    # Zero-sleep to allow underlying connections to close
-    await asyncio.sleep(0)
-    await session.close()
+async def start_engine_pool(app):
+    app['engine_pool'].start()
+
+
+async def close_engine_pool(app):
+    await app['engine_pool'].close()
+
+
+async def close_build_history(app):
+    await app['build_history'].close()
+
+
+async def close_log_store(app):
+    await app['log_store'].close()
+
+
+async def start_loop_lag_monitor(app):
+    app['loop_lag_monitor'].start()
+
+
+async def stop_loop_lag_monitor(app):
+    await app['loop_lag_monitor'].stop()
+
+
+async def close_trace_recorder(app):
+    await app['trace_recorder'].close()
+
+
+async def start_config_reloader(app):
+    app['config_reloader'].start()
+
+
+async def stop_config_reloader(app):
+    await app['config_reloader'].stop()
+
+
+async def close_worker(app):
+    await app['worker'].close()
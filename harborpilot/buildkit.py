@@ -0,0 +1,298 @@
+"""
+BuildKit's build progress, as the Engine API's /build streams it for
+``version=2`` builds.
+
+Instead of ``stream`` text, BuildKit sends messages with the ID
+:data:`TRACE_ID` whose ``aux`` is a base64 encoded ``StatusResponse``
+protobuf message (from ``moby/buildkit``'s control API) describing the
+progress of the build graph's vertices. :class:`TraceRenderer` turns
+those into text laid out like ``docker build --progress=plain``, so
+everything reading ``stream`` text works the same for both builders.
+
+Only the few fields used are decoded, with a minimal protobuf reader
+rather than a dependency on generated code.
+"""
+import base64
+import binascii
+import logging
+
+import attr
+
+
+log = logging.getLogger(__name__)
+
+
+TRACE_ID = 'moby.buildkit.trace'
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+
+class DecodeError(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return 'Bad BuildKit status message: {0}'.format(self.reason)
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise DecodeError('truncated varint')
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+        if shift > 63:
+            raise DecodeError('varint too long')
+
+
+def _fields(data):
+    """
+    Yield ``(field number, value)`` for each field of the encoded
+    protobuf message ``data``: an int for varints, and bytes for
+    length-delimited fields. Fixed-size fields are skipped.
+    """
+    position = 0
+    while position < len(data):
+        key, position = _read_varint(data, position)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == _VARINT:
+            value, position = _read_varint(data, position)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, position = _read_varint(data, position)
+            value = data[position:position + length]
+            if len(value) != length:
+                raise DecodeError('truncated field {0}'.format(number))
+            position += length
+        elif wire_type == _FIXED64:
+            position += 8
+            continue
+        elif wire_type == _FIXED32:
+            position += 4
+            continue
+        else:
+            raise DecodeError('unsupported wire type {0}'.format(wire_type))
+        yield number, value
+
+
+def _timestamp(data):
+    # google.protobuf.Timestamp: seconds, nanos
+    seconds = nanos = 0
+    for number, value in _fields(data):
+        if number == 1:
+            seconds = value
+        elif number == 2:
+            nanos = value
+    return seconds + nanos / 1e9
+
+
+def _text(data):
+    return data.decode('utf-8', 'replace')
+
+
+@attr.s
+class Vertex:
+    # str, the vertex's digest, which identifies it
+    digest = attr.ib()
+    # str, e.g. '[2/3] RUN make'
+    name = attr.ib(default='')
+    # bool, whether the result came from the cache
+    cached = attr.ib(default=False)
+    # float seconds since the epoch, or None
+    started = attr.ib(default=None)
+    completed = attr.ib(default=None)
+    # str, why the vertex failed, or ''
+    error = attr.ib(default='')
+
+    @classmethod
+    def decode(cls, data):
+        vertex = cls(digest='')
+        for number, value in _fields(data):
+            if number == 1:
+                vertex.digest = _text(value)
+            elif number == 3:
+                vertex.name = _text(value)
+            elif number == 4:
+                vertex.cached = bool(value)
+            elif number == 5:
+                vertex.started = _timestamp(value)
+            elif number == 6:
+                vertex.completed = _timestamp(value)
+            elif number == 7:
+                vertex.error = _text(value)
+        return vertex
+
+
+@attr.s
+class VertexLog:
+    # str, the digest of the vertex the output is from
+    vertex = attr.ib()
+    # float seconds since the epoch
+    timestamp = attr.ib(default=None)
+    # bytes, the output
+    msg = attr.ib(default=b'')
+
+    @classmethod
+    def decode(cls, data):
+        vertex_log = cls(vertex='')
+        for number, value in _fields(data):
+            if number == 1:
+                vertex_log.vertex = _text(value)
+            elif number == 2:
+                vertex_log.timestamp = _timestamp(value)
+            elif number == 4:
+                vertex_log.msg = bytes(value)
+        return vertex_log
+
+
+@attr.s
+class StatusResponse:
+    # list of Vertex
+    vertexes = attr.ib(default=attr.Factory(list))
+    # list of VertexLog
+    logs = attr.ib(default=attr.Factory(list))
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Decode the protobuf encoded ``data``. Vertex statuses (progress
+        of pulls and transfers) and warnings aren't decoded.
+        """
+        status = cls()
+        for number, value in _fields(data):
+            if number == 1:
+                status.vertexes.append(Vertex.decode(value))
+            elif number == 3:
+                status.logs.append(VertexLog.decode(value))
+        return status
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Decode the ``aux`` of a :data:`TRACE_ID` message from /build.
+        """
+        try:
+            data = base64.b64decode(message['aux'], validate=True)
+        except (KeyError, TypeError, binascii.Error) as e:
+            raise DecodeError(str(e))
+        return cls.decode(data)
+
+
+class TraceRenderer:
+    """
+    Replaces the BuildKit trace messages of a build with ``stream``
+    messages of the same progress as text. Each vertex gets a number in
+    the order it's seen, and its lines are prefixed with it::
+
+        #4 [2/3] RUN make
+        #4 0.512 cc -o app app.c
+        #4 DONE 1.3s
+
+    Cached vertices end with ``CACHED``, and failed ones with
+    ``ERROR: <reason>``.
+    """
+    def __init__(self):
+        # Vertex digest -> _VertexState
+        self._vertices = {}
+
+    def translate(self, messages):
+        """
+        Return ``messages`` with trace messages replaced by ``stream``
+        messages, and the rest left as they are.
+        """
+        translated = []
+        for message in messages:
+            if message.get('id') != TRACE_ID:
+                translated.append(message)
+                continue
+            try:
+                status = StatusResponse.from_message(message)
+            except DecodeError as e:
+                log.warning('Skipping BuildKit trace message: {0}'.format(e))
+                continue
+            text = self.render(status)
+            if text:
+                translated.append({'stream': text})
+        return translated
+
+    def render(self, status):
+        """
+        Return the text for the new progress in the
+        :class:`StatusResponse` ``status``.
+        """
+        lines = []
+        for vertex in status.vertexes:
+            state = self._state(vertex.digest)
+            if vertex.name:
+                state.name = vertex.name
+            if vertex.started is not None and state.started is None:
+                state.started = vertex.started
+            if vertex.started is not None or vertex.cached:
+                self._announce(state, lines)
+        # Output comes before the vertex's end in the same message
+        for vertex_log in status.logs:
+            state = self._state(vertex_log.vertex)
+            self._announce(state, lines)
+            if state.started is None:
+                state.started = vertex_log.timestamp
+            elapsed = 0.0
+            if vertex_log.timestamp is not None:
+                elapsed = vertex_log.timestamp - state.started
+            output = state.partial_line + _text(vertex_log.msg)
+            output_lines = output.split('\n')
+            state.partial_line = output_lines.pop()
+            for line in output_lines:
+                lines.append('#{0} {1:.3f} {2}'.format(
+                    state.number, elapsed, line.rstrip('\r')))
+        for vertex in status.vertexes:
+            state = self._state(vertex.digest)
+            if state.done:
+                continue
+            if vertex.cached:
+                ending = 'CACHED'
+            elif vertex.error:
+                ending = 'ERROR: {0}'.format(vertex.error)
+            elif vertex.completed is not None:
+                ending = 'DONE {0:.1f}s'.format(
+                    vertex.completed - (state.started or vertex.completed))
+            else:
+                continue
+            state.done = True
+            if state.partial_line:
+                lines.append('#{0} {1}'.format(
+                    state.number, state.partial_line))
+                state.partial_line = ''
+            lines.append('#{0} {1}'.format(state.number, ending))
+        return ''.join(line + '\n' for line in lines)
+
+    def _state(self, digest):
+        state = self._vertices.get(digest)
+        if state is None:
+            state = self._vertices[digest] = _VertexState(
+                len(self._vertices) + 1)
+        return state
+
+    @staticmethod
+    def _announce(state, lines):
+        if not state.announced:
+            state.announced = True
+            lines.append('#{0} {1}'.format(state.number, state.name))
+
+
+class _VertexState:
+    def __init__(self, number):
+        self.number = number
+        self.name = ''
+        self.started = None
+        self.announced = False
+        self.done = False
+        self.partial_line = ''
@@ -0,0 +1,667 @@
+"""
+Running image builds independently of the requests asking for them.
+"""
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import contextlib
+import logging
+import datetime
+import collections
+
+import attr
+
+from harborpilot import docker
+from harborpilot import git
+from harborpilot import dedup
+from harborpilot import history
+
+
+log = logging.getLogger(__name__)
+
+
+class BuildOutput:
+    """
+    The text output of a build, kept so that any number of readers can
+    follow it from the start while it's still being written.
+
+    Offsets count bytes from the start of the output. At most about
+    ``max_bytes`` (if given) are kept in memory; once more than that has
+    been written, the oldest output is dropped and reading starts from
+    :attr:`start_offset`. All of it is also written to ``log_writer`` (a
+    :class:`.logstore.LogWriter`), if given.
+    """
+    def __init__(self, *, max_bytes=None, log_writer=None):
+        self.max_bytes = max_bytes
+        self.log_writer = log_writer
+        self._data = bytearray()
+        self._start = 0
+        self._closed = False
+        self._waiter = asyncio.get_event_loop().create_future()
+
+    def write(self, data):
+        if self._closed:
+            raise Exception('Cannot write after close() called')
+        if not data:
+            return
+        if self.log_writer is not None:
+            self.log_writer.write(data)
+        self._data += data
+        # Trim in bulk rather than on every write, the bytearray moves
+        # everything down each time.
+        if self.max_bytes is not None and (
+                len(self._data) > self.max_bytes + self.max_bytes // 4):
+            excess = len(self._data) - self.max_bytes
+            del self._data[:excess]
+            self._start += excess
+        self._wake()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.log_writer is not None:
+            self.log_writer.close()
+        self._wake()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __len__(self):
+        """
+        Return the total number of bytes written, including any that
+        have been dropped.
+        """
+        return self._start + len(self._data)
+
+    @property
+    def start_offset(self):
+        """
+        The offset of the oldest output still kept.
+        """
+        return self._start
+
+    def read(self, offset=0):
+        """
+        Return the output written so far from byte ``offset`` (or
+        :attr:`start_offset`, if that's later) onward.
+        """
+        offset = max(offset, self._start)
+        return bytes(self._data[offset - self._start:])
+
+    async def follow(self, offset=0):
+        """
+        Asynchronously iterate over chunks of the output from byte
+        ``offset`` onward, waiting for more until the output is closed.
+
+        Output dropped from memory is read back from the log writer's
+        store if there is one, and skipped otherwise, or if the store
+        no longer has it.
+        """
+        while True:
+            if offset < self._start and self.log_writer is not None:
+                chunk = await self.log_writer.read(
+                    offset, self._start - offset)
+                if not chunk:
+                    log.warning(
+                        'Stored output of build {0} is missing from byte '
+                        '{1}, skipping to {2}'.format(
+                            self.log_writer.build_id, offset, self._start))
+                    offset = self._start
+                    continue
+                offset += len(chunk)
+                yield chunk
+            elif offset < len(self):
+                chunk = self.read(offset)
+                offset = len(self)
+                yield chunk
+            elif self._closed:
+                return
+            else:
+                await asyncio.shield(self._waiter)
+
+    def _wake(self):
+        waiter = self._waiter
+        self._waiter = asyncio.get_event_loop().create_future()
+        waiter.set_result(None)
+
+
+class OutputConsumer:
+    """
+    An :meth:`.docker.ImageBuild.dispatch_messages` consumer writing the
+    ``stream`` portion of the messages to a :class:`BuildOutput`.
+    """
+    def __init__(self, output):
+        self._output = output
+
+    def message_received(self, message):
+        self.messages_received((message,))
+
+    def messages_received(self, messages):
+        self._output.write(docker.stream_text(messages).encode('utf-8'))
+
+    async def last_message_received(self):
+        pass
+
+
+class Build:
+    """
+    A single run of a configured image build.
+
+    The build runs in its own task, independent of the requests that
+    asked for it or are watching it. Follow :attr:`output` for its
+    progress, or subscribe to :attr:`broadcast` for just the live tail,
+    and check :attr:`status` for where it's at.
+    """
+    # Values of status, in the order a build goes through them. A build
+    # ends up in one of the last five: FINISHED is for when the engine
+    # didn't say whether the build succeeded, and ERRORED is for when
+    # HarborPilot couldn't get the build done.
+    QUEUED = 'queued'
+    PREPARING = 'preparing'
+    BUILDING = 'building'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    FINISHED = 'finished'
+    REUSED = 'reused'
+    ERRORED = 'errored'
+
+    def __init__(
+            self, image_build_config, ticket, *, max_output_bytes=None,
+            log_store=None
+        ):
+        self.config = image_build_config
+        self.build_id = uuid.uuid4().hex
+        log_writer = None
+        if log_store is not None:
+            log_writer = log_store.open_writer(self.build_name, self.build_id)
+        self.output = BuildOutput(
+            max_bytes=max_output_bytes, log_writer=log_writer)
+        self.broadcast = docker.BroadcastConsumer()
+        self.result_tracker = docker.BuildResultConsumer()
+        # Receives the Docker build messages, and our own
+        self.consumer = docker.MultiConsumer([
+            OutputConsumer(self.output),
+            self.broadcast,
+            self.result_tracker,
+        ])
+        # .scheduler.Ticket, for a slot to run in
+        self.ticket = ticket
+        self.status = self.QUEUED
+        # str, set once the mirror has been fetched
+        self.commit_hash = None
+        # str, the reason for the FAILED or ERRORED status
+        self.error = None
+        # str, the ID of the image built (or reused)
+        self.image_id = None
+        # .docker.BuildResult, once the engine is done
+        self.result = None
+        # str phase name -> float seconds spent in it. The phases are
+        # 'fetch' (updating the mirror), 'scan' (checking the context's
+        # tree), 'archive' (producing the context), 'accept' (waiting for
+        # the engine to accept the build) and 'stream' (the build itself).
+        self.phase_seconds = {}
+        # int, bytes of build context sent to the engine
+        self.context_bytes = 0
+        # str, the name of the engine the build was placed on
+        self.engine = None
+        # Wall-clock times as float seconds since the epoch
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._accepted = asyncio.get_event_loop().create_future()
+        self._task = None
+
+    @property
+    def build_name(self):
+        return self.config.build_name
+
+    @property
+    def commit_resolved(self):
+        return self.commit_hash is not None
+
+    @property
+    def done(self):
+        return self._task is not None and self._task.done()
+
+    def emit(self, text):
+        """
+        Add a line of HarborPilot's own to the build's output.
+        """
+        self.consumer.message_received({'stream': text + '\n'})
+
+    async def wait_accepted(self):
+        """
+        Wait until the engine accepts the build, or it's found to be
+        already built. Raises whatever prevented the build from
+        starting, such as :exc:`.docker.BuildNotAccepted`.
+        """
+        await asyncio.shield(self._accepted)
+
+    async def wait_done(self):
+        await asyncio.shield(self._task)
+
+    def describe(self):
+        """
+        Return a JSON-serializable dict describing the build.
+        """
+        return {
+            'build_id': self.build_id,
+            'build_name': self.build_name,
+            'status': self.status,
+            'commit_hash': self.commit_hash,
+            'error': self.error,
+            'image_id': self.image_id,
+            'steps': (
+                [attr.asdict(step) for step in self.result.steps]
+                if self.result is not None else []
+            ),
+            'created_at': _isoformat(self.created_at),
+            'started_at': _isoformat(self.started_at),
+            'finished_at': _isoformat(self.finished_at),
+            'queue_wait_seconds': self.ticket.wait_seconds,
+            'phase_seconds': self.phase_seconds,
+            'context_bytes': self.context_bytes,
+            'engine': self.engine,
+            'log_bytes': len(self.output),
+            'log_start_offset': self.output.start_offset,
+        }
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat()
+
+
+class BuildCoordinator:
+    """
+    Starts builds, coalescing concurrent requests for the same build
+    name and branch into a single build, and running them as the
+    scheduler allows.
+
+    A request arriving while a build is still fetching the mirror
+    attaches to it, since the fetch will include whatever commit the
+    request is about. Once the commit is known, later requests attach
+    to a single queued build which starts when the current one ends,
+    picking up the newest commit.
+
+    Each build runs on the engine ``engine_pool`` (a
+    :class:`.docker.EnginePool`) places it on.
+
+    The most recent ``max_retained`` builds can be looked up by ID.
+    Finished builds are recorded in ``build_history`` (a
+    :class:`.history.BuildHistory`), their output in ``log_store`` (a
+    :class:`.logstore.LogStore`) and their timings in ``build_metrics``
+    (a :class:`.metrics.BuildMetrics`), if given. Contexts are archived
+    through ``context_cache`` (a :class:`.contextcache.ContextCache`),
+    if given.
+
+    With ``shared_state`` (a :class:`.workers.SharedState`), the builds
+    retained here are registered in it, and so is this worker's claim on
+    running builds of a build name and branch, which it gives up once
+    it has none running or queued.
+
+    With ``trace_recorder`` (a :class:`.trace.TraceRecorder`), the
+    engine output of each build is recorded in its trace.
+    """
+    max_retained = 1000
+
+    def __init__(
+            self, engine_pool, mirror_cache, build_index, scheduler, *,
+            max_output_bytes=None, build_history=None, log_store=None,
+            build_metrics=None, context_cache=None, shared_state=None,
+            trace_recorder=None
+        ):
+        self._engine_pool = engine_pool
+        self._shared = shared_state
+        self._trace_recorder = trace_recorder
+        self._history = build_history
+        self._log_store = log_store
+        self._metrics = build_metrics
+        self._context_cache = context_cache
+        self._max_output_bytes = max_output_bytes
+        self._scheduler = scheduler
+        self._mirror_cache = mirror_cache
+        self._build_index = build_index
+        self._current = {}  # (build_name, branch) -> running Build
+        self._next = {}  # (build_name, branch) -> queued Build
+        self._builds = collections.OrderedDict()  # build_id -> Build
+
+    def get(self, build_name, build_id):
+        """
+        Return the retained :class:`Build` of ``build_name`` with ID
+        ``build_id``, or ``None``.
+        """
+        build = self._builds.get(build_id)
+        if build is None or build.build_name != build_name:
+            return None
+        return build
+
+    def submit(self, image_build_config):
+        """
+        Return the :class:`Build` that will satisfy a request to build
+        ``image_build_config``, starting or queueing one if needed.
+
+        Raises :exc:`.scheduler.QueueFull` if a new build is needed but
+        the scheduler has no room for it.
+        """
+        key = (image_build_config.build_name, image_build_config.git.branch)
+        current = self._current.get(key)
+        if current is None:
+            try:
+                build = self._new_build(image_build_config)
+            except BaseException:
+                self._release(key)
+                raise
+            self._start(key, build)
+            return build
+        if not current.commit_resolved:
+            log.debug('Attaching to running build of {0}'.format(key))
+            return current
+        queued = self._next.get(key)
+        if queued is None:
+            log.debug('Queueing next build of {0}'.format(key))
+            queued = self._next[key] = self._new_build(image_build_config)
+        else:
+            log.debug('Attaching to queued build of {0}'.format(key))
+            # It hasn't started, so it can still use a reloaded config.
+            queued.config = image_build_config
+        return queued
+
+    def _new_build(self, image_build_config):
+        ticket = self._scheduler.reserve(image_build_config.build_name)
+        try:
+            build = Build(
+                image_build_config,
+                ticket,
+                max_output_bytes=self._max_output_bytes,
+                log_store=self._log_store,
+            )
+        except BaseException:
+            # Opening its log can fail, which mustn't cost a place
+            ticket.cancel()
+            raise
+        self._builds[build.build_id] = build
+        if self._shared is not None:
+            self._shared.add_build(build.build_id)
+        while len(self._builds) > self.max_retained:
+            oldest_id = next(iter(self._builds))
+            if not self._builds[oldest_id].done:
+                break
+            del self._builds[oldest_id]
+            if self._shared is not None:
+                self._shared.remove_build(oldest_id)
+        return build
+
+    def _start(self, key, build):
+        self._current[key] = build
+        build._task = asyncio.ensure_future(self._run(build))
+        build._task.add_done_callback(lambda task: self._finished(key))
+
+    def _finished(self, key):
+        del self._current[key]
+        queued = self._next.pop(key, None)
+        if queued is not None:
+            self._start(key, queued)
+        else:
+            self._release(key)
+
+    def _release(self, key):
+        if self._shared is not None and key not in self._current:
+            self._shared.release(*key)
+
+    async def _run(self, build):
+        try:
+            async with build.ticket:
+                build.started_at = time.time()
+                build.status = Build.PREPARING
+                await self._run_build(build)
+        except Exception as e:
+            log.exception('Build of {0} failed'.format(build.build_name))
+            build.status = Build.ERRORED
+            build.error = str(e)
+            build.emit('Error: {0}'.format(e))
+            if not build._accepted.done():
+                build._accepted.set_exception(e)
+                # Nobody has to wait for acceptance, so don't complain if
+                # this is never retrieved.
+                build._accepted.exception()
+        finally:
+            if not build._accepted.done():
+                build._accepted.cancel()
+            build.finished_at = time.time()
+            build.output.close()
+            build.broadcast.close()
+            if self._history is not None:
+                self._history.record(history.build_row(build))
+            if self._metrics is not None:
+                self._metrics.build_finished(build)
+
+    async def _run_build(self, build):
+        with self._engine_pool.placed(build.build_name) as engine:
+            build.engine = engine.name
+            await self._run_build_on(engine, build)
+
+    async def _run_build_on(self, engine, build):
+        config = build.config
+        log.debug('Using config {0} on engine {1}'.format(
+            config, engine.name))
+        # Stream the context straight from the Git mirror to Docker
+        async with git.stream_archive(
+                config.git,
+                mirror_cache=self._mirror_cache,
+                timings=build.phase_seconds,
+            ) as archive:
+            build.commit_hash = archive.commit_hash
+            build_key = dedup.BuildKey(
+                build_name=build.build_name,
+                commit_hash=archive.commit_hash,
+                context_relpath=config.git.context_relpath,
+                dockerfile_digest=(
+                    await archive.object_id('Dockerfile') or ''),
+                options_digest=_options_digest(config),
+            )
+            image_id = await self._find_built_image(engine, build_key)
+            if image_id is not None:
+                await self._reuse_image(engine, image_id, build, build_key)
+                build.image_id = image_id
+                build.status = Build.REUSED
+                build._accepted.set_result(None)
+                return
+
+            build_options = await self._build_options(build)
+            log.debug('Sending archive of {0} to Docker'.format(
+                archive.commit_hash))
+            if self._context_cache is not None:
+                chunks = self._context_cache.chunks(build.build_name, archive)
+            else:
+                chunks = archive.chunks()
+            image_build = docker.ImageBuild(
+                engine.session,
+                archive=_timed_chunks(chunks, build),
+                image_name=image_ref(config),
+                labels=build_key.labels(),
+                base_url=engine.base_url,
+                **build_options
+            )
+            with _timed(build, 'accept'):
+                await image_build.start()
+            build.status = Build.BUILDING
+            build._accepted.set_result(None)
+            # Docker may still be reading the context from the mirror,
+            # so keep hold of it until the build is over.
+            await self._follow_build(build, image_build, build_key)
+
+    async def _follow_build(self, build, image_build, build_key):
+        """
+        Pass on the output of the build Docker accepted, then record how
+        it ended.
+        """
+        recording = None
+        if self._trace_recorder is not None:
+            recording = self._trace_recorder.stream(
+                build.build_name, build.build_id)
+            image_build.stream_observer = recording.chunk_received
+        try:
+            with _timed(build, 'stream'):
+                await image_build.dispatch_messages(build.consumer)
+        finally:
+            if recording is not None:
+                recording.close()
+        build.result = result = build.result_tracker.result
+        build.image_id = result.image_id
+        build.error = result.error
+        log.info('Build {0} of {1} at {2}: {3} in {4:.1f}s, image {5}'.format(
+            build.build_id,
+            build.build_name,
+            build.commit_hash,
+            result.status,
+            result.seconds,
+            result.image_id,
+        ))
+        if result.status == docker.BuildResult.SUCCEEDED:
+            self._build_index.record(build_key, result.image_id)
+            build.status = Build.SUCCEEDED
+        elif result.status == docker.BuildResult.FAILED:
+            build.status = Build.FAILED
+        else:
+            build.status = Build.FINISHED
+
+    async def _build_options(self, build):
+        """
+        Return the keyword arguments for :class:`.docker.ImageBuild`
+        that the build's config sets, with the image of the last
+        successful build as a cache source if wanted.
+        """
+        config = build.config
+        buildkit = config.buildkit
+        build_options = config.build_options
+        options = {
+            'buildargs': dict(build_options.buildargs),
+            'target': build_options.target,
+            'pull': build_options.pull,
+            'networkmode': build_options.networkmode,
+            'memory': build_options.memory,
+            'cpushares': build_options.cpushares,
+            'cachefrom': list(build_options.cachefrom),
+            'platform': buildkit.platform,
+        }
+        if buildkit.enabled:
+            options['version'] = '2'
+            if buildkit.inline_cache:
+                options['buildargs']['BUILDKIT_INLINE_CACHE'] = '1'
+        if build_options.cache_from_last_build:
+            image_id = await self._last_good_image(build)
+            if image_id is not None:
+                # BuildKit only takes cache sources by reference, and
+                # uses their inline cache metadata
+                source = image_ref(config) if buildkit.enabled else image_id
+                if source not in options['cachefrom']:
+                    build.emit('Using cache from {0}'.format(source))
+                    options['cachefrom'].append(source)
+        return options
+
+    async def _last_good_image(self, build):
+        """
+        Return the ID of the image of the newest build of the same
+        name that produced one, from the retained builds or else the
+        history, or ``None``.
+        """
+        for other in reversed(self._builds.values()):
+            if (other is not build
+                    and other.build_name == build.build_name
+                    and other.status in (Build.SUCCEEDED, Build.REUSED)
+                    and other.image_id is not None):
+                return other.image_id
+        if self._history is None:
+            return None
+        return await self._history.last_image(build.build_name)
+
+    async def _find_built_image(self, engine, build_key):
+        """
+        Return the ID of an image already built from ``build_key`` on
+        ``engine``, or ``None``. The local index is checked first, then
+        the engine is asked for images labelled with the key.
+        """
+        image_id = self._build_index.lookup(build_key)
+        if image_id is not None:
+            image = await docker.inspect_image(
+                engine.session, image_id, base_url=engine.base_url)
+            if image is not None:
+                return image_id
+            log.info('Indexed image {0} is gone'.format(image_id))
+            self._build_index.forget(build_key)
+
+        images = await docker.find_images(
+            engine.session, build_key.labels(), base_url=engine.base_url)
+        if not images:
+            return None
+        image_id = images[0]['Id']
+        self._build_index.record(build_key, image_id)
+        return image_id
+
+    async def _reuse_image(self, engine, image_id, build, build_key):
+        # The tag may have moved on to another commit since, point it back.
+        await docker.tag_image(
+            engine.session,
+            image_id,
+            build.config.image_name,
+            build.config.image_tag,
+            base_url=engine.base_url,
+        )
+        log.info('Reusing image {0} for {1}'.format(image_id, build_key))
+        build.emit((
+            'Image {image_id} is already built from commit {commit_hash}, '
+            'tagged {image_ref}'
+        ).format(
+            image_id=image_id,
+            commit_hash=build_key.commit_hash,
+            image_ref=image_ref(build.config),
+        ))
+
+
+@contextlib.contextmanager
+def _timed(build, phase):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        build.phase_seconds[phase] = time.monotonic() - started
+
+
+async def _timed_chunks(chunks, build):
+    """
+    Pass on the archive ``chunks``, timing how long it takes to produce
+    them as the 'archive' phase and counting their bytes.
+    """
+    started = time.monotonic()
+    async for chunk in chunks:
+        build.context_bytes += len(chunk)
+        yield chunk
+    build.phase_seconds['archive'] = time.monotonic() - started
+
+
+def _options_digest(image_build_config):
+    """
+    Return a digest of the options in ``image_build_config`` that change
+    the image built from a context, or '' if none are set.
+    """
+    options = {
+        'buildargs': image_build_config.build_options.buildargs,
+        'target': image_build_config.build_options.target,
+        'platform': image_build_config.buildkit.platform,
+    }
+    if not any(options.values()):
+        return ''
+    encoded = json.dumps(options, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def image_ref(image_build_config):
+    return '{0}:{1}'.format(
+        image_build_config.image_name, image_build_config.image_tag)
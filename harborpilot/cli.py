@@ -1,26 +1,204 @@
+import os
 import sys
+import time
+import signal
 import asyncio
-import pathlib
 import logging
+import argparse
 
-import aiohttp.web as aweb
-
-from harborpilot import docker
-from harborpilot import config
-from harborpilot import application
+from harborpilot import configfiles
 
 
 log = logging.getLogger(__name__)
 
 
-def serve(config_path):
-    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-    with open(config_path, 'r') as conffile:
-        cfg = config.from_yaml_file(conffile)
+# Seconds to wait before restarting a worker that exited
+WORKER_RESTART_DELAY = 1.0
+
+
+def serve(config_path, *, worker_count=1):
+    """
+    Serve the config at ``config_path``, in this process or, with a
+    ``worker_count`` over 1, in that many worker processes.
+    """
+    if worker_count > 1:
+        log_format = '%(levelname)s:%(process)d:%(name)s:%(message)s'
+    else:
+        log_format = logging.BASIC_FORMAT
+    logging.basicConfig(
+        stream=sys.stderr, level=logging.DEBUG, format=log_format)
+    cfg = configfiles.load(config_path)
+    if worker_count > 1:
+        serve_workers(cfg, worker_count, config_path=config_path)
+        return
+    # Imported only now, so --help and bad configs don't wait for aiohttp
+    # and the rest.
+    import aiohttp.web as aweb
+    from harborpilot import application
     loop = asyncio.get_event_loop()
-    app = loop.run_until_complete(application.build_app(cfg))
-    aweb.run_app(app, host=cfg.address, port=cfg.port)
+    app = loop.run_until_complete(
+        application.build_app(cfg, config_path=config_path))
+    # On the loop the app was built on, which its sessions belong to
+    aweb.run_app(app, host=cfg.address, port=cfg.port, loop=loop)
+
+
+def serve_workers(cfg, worker_count, *, config_path=None):
+    """
+    Run ``worker_count`` worker processes serving ``cfg`` on the same
+    port, restarting any that exit, until SIGINT or SIGTERM. SIGHUP is
+    passed on to the workers, which reload ``config_path`` if given;
+    workers restarted later start with its builds as they are then.
+
+    This process only supervises: it never starts an event loop, so the
+    workers are forked without one.
+    """
+    from harborpilot import workers
+    # Imported before forking, so the workers share the loaded modules
+    # rather than each importing them again.
+    from harborpilot import application  # noqa: F401
+    shared_state_path = workers.shared_state_path(cfg.state_dir)
+    shared_state = workers.SharedState(shared_state_path, None)
+    shared_state.reset()
+    shared_state.close()
+    children = {}  # pid -> worker number
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def start(index, *, restart=False):
+        nonlocal cfg
+        if restart and config_path is not None:
+            # The other workers have been reloading it all along.
+            cfg = _reloaded_config(cfg, config_path)
+        children[_start_worker(cfg, index, worker_count, config_path)] = (
+            index)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, reload)
+    for index in range(worker_count):
+        start(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        # Builds it was running, or holding a place for, are gone.
+        shared_state = workers.SharedState(shared_state_path, index)
+        shared_state.clear_worker()
+        shared_state.close()
+        if stopping:
+            continue
+        log.warning('Worker {0} (pid {1}) exited with status {2}'.format(
+            index, pid, status))
+        time.sleep(WORKER_RESTART_DELAY)
+        if not stopping:
+            start(index, restart=True)
+
+
+def _reloaded_config(cfg, config_path):
+    """
+    Return ``cfg`` with the builds now in the file at ``config_path``,
+    as a running worker reloading it would have them, or just ``cfg`` if
+    it doesn't load.
+    """
+    import attr
+    import yaml
+    import marshmallow as mm
+    try:
+        new = configfiles.load(config_path)
+    except (OSError, yaml.YAMLError, mm.ValidationError) as e:
+        log.error('Keeping the last config, {0} is bad: {1}'.format(
+            config_path, e))
+        return cfg
+    return attr.evolve(cfg, builds=new.builds, builds_dir=new.builds_dir)
+
+
+def _start_worker(cfg, index, worker_count, config_path):
+    pid = os.fork()
+    if pid:
+        log.info('Started worker {0} (pid {1})'.format(index, pid))
+        return pid
+    status = 1
+    try:
+        _run_worker(cfg, index, worker_count, config_path)
+        status = 0
+    except BaseException:
+        log.exception('Worker {0} failed'.format(index))
+    finally:
+        logging.shutdown()
+        os._exit(status)
+
+
+def _run_worker(cfg, index, worker_count, config_path):
+    import aiohttp.web as aweb
+    from harborpilot import workers
+    from harborpilot import application
+    # A terminal's Ctrl-C reaches the whole process group; the
+    # supervisor passes it on as SIGTERM, which is enough.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Until the config reloader handles it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, _stop_worker, loop)
+    worker = workers.Worker(cfg.state_dir, index, worker_count)
+    socket_path = worker.socket_path()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        # Left behind by the worker's previous process
+        socket_path.unlink()
+    except FileNotFoundError:
+        pass
+    app = loop.run_until_complete(application.build_app(
+        cfg, worker=worker, config_path=config_path))
+    aweb.run_app(
+        app,
+        host=cfg.address,
+        port=cfg.port,
+        path=str(socket_path),
+        reuse_port=True,
+        print=None,
+        handle_signals=False,
+        loop=loop,
+    )
+
+
+def _stop_worker(loop):
+    # Only once, so a second SIGTERM doesn't cut the shutdown short
+    import aiohttp.web as aweb
+    loop.remove_signal_handler(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise aweb.GracefulExit()
 
 
 def main():
-    serve('harborpilot.conf')
+    parser = argparse.ArgumentParser(
+        description='A middleman for building Docker images')
+    parser.add_argument(
+        '--config', default='harborpilot.conf',
+        help='Configuration file (default: %(default)s)')
+    parser.add_argument(
+        '--workers', type=int, default=1, metavar='N',
+        help='Worker processes to serve with (default: %(default)s)')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    serve(args.config, worker_count=args.workers)
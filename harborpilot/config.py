@@ -10,12 +10,60 @@ import marshmallow.fields as mmf
 import marshmallow.validate as mmv
 
 
+# LibYAML's loader is several times faster, where PyYAML was built with it
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml(stream):
+    """
+    Return the structure in the YAML ``stream`` (a file, str or bytes),
+    which may only use the safe subset of YAML.
+    """
+    return yaml.load(stream, Loader=_YAML_LOADER)
+
+
 def from_yaml_file(fileobj):
-    structure = yaml.safe_load(fileobj)
+    """
+    Return the config in the YAML file ``fileobj``.
+
+    The builds in a ``builds_dir`` aren't loaded, see
+    :func:`.configfiles.load` for that.
+    """
+    structure = load_yaml(fileobj)
     schema = HarborPilotConfigSchema()
     return schema.load(structure)
 
 
+def load_builds(structure):
+    """
+    Return the dict of build name -> :class:`ImageBuildConfig` in
+    ``structure``, a mapping like the ``builds`` of the whole config.
+
+    Raises :class:`marshmallow.ValidationError` with the messages of all
+    the builds that aren't valid.
+    """
+    if not isinstance(structure, dict):
+        raise mm.ValidationError(
+            'Must be a mapping of build names to builds.')
+    schema = ImageBuildConfigSchema()
+    builds = {}
+    errors = {}
+    for build_name, build_structure in structure.items():
+        if not isinstance(build_name, str):
+            errors[build_name] = ['Build names must be strings.']
+            continue
+        try:
+            image_build_obj = schema.load(build_structure)
+        except mm.ValidationError as e:
+            errors[build_name] = e.messages
+            continue
+        builds[build_name] = attr.evolve(
+            image_build_obj, build_name=build_name)
+    if errors:
+        raise mm.ValidationError(errors)
+    return builds
+
+
 @attr.s
 class HarborPilotConfig:
     # str, listening address
@@ -24,6 +72,57 @@ class HarborPilotConfig:
     port = attr.ib()
     # dict of build_name str -> ImageBuildConfig
     builds = attr.ib()
+    # str, directory for persistent state (mirrors, logs, etc)
+    state_dir = attr.ib()
+    # GitCacheConfig
+    git_cache = attr.ib()
+    # SchedulerConfig
+    scheduler = attr.ib()
+    # LogsConfig
+    logs = attr.ib()
+    # ContextCacheConfig
+    context_cache = attr.ib()
+    # EnginesConfig
+    engines = attr.ib()
+    # TraceConfig
+    trace = attr.ib()
+    # str, directory of more build files, or None
+    builds_dir = attr.ib(default=None)
+
+
+@attr.s
+class BuildKitConfig:
+    # bool, whether to build with BuildKit rather than the classic builder
+    enabled = attr.ib(default=False)
+    # bool, whether to embed cache metadata in the image, so later builds
+    # elsewhere can use it as a cache source
+    inline_cache = attr.ib(default=False)
+    # str, the platform to build for, like linux/arm64, or None for the
+    # engine's own
+    platform = attr.ib(default=None)
+
+
+@attr.s
+class BuildOptionsConfig:
+    # dict of str -> str, build-time variables for ARG instructions
+    buildargs = attr.ib(default=attr.Factory(dict))
+    # str, the build stage to stop at, or None for the last one
+    target = attr.ib(default=None)
+    # bool, whether to pull newer versions of the base images
+    pull = attr.ib(default=False)
+    # str, the network mode for RUN instructions, or None for the
+    # engine's default
+    networkmode = attr.ib(default=None)
+    # int, bytes of memory each build container may use, or None for no
+    # limit
+    memory = attr.ib(default=None)
+    # int, relative CPU weight of the build containers, or None
+    cpushares = attr.ib(default=None)
+    # list of str, images to use as cache sources
+    cachefrom = attr.ib(default=attr.Factory(list))
+    # bool, whether to also use the image of the build name's last
+    # successful build as a cache source
+    cache_from_last_build = attr.ib(default=True)
 
 
 @attr.s
@@ -36,6 +135,16 @@ class ImageBuildConfig:
     image_tag = attr.ib()
     # GitDockerBuildContextConfig
     git = attr.ib()
+    # BuildKitConfig
+    buildkit = attr.ib(default=attr.Factory(BuildKitConfig))
+    # BuildOptionsConfig
+    build_options = attr.ib(default=attr.Factory(BuildOptionsConfig))
+
+
+# Values of GitDockerBuildContextConfig.symlinks: fail on any symlink in
+# the context, or archive those whose target is inside the context.
+SYMLINKS_REJECT = 'reject'
+SYMLINKS_INTERNAL = 'internal'
 
 
 @attr.s
@@ -43,9 +152,94 @@ class GitDockerBuildContextConfig:
     remote = attr.ib()
     branch = attr.ib()
     context_relpath = attr.ib()
+    # str, SYMLINKS_REJECT or SYMLINKS_INTERNAL
+    symlinks = attr.ib(default=SYMLINKS_REJECT)
+
+
+@attr.s
+class GitCacheConfig:
+    # int, total size in bytes of the mirrors to keep before evicting the
+    # least recently used ones
+    max_bytes = attr.ib()
+    # bool, whether to fetch file contents only for the build context
+    partial_clone = attr.ib()
+
+
+@attr.s
+class SchedulerConfig:
+    # int, builds allowed to run at once
+    max_concurrent_builds = attr.ib()
+    # int, builds allowed to run at once for any one build_name
+    max_concurrent_per_build = attr.ib()
+    # int, builds allowed to wait for a slot before refusing requests
+    max_queued_builds = attr.ib()
+
+
+@attr.s
+class LogsConfig:
+    # int, bytes of each build's most recent output to keep in memory
+    max_memory_bytes = attr.ib()
+    # int, total size in bytes of the stored logs to keep before removing
+    # the oldest
+    max_disk_bytes = attr.ib()
+    # int, days to keep stored logs for
+    max_age_days = attr.ib()
+
+
+@attr.s
+class ContextCacheConfig:
+    # bool, whether to keep each build's last context to archive the next
+    # commit's from
+    enabled = attr.ib()
+    # int, total size in bytes of the cached contexts to keep before
+    # evicting the least recently used ones
+    max_bytes = attr.ib()
+
+
+# Values of EnginesConfig.placement: the engine with the fewest running
+# builds, or the one the build name hashes to.
+PLACEMENT_LEAST_LOADED = 'least_loaded'
+PLACEMENT_CONSISTENT_HASH = 'consistent_hash'
+
+
+@attr.s
+class EngineConfig:
+    # str, unix:///path/to/socket, or tcp://host:port or http://host:port
+    url = attr.ib()
+    # int, connections to the engine to allow at once
+    max_connections = attr.ib()
+    # float, seconds to keep an idle connection open for reuse
+    keepalive_timeout = attr.ib()
+
+
+@attr.s
+class EnginesConfig:
+    # str, PLACEMENT_LEAST_LOADED or PLACEMENT_CONSISTENT_HASH
+    placement = attr.ib()
+    # float, seconds between health checks of each engine
+    health_check_interval = attr.ib()
+    # list of EngineConfig
+    endpoints = attr.ib()
+
+
+@attr.s
+class TraceConfig:
+    # bool, whether to record build requests and engine output to a trace
+    # file in the state directory
+    enabled = attr.ib()
+    # int, bytes of each build's engine output to record
+    max_stream_bytes = attr.ib()
 
 
 # Schemas
+def _section_defaults(schema_class):
+    """
+    Return a callable for a nested section's ``missing`` argument that
+    produces the section's fully defaulted instance.
+    """
+    return lambda: schema_class().load({})
+
+
 class _RelativePosixPath(mmf.String):
     default_error_messages = mmf.String.default_error_messages.copy()
     default_error_messages.update({
@@ -67,12 +261,61 @@ class GitDockerBuildContextConfigSchema(mm.Schema):
     remote = mmf.String(required=True)  # TODO: Add validation
     branch = mmf.String(missing='master')  # TODO: Add validation
     context_relpath = _RelativePosixPath(missing=pathlib.PurePosixPath('.'))
+    symlinks = mmf.String(
+        validate=mmv.OneOf([SYMLINKS_REJECT, SYMLINKS_INTERNAL]),
+        missing=SYMLINKS_REJECT,
+    )
 
     @mm.post_load
     def convert_to_instance(self, data):
         return GitDockerBuildContextConfig(**data)
 
 
+class BuildKitConfigSchema(mm.Schema):
+    enabled = mmf.Boolean(missing=False)
+    inline_cache = mmf.Boolean(missing=False)
+    platform = mmf.String(
+        validate=mmv.Regexp(
+            r'^[a-z0-9_]+/[a-z0-9_]+(/[a-z0-9_]+)?$',
+            error='Platform must be OS/ARCH or OS/ARCH/VARIANT.',
+        ),
+        missing=None,
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return BuildKitConfig(**data)
+
+
+class BuildOptionsConfigSchema(mm.Schema):
+    buildargs = mmf.Dict(
+        keys=mmf.String(validate=mmv.Regexp(
+            r'^[A-Za-z_][A-Za-z0-9_]*$',
+            error='Build arg names must be valid variable names.',
+        )),
+        values=mmf.String(),
+        missing=dict,
+    )
+    target = mmf.String(validate=mmv.Length(min=1), missing=None)
+    pull = mmf.Boolean(missing=False)
+    networkmode = mmf.String(validate=mmv.Length(min=1), missing=None)
+    # The engine's minimum is 6 MiB
+    memory = mmf.Integer(
+        validate=mmv.Range(min=6 * 1024 ** 2),
+        missing=None,
+    )
+    cpushares = mmf.Integer(validate=mmv.Range(min=2), missing=None)
+    cachefrom = mmf.List(
+        mmf.String(validate=mmv.Length(min=1)),
+        missing=list,
+    )
+    cache_from_last_build = mmf.Boolean(missing=True)
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return BuildOptionsConfig(**data)
+
+
 class ImageBuildConfigSchema(mm.Schema):
     """
     Does not include build_name, this is added from the key.
@@ -80,6 +323,14 @@ class ImageBuildConfigSchema(mm.Schema):
     image_name = mmf.String(required=True)  # TODO: Add validation
     image_tag = mmf.String(missing='latest')  # TODO: Add validation
     git = mmf.Nested(GitDockerBuildContextConfigSchema, required=True)
+    buildkit = mmf.Nested(
+        BuildKitConfigSchema,
+        missing=_section_defaults(BuildKitConfigSchema),
+    )
+    build_options = mmf.Nested(
+        BuildOptionsConfigSchema,
+        missing=_section_defaults(BuildOptionsConfigSchema),
+    )
 
     @mm.post_load
     def convert_to_instance(self, data):
@@ -87,24 +338,171 @@ class ImageBuildConfigSchema(mm.Schema):
         return ImageBuildConfig(build_name=None, **data)
 
 
+class GitCacheConfigSchema(mm.Schema):
+    max_bytes = mmf.Integer(
+        validate=mmv.Range(min=0),
+        missing=10 * 1024 ** 3,
+    )
+    partial_clone = mmf.Boolean(missing=True)
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return GitCacheConfig(**data)
+
+
+class SchedulerConfigSchema(mm.Schema):
+    max_concurrent_builds = mmf.Integer(
+        validate=mmv.Range(min=1),
+        missing=4,
+    )
+    max_concurrent_per_build = mmf.Integer(
+        validate=mmv.Range(min=1),
+        missing=1,
+    )
+    max_queued_builds = mmf.Integer(
+        validate=mmv.Range(min=0),
+        missing=100,
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return SchedulerConfig(**data)
+
+
+class LogsConfigSchema(mm.Schema):
+    max_memory_bytes = mmf.Integer(
+        validate=mmv.Range(min=1024),
+        missing=4 * 1024 ** 2,
+    )
+    max_disk_bytes = mmf.Integer(
+        validate=mmv.Range(min=1024 ** 2),
+        missing=1024 ** 3,
+    )
+    max_age_days = mmf.Integer(
+        validate=mmv.Range(min=1),
+        missing=30,
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return LogsConfig(**data)
+
+
+class ContextCacheConfigSchema(mm.Schema):
+    enabled = mmf.Boolean(missing=True)
+    max_bytes = mmf.Integer(
+        validate=mmv.Range(min=0),
+        missing=10 * 1024 ** 3,
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return ContextCacheConfig(**data)
+
+
+class EngineConfigSchema(mm.Schema):
+    url = mmf.String(
+        validate=mmv.Regexp(
+            r'^(unix://.+|(tcp|http)://[^/]+/?)$',
+            error='Engine URL must be unix://PATH, tcp://HOST:PORT or '
+                  'http://HOST:PORT.',
+        ),
+        missing='unix:///var/run/docker.sock',
+    )
+    max_connections = mmf.Integer(
+        validate=mmv.Range(min=1),
+        missing=100,
+    )
+    keepalive_timeout = mmf.Float(
+        validate=mmv.Range(min=0),
+        missing=15.0,
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return EngineConfig(**data)
+
+
+class EnginesConfigSchema(mm.Schema):
+    placement = mmf.String(
+        validate=mmv.OneOf(
+            [PLACEMENT_LEAST_LOADED, PLACEMENT_CONSISTENT_HASH]),
+        missing=PLACEMENT_LEAST_LOADED,
+    )
+    health_check_interval = mmf.Float(
+        validate=mmv.Range(min=0.1),
+        missing=10.0,
+    )
+    endpoints = mmf.Nested(
+        EngineConfigSchema,
+        many=True,
+        validate=mmv.Length(min=1, error='At least one engine is required.'),
+        missing=lambda: [EngineConfigSchema().load({})],
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return EnginesConfig(**data)
+
+
+class TraceConfigSchema(mm.Schema):
+    enabled = mmf.Boolean(missing=False)
+    max_stream_bytes = mmf.Integer(
+        validate=mmv.Range(min=0),
+        missing=1024 ** 2,
+    )
+
+    @mm.post_load
+    def convert_to_instance(self, data):
+        return TraceConfig(**data)
+
+
 class HarborPilotConfigSchema(mm.Schema):
     address = mmf.String(missing='127.0.0.1')
     port = mmf.Integer(
         validate=mmv.Range(min=0, max=0xFFFF),
         missing=18080,
     )
+    state_dir = mmf.String(missing='harborpilot-state')
+    git_cache = mmf.Nested(
+        GitCacheConfigSchema,
+        missing=_section_defaults(GitCacheConfigSchema),
+    )
+    scheduler = mmf.Nested(
+        SchedulerConfigSchema,
+        missing=_section_defaults(SchedulerConfigSchema),
+    )
+    logs = mmf.Nested(
+        LogsConfigSchema,
+        missing=_section_defaults(LogsConfigSchema),
+    )
+    context_cache = mmf.Nested(
+        ContextCacheConfigSchema,
+        missing=_section_defaults(ContextCacheConfigSchema),
+    )
+    engines = mmf.Nested(
+        EnginesConfigSchema,
+        missing=_section_defaults(EnginesConfigSchema),
+    )
+    trace = mmf.Nested(
+        TraceConfigSchema,
+        missing=_section_defaults(TraceConfigSchema),
+    )
     builds = mmf.Dict(
         keys=mmf.String(),  # TODO: Add validation for proper build_name name
         values=mmf.Nested(ImageBuildConfigSchema),
         required=True,
         validate=mmv.Length(min=1, error='At least one build is required.'),
     )
+    # Relative to the config file's directory. Loaded with the builds
+    # partial, as the builds may all be in there.
+    builds_dir = mmf.String(missing=None)
 
     @mm.post_load
     def convert_to_instance(self, data):
         data['builds'] = {
             build_name: attr.evolve(image_build_obj, build_name=build_name)
             for build_name, image_build_obj
-            in data['builds'].items()
+            in data.get('builds', {}).items()
         }
         return HarborPilotConfig(**data)
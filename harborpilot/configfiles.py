@@ -0,0 +1,254 @@
+"""
+Loading the configuration from its files: the main one, and the
+directory of build files it may name as its ``builds_dir``.
+
+Each file in the builds directory with a ``.yaml`` or ``.yml`` suffix
+is a mapping of build names to builds, just like the ``builds`` of the
+main file. With thousands of builds, parsing and validating them all
+takes a while, so the validated builds are kept in a cache in the state
+directory. A file is only read again when its size or modification time
+changed, and only validated again when its contents did too. Files that
+have to be validated are spread over several processes when there's
+enough of them to be worth starting those.
+"""
+import os
+import pickle
+import hashlib
+import logging
+import pathlib
+import multiprocessing
+import concurrent.futures
+
+import attr
+import yaml
+import marshmallow as mm
+
+from harborpilot import config
+
+
+log = logging.getLogger(__name__)
+
+
+# In the state directory
+CACHE_FILE = 'builds-cache.pickle'
+
+BUILD_FILE_SUFFIXES = ('.yaml', '.yml')
+
+# Bytes of build files to validate before processes are started for it
+PARALLEL_MIN_BYTES = 256 * 1024
+
+
+def load(path):
+    """
+    Return the :class:`.config.HarborPilotConfig` in the file at
+    ``path``, with the builds in its ``builds_dir``, if it names one.
+
+    Raises :class:`OSError`, :class:`yaml.YAMLError` or
+    :class:`marshmallow.ValidationError` if a file can't be read or
+    isn't valid.
+    """
+    path = pathlib.Path(path)
+    with path.open('rb') as conffile:
+        structure = config.load_yaml(conffile)
+    if not isinstance(structure, dict) or not structure.get('builds_dir'):
+        return config.HarborPilotConfigSchema().load(structure)
+    if structure.get('builds') == {}:
+        # The builds may all be in the directory.
+        structure = dict(structure)
+        del structure['builds']
+    cfg = config.HarborPilotConfigSchema(partial=('builds',)).load(structure)
+    builds_dir = path.parent / cfg.builds_dir
+    cache_path = pathlib.Path(cfg.state_dir) / CACHE_FILE
+    builds = dict(cfg.builds)
+    sources = dict.fromkeys(builds, path.name)
+    errors = {}
+    for file_name, file_builds in _load_builds_dir(builds_dir, cache_path):
+        for build_name, image_build_obj in file_builds.items():
+            if build_name in sources:
+                errors.setdefault(file_name, {})[build_name] = [
+                    'Also in {0}.'.format(sources[build_name])]
+                continue
+            builds[build_name] = image_build_obj
+            sources[build_name] = file_name
+    if errors:
+        raise mm.ValidationError({'builds_dir': errors})
+    if not builds:
+        raise mm.ValidationError(
+            {'builds': ['At least one build is required.']})
+    return attr.evolve(cfg, builds=builds, builds_dir=str(builds_dir))
+
+
+def file_states(path, builds_dir=None):
+    """
+    Return something that changes whenever the config file at ``path``,
+    or a build file in ``builds_dir`` (if not ``None``), does.
+    """
+    states = [_file_state(path)]
+    if builds_dir is not None:
+        try:
+            entries = sorted(
+                os.scandir(str(builds_dir)), key=lambda entry: entry.name)
+        except OSError:
+            entries = []
+        states.extend(
+            (entry.name, _file_state(entry.path)) for entry in entries
+            if _is_build_file(entry.name)
+        )
+    return tuple(states)
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(str(path))
+    except OSError:
+        return None
+    # Editors often replace the file rather than write to it.
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _is_build_file(name):
+    return name.endswith(BUILD_FILE_SUFFIXES) and not name.startswith('.')
+
+
+@attr.s(slots=True)
+class _CacheEntry:
+    size = attr.ib()
+    mtime_ns = attr.ib()
+    # str, sha256 of the contents
+    digest = attr.ib()
+    # dict of build name -> ImageBuildConfig, or None if not loaded
+    builds = attr.ib(default=None)
+    # str or the messages of a ValidationError, if the file isn't valid
+    error = attr.ib(default=None)
+
+
+def _load_builds_dir(builds_dir, cache_path):
+    """
+    Return a list of (file name, dict of build name -> ImageBuildConfig)
+    for the build files in ``builds_dir``, in order of name.
+    """
+    paths = sorted(
+        path for path in builds_dir.iterdir() if _is_build_file(path.name))
+    cached = _read_cache(cache_path, builds_dir)
+    entries = {}
+    stale = []
+    for path in paths:
+        stat = path.stat()
+        entry = cached.get(path.name)
+        if (entry is not None and entry.size == stat.st_size
+                and entry.mtime_ns == stat.st_mtime_ns):
+            entries[path.name] = entry
+        else:
+            stale.append((path, stat.st_size))
+    validated = 0
+    for path, entry in _load_build_files(stale, cached):
+        if entry.builds is None and entry.error is None:
+            # Only touched, the cached builds still hold.
+            entry.builds = cached[path.name].builds
+        elif entry.error is None:
+            validated += 1
+        entries[path.name] = entry
+    errors = {
+        name: entry.error for name, entry in entries.items()
+        if entry.error is not None
+    }
+    if errors:
+        raise mm.ValidationError({'builds_dir': errors})
+    if stale or set(cached) != set(entries):
+        _write_cache(cache_path, builds_dir, entries)
+    log.debug('Loaded {0} build files from {1}, validated {2}'.format(
+        len(entries), builds_dir, validated))
+    return [(path.name, entries[path.name].builds) for path in paths]
+
+
+def _load_build_files(stale, cached):
+    """
+    Yield (path, _CacheEntry) for each (path, size) in ``stale``.
+    """
+    paths = [path for path, size in stale]
+    digests = [
+        cached[path.name].digest if path.name in cached else None
+        for path in paths
+    ]
+    stale_bytes = sum(size for path, size in stale)
+    cpus = os.cpu_count() or 1
+    if len(paths) < 2 or cpus < 2 or stale_bytes < PARALLEL_MIN_BYTES:
+        yield from zip(paths, map(_load_build_file, paths, digests))
+        return
+    # Not forked: this may well be a thread of a process with an event
+    # loop and other threads.
+    context = multiprocessing.get_context('spawn')
+    max_workers = min(cpus, len(paths))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=context) as executor:
+        entries = executor.map(
+            _load_build_file, paths, digests,
+            chunksize=max(1, len(paths) // (max_workers * 4)),
+        )
+        yield from zip(paths, entries)
+
+
+def _load_build_file(path, known_digest):
+    """
+    Return a :class:`_CacheEntry` for the build file at ``path``, with
+    the builds left out if its digest is still ``known_digest``.
+    """
+    with path.open('rb') as build_file:
+        stat = os.fstat(build_file.fileno())
+        data = build_file.read()
+    entry = _CacheEntry(
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        digest=hashlib.sha256(data).hexdigest(),
+    )
+    if entry.digest == known_digest:
+        return entry
+    try:
+        entry.builds = config.load_builds(config.load_yaml(data))
+    except mm.ValidationError as e:
+        entry.error = e.messages
+    except yaml.YAMLError as e:
+        entry.error = [str(e)]
+    return entry
+
+
+def _cache_version():
+    # Anything cached by another version of the schemas is stale.
+    with open(config.__file__, 'rb') as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+def _read_cache(cache_path, builds_dir):
+    try:
+        with cache_path.open('rb') as cache_file:
+            cache = pickle.load(cache_file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning('Ignoring the unreadable {0}: {1}'.format(cache_path, e))
+        return {}
+    if (cache.get('version') != _cache_version()
+            or cache.get('builds_dir') != str(builds_dir.resolve())):
+        return {}
+    return cache['files']
+
+
+def _write_cache(cache_path, builds_dir, entries):
+    cache = {
+        'version': _cache_version(),
+        'builds_dir': str(builds_dir.resolve()),
+        'files': {
+            name: entry for name, entry in entries.items()
+            if entry.error is None
+        },
+    }
+    # Other workers may be reading it, or writing it too.
+    temp_path = cache_path.with_name(
+        '{0}.{1}.tmp'.format(cache_path.name, os.getpid()))
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with temp_path.open('wb') as temp_file:
+            pickle.dump(cache, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(temp_path), str(cache_path))
+    except OSError as e:
+        log.warning('Could not write {0}: {1}'.format(cache_path, e))
@@ -0,0 +1,407 @@
+"""
+Build contexts kept on disk between builds, so archiving a new commit
+only reads the files that changed from Git.
+
+Each key (a build name) has a directory holding the tar of the last
+context archived for it and ``manifest.json``, which records where in
+that tar each file's contents are, by Git blob ID. When the next commit
+is archived, a file whose blob is in the manifest is copied from the old
+tar with ``copy_file_range``, and only new blobs are read out of Git.
+The new tar is sent on as it's written, so the engine doesn't wait for
+all of it.
+"""
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import logging
+import pathlib
+import tarfile
+import tempfile
+import subprocess
+import collections
+
+from harborpilot import git
+from harborpilot import filelock
+
+
+log = logging.getLogger(__name__)
+
+
+_MANIFEST = 'manifest.json'
+
+
+class ContextCache:
+    """
+    A directory of the last build context archived for each key, with
+    the least recently used removed once they take up more than
+    ``max_bytes``. A lock file next to each context's directory keeps
+    other HarborPilot processes sharing ``root`` from updating or
+    removing it at the same time.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, root, *, max_bytes=None):
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        # Directory name -> lock held while it's updated or removed
+        self._locks = collections.defaultdict(asyncio.Lock)
+
+    def directory(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self.root / digest[:32]
+
+    def _lock(self, name):
+        return filelock.FileLock(self.root / (name + '.lock'))
+
+    async def chunks(self, key, archive):
+        """
+        Asynchronously iterate over the tar data of the
+        :class:`.git.StreamedArchive` ``archive``, updating the cached
+        context of ``key`` to it as it goes.
+        """
+        if archive.entries is None:
+            await archive.check_tree()
+        loop = asyncio.get_event_loop()
+        opened = loop.create_future()
+        written = asyncio.Event()
+        preparing = asyncio.ensure_future(
+            self._prepare(key, archive, opened, written))
+        preparing.add_done_callback(lambda future: written.set())
+        tar_file = None
+        try:
+            tar_file = await opened
+            while True:
+                written.clear()
+                chunk = await loop.run_in_executor(
+                    None, tar_file.read, self.chunk_size)
+                if chunk:
+                    yield chunk
+                elif preparing.done():
+                    # All written, and read up to the end since
+                    preparing.result()
+                    break
+                else:
+                    await written.wait()
+        finally:
+            if tar_file is not None:
+                tar_file.close()
+            if not preparing.done():
+                # Left to finish updating the cache, as the build stopped
+                # reading early.
+                preparing.add_done_callback(_log_failure)
+            elif not preparing.cancelled():
+                # Raised here already, if it failed
+                preparing.exception()
+
+    async def _prepare(self, key, archive, opened, written):
+        """
+        Set the future ``opened`` to the cached tar of ``key``, open for
+        reading, first starting to update it to ``archive`` if needed.
+        While it's being written, the event ``written`` is set whenever
+        more of it is.
+        """
+        loop = asyncio.get_event_loop()
+        directory = self.directory(key)
+        try:
+            async with self._locks[directory.name], (
+                    self._lock(directory.name)):
+                manifest = await loop.run_in_executor(
+                    None, _load_manifest, directory)
+                if manifest is not None and (
+                        manifest['tree_ish'] == archive.tree_ish):
+                    # Still readable if a later update replaces it
+                    opened.set_result(
+                        (directory / manifest['tar']).open('rb'))
+                    return
+                await self._update(key, archive, manifest, opened, written)
+        except BaseException as e:
+            if not opened.done():
+                opened.set_exception(e)
+            raise
+        await self._evict(directory.name)
+
+    async def _update(self, key, archive, previous, opened, written):
+        reused = previous['blobs'] if previous is not None else {}
+        links = previous['links'] if previous is not None else {}
+        await archive.prefetch([
+            object_id
+            for mode, object_type, object_id, path in archive.entries
+            if object_type == 'blob'
+            and object_id not in reused and object_id not in links
+        ])
+        mtime = await archive.commit_time()
+        loop = asyncio.get_event_loop()
+        directory = self.directory(key)
+        fd, tar_path, tar_file = await loop.run_in_executor(
+            None, _create_tar, directory)
+        opened.set_result(tar_file)
+        try:
+            manifest, read_count = await loop.run_in_executor(
+                None, _regenerate, directory, key, archive, mtime,
+                previous, fd, tar_path,
+                lambda: loop.call_soon_threadsafe(written.set),
+            )
+        except git.ArchiveFailed as e:
+            e.config = archive.config
+            raise e
+        log.debug(
+            'Cached context of {0} at {1}: {2} files read from Git, '
+            '{3} reused'.format(
+                key, archive.commit_hash, read_count,
+                len(manifest['blobs']) - read_count,
+            ))
+        return manifest
+
+    async def _evict(self, current):
+        if self.max_bytes is None:
+            return
+        loop = asyncio.get_event_loop()
+        usage = await loop.run_in_executor(None, _measure_contexts, self.root)
+        total = sum(size for mtime, size, name in usage)
+        for mtime, size, name in usage:
+            if total <= self.max_bytes:
+                break
+            lock = self._locks[name]
+            if name == current or lock.locked():
+                continue
+            async with lock:
+                file_lock = self._lock(name)
+                if not file_lock.try_acquire():
+                    # Being updated by another process
+                    continue
+                try:
+                    log.info('Evicting cached context {0}'.format(name))
+                    await loop.run_in_executor(
+                        None, shutil.rmtree, str(self.root / name), True)
+                finally:
+                    file_lock.release()
+            total -= size
+
+
+def _log_failure(future):
+    if future.cancelled():
+        return
+    e = future.exception()
+    if e is not None:
+        log.warning('Failed to update cached context: {0}'.format(e))
+
+
+# The rest run on executor threads.
+
+def _load_manifest(directory):
+    """
+    Return the manifest of the context cached in ``directory``, marking
+    it as used, or ``None`` if there's no usable one.
+    """
+    path = directory / _MANIFEST
+    try:
+        with path.open('rb') as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+        if not (directory / manifest['tar']).is_file():
+            return None
+        os.utime(str(path))
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        log.warning('Ignoring unreadable context manifest {0}'.format(path))
+        return None
+    return manifest
+
+
+def _create_tar(directory):
+    """
+    Create a new tar file in ``directory``, and return its descriptor,
+    its path and it open for reading.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, tar_path = tempfile.mkstemp(
+        dir=str(directory), prefix='context-', suffix='.tar')
+    return fd, tar_path, open(tar_path, 'rb')
+
+
+def _regenerate(directory, key, archive, mtime, previous, fd, tar_path,
+                written):
+    """
+    Write the tar of ``archive`` to the open file ``fd`` at ``tar_path``
+    in ``directory``, copying the contents of blobs in the ``previous``
+    manifest from its tar and calling ``written`` after each write, and
+    return the new manifest and the number of blobs read from Git.
+    """
+    reused = {}
+    links = {}
+    source_fd = None
+    if previous is not None:
+        links = previous['links']
+        try:
+            source_fd = os.open(
+                str(directory / previous['tar']), os.O_RDONLY)
+            reused = previous['blobs']
+        except FileNotFoundError:
+            pass
+    blobs = {}
+    new_links = {}
+    reader = None
+    try:
+        with _NotifyingFile(open(fd, 'wb', buffering=0), written) as dest:
+            writer = git.TarWriter(dest)
+            for mode, object_type, object_id, path in archive.entries:
+                if object_type != 'blob':
+                    # Trees, and submodules which are left empty
+                    writer.add(path, 0o775, mtime, type=tarfile.DIRTYPE)
+                    continue
+                if mode == git.SYMLINK_MODE:
+                    target = links.get(object_id)
+                    if target is None:
+                        if reader is None:
+                            reader = _BlobReader(archive.git_dir)
+                        target = reader.read(object_id).decode(
+                            'utf-8', 'surrogateescape')
+                    new_links[object_id] = target
+                    writer.add(
+                        path, 0o777, mtime, type=tarfile.SYMTYPE,
+                        linkname=target,
+                    )
+                    continue
+                file_mode = 0o775 if mode == '100755' else 0o664
+                if object_id in reused:
+                    offset, size = reused[object_id]
+                    offset = writer.add_range(
+                        path, file_mode, mtime, source_fd, offset, size)
+                else:
+                    if reader is None:
+                        reader = _BlobReader(archive.git_dir)
+                    size = reader.start(object_id)
+                    offset = writer.add_stream(
+                        path, file_mode, mtime, reader.stdout, size)
+                    reader.finish()
+                blobs[object_id] = [offset, size]
+            writer.close()
+    except BaseException:
+        os.unlink(tar_path)
+        raise
+    finally:
+        if source_fd is not None:
+            os.close(source_fd)
+        if reader is not None:
+            reader.close()
+
+    manifest = {
+        'key': key,
+        'commit_hash': archive.commit_hash,
+        'tree_ish': archive.tree_ish,
+        'tar': os.path.basename(tar_path),
+        'blobs': blobs,
+        'links': new_links,
+    }
+    # The manifest goes in last, so it never points at a partial tar.
+    manifest_path = directory / _MANIFEST
+    temp_path = directory / (_MANIFEST + '.tmp')
+    with temp_path.open('wb') as f:
+        f.write(json.dumps(manifest).encode('utf-8'))
+    os.replace(str(temp_path), str(manifest_path))
+    for path in directory.glob('context-*.tar'):
+        if path.name != manifest['tar']:
+            path.unlink()
+    read_count = sum(
+        1 for object_id in blobs if object_id not in reused)
+    return manifest, read_count
+
+
+class _NotifyingFile:
+    """
+    The unbuffered file ``raw``, calling ``written`` after each write to
+    it. Contents copied in the kernel are only noticed with the next.
+    """
+    def __init__(self, raw, written):
+        self._raw = raw
+        self._written = written
+
+    def write(self, data):
+        count = self._raw.write(data)
+        self._written()
+        return count
+
+    def tell(self):
+        return self._raw.tell()
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._raw.close()
+
+
+class _BlobReader:
+    """
+    Reads blobs one at a time from ``git cat-file --batch``, which
+    answers each request before reading the next.
+    """
+    def __init__(self, git_dir):
+        self._proc = subprocess.Popen(
+            ['git', '--git-dir={0}'.format(git_dir), 'cat-file', '--batch'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.stdout = self._proc.stdout
+
+    def start(self, object_id):
+        """
+        Request the blob ``object_id`` and return its size. Its contents
+        are then read from :attr:`stdout`, followed by :meth:`finish`.
+        """
+        self._proc.stdin.write(object_id.encode('ascii') + b'\n')
+        self._proc.stdin.flush()
+        header = self.stdout.readline()
+        fields = header.split()
+        if len(fields) != 3 or fields[1] != b'blob':
+            raise git.ArchiveFailed(self._proc.poll(), header, b'')
+        return int(fields[2])
+
+    def finish(self):
+        self.stdout.read(1)  # The newline after the contents
+
+    def read(self, object_id):
+        size = self.start(object_id)
+        data = self.stdout.read(size)
+        self.finish()
+        return data
+
+    def close(self):
+        self._proc.stdin.close()
+        self.stdout.close()
+        self._proc.wait()
+
+
+def _measure_contexts(root):
+    """
+    Return ``(last used, size, name)`` of each cached context under
+    ``root``, least recently used first.
+    """
+    try:
+        directories = list(os.scandir(str(root)))
+    except FileNotFoundError:
+        return []
+    usage = []
+    for directory in directories:
+        if not directory.is_dir(follow_symlinks=False):
+            continue
+        try:
+            mtime = os.stat(
+                os.path.join(directory.path, _MANIFEST)).st_mtime
+        except FileNotFoundError:
+            mtime = 0
+        size = 0
+        for entry in os.scandir(directory.path):
+            try:
+                size += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass
+        usage.append((mtime, size, directory.name))
+    usage.sort()
+    return usage
@@ -0,0 +1,132 @@
+"""
+Deduplication of builds by the content they're built from.
+"""
+import json
+import logging
+import pathlib
+
+import attr
+
+
+log = logging.getLogger(__name__)
+
+
+LABEL_PREFIX = 'harborpilot.'
+
+
+@attr.s(frozen=True)
+class BuildKey:
+    """
+    Identifies the inputs of a build: two builds with equal keys
+    produce equivalent images.
+    """
+    # str, the configured build name
+    build_name = attr.ib()
+    # str, the Git commit the context was taken from
+    commit_hash = attr.ib()
+    # str, the context's path inside the repository
+    context_relpath = attr.ib(converter=str)
+    # str, the Git blob ID of the Dockerfile
+    dockerfile_digest = attr.ib()
+    # str, a digest of the build options that change the image built
+    # (build args, target and platform), or '' if there are none. The
+    # default lets index entries from before it was added load.
+    options_digest = attr.ib(default='')
+
+    def labels(self):
+        """
+        Return the image labels (a dict of str -> str) recording this
+        key, used to find the image in the engine later.
+        """
+        return {
+            LABEL_PREFIX + field.name: getattr(self, field.name)
+            for field in attr.fields(type(self))
+        }
+
+    @classmethod
+    def from_labels(cls, labels):
+        """
+        Return the key recorded in the image ``labels``, or ``None``
+        if they don't contain one.
+        """
+        labels = labels or {}
+        try:
+            return cls(**{
+                field.name: labels[LABEL_PREFIX + field.name]
+                for field in attr.fields(cls)
+            })
+        except KeyError:
+            return None
+
+
+class BuildIndex:
+    """
+    A local index of :class:`BuildKey` -> Docker image ID.
+
+    Entries are appended to a JSON lines file so the index survives
+    restarts; the whole file is read on first use. Other processes may
+    append to it too, so a lookup that misses reads any lines added
+    since.
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._entries = None
+        self._offset = 0  # Bytes of the file read so far
+        self._lineno = 0
+
+    def lookup(self, key):
+        """
+        Return the image ID recorded for ``key``, or ``None``.
+        """
+        self._load()
+        image_id = self._entries.get(key)
+        if image_id is None:
+            self._read_new_lines()
+            image_id = self._entries.get(key)
+        return image_id
+
+    def record(self, key, image_id):
+        self._load()
+        if self._entries.get(key) == image_id:
+            return
+        self._entries[key] = image_id
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps({'key': attr.asdict(key), 'image_id': image_id})
+        # One write, so lines from several processes don't interleave
+        with self.path.open('ab', buffering=0) as f:
+            f.write(line.encode('utf-8') + b'\n')
+
+    def forget(self, key):
+        """
+        Drop ``key`` from the in-memory index, for when its image turns
+        out to be gone from the engine.
+        """
+        self._load()
+        self._entries.pop(key, None)
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._read_new_lines()
+
+    def _read_new_lines(self):
+        try:
+            f = self.path.open('rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self._offset)
+            data = f.read()
+        # A line still being written is left for next time.
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            self._lineno += 1
+            try:
+                entry = json.loads(line.decode('utf-8'))
+                key = BuildKey(**entry['key'])
+                self._entries[key] = entry['image_id']
+            except (ValueError, KeyError, TypeError):
+                log.warning('Skipping bad line {0} of {1}'.format(
+                    self._lineno, self.path))
@@ -1,18 +1,42 @@
 """
 Wrappers for accessing Docker Engine.
 """
+import re
 import json
+import time
 import logging
 import uuid
+import bisect
 import asyncio
+import hashlib
+import contextlib
+import collections
 import concurrent.futures
 
+import attr
 import aiohttp
 
+from harborpilot import buildkit
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 log = logging.getLogger(__name__)
 
 
+if orjson is not None:
+    _json_loads = orjson.loads
+else:
+    # Also takes bytes, just slower.
+    _json_loads = json.loads
+
+
+DEFAULT_BASE_URL = 'http://dockerengine.local'
+
+
 # See https://docs.docker.com/engine/api/v1.37/#operation/ImageBuild
 # The response body format isn't documented (as of 2018-04-26), but appears
 # to be line-delimited JSON objects. See also
@@ -28,7 +52,10 @@ class ImageBuild:
     """
     def __init__(
             self, client_session, archive, *,
-            image_name, labels=None, base_url='http://dockerengine.local'
+            image_name, labels=None, base_url=DEFAULT_BASE_URL,
+            version=None, platform=None, buildargs=None, target=None,
+            pull=False, networkmode=None, memory=None, cpushares=None,
+            cachefrom=None, stream_observer=None
         ):
         """
         Arguments:
@@ -36,14 +63,16 @@ class ImageBuild:
                 The HTTP client. Assumed to be created with
                 :func:`make_session`.
             archive:
-                A binary-mode file-like object containing tar data.
-                The archive must have a Dockerfile at its root, along
-                with any necessary supporting files needed for the
-                build.
+                A binary-mode file-like object containing tar data, or
+                an async iterable of ``bytes`` chunks of tar data, which
+                is streamed to the engine as it's produced. The archive
+                must have a Dockerfile at its root, along with any
+                necessary supporting files needed for the build.
 
         Keyword Arguments:
             image_name (str):
-                The name to use for the image.
+                The name to use for the image, optionally with a tag
+                (``name:tag``).
             labels (collections.abc.Mapping):
                 A mapping (str -> str) of label names and values to
                 apply to the image.
@@ -53,16 +82,53 @@ class ImageBuild:
                 ``client_session`` is configured to communicate with
                 the UNIX socket, the host portion of the URL shouldn't
                 matter, but it should still be there.
+            version (str):
+                The builder to use: ``'1'`` for the classic one, ``'2'``
+                for BuildKit. By default the engine decides. BuildKit's
+                progress is passed on to the consumer as ``stream``
+                text (see :class:`.buildkit.TraceRenderer`).
+            platform (str):
+                The platform to build for, like ``'linux/amd64'``.
+            buildargs (collections.abc.Mapping):
+                A mapping (str -> str) of build-time variables.
+            target (str):
+                The build stage to stop at.
+            pull (bool):
+                Whether to pull newer versions of the base images.
+            networkmode (str):
+                The network mode for ``RUN`` instructions.
+            memory (int):
+                The memory limit in bytes of the build containers.
+            cpushares (int):
+                The relative CPU weight of the build containers.
+            cachefrom (list):
+                Images (str) to use as cache sources.
+            stream_observer (callable):
+                Called with each piece (bytes) of the response body as
+                it's read, before it's decoded; for recording it. It
+                can also be set as the attribute of the same name until
+                :meth:`dispatch_messages` is called.
         """
         self.archive = archive
         self.image_name = image_name
         self.labels = labels or {}
         self.base_url = base_url
+        self.version = version
+        self.platform = platform
+        self.buildargs = buildargs or {}
+        self.target = target
+        self.pull = pull
+        self.networkmode = networkmode
+        self.memory = memory
+        self.cpushares = cpushares
+        self.cachefrom = cachefrom or []
+        self.stream_observer = stream_observer
 
         self._session = client_session
         self._request_task = None
         self._status_received = asyncio.Event()
         self._not_accepted_error = None
+        self._request_error = None
         self._is_ready_to_dispatch = True
         self._ready_to_receive = asyncio.Event()
         self._messages_consumer = None
@@ -70,7 +136,9 @@ class ImageBuild:
     async def start(self):
         """
         Send the request for the build, raise :exc:`.BuildNotAccepted`
-        if the Docker API responds other than 200.
+        if the Docker API responds other than 200. If sending the
+        request fails (for instance, producing the archive raised),
+        that exception is raised instead.
 
         This does not consume the response body, use
         :meth:`dispatch_messages` for that.
@@ -79,6 +147,8 @@ class ImageBuild:
             raise Exception('Already started!')
         self._request_task = asyncio.ensure_future(self._invoke())
         await self._status_received.wait()
+        if self._request_error is not None:
+            raise self._request_error
         if self._not_accepted_error is not None:
             self._request_task.cancel()
             raise self._not_accepted_error
@@ -89,9 +159,19 @@ class ImageBuild:
         Read the response JSON lines and dispatch their decoded
         structures to the consumer's ``message_received`` method.
 
+        The response is read in large chunks, and all the messages in a
+        chunk are decoded together. If the consumer has a
+        ``messages_received`` method, it's called with each batch (a
+        list) instead, saving a method call per message.
+
         When there are no more messages, the consumer's
         ``last_message_received`` *coroutine* method will be called
         and awaited.
+
+        If the consumer has a ``drain`` *coroutine* method, it's awaited
+        after each batch, and reading from the engine pauses until it
+        returns. This lets a slow consumer push back on the build rather
+        than buffering without limit.
         """
         if not self._is_ready_to_dispatch:
             raise Exception('Must start() before dispatching!')
@@ -107,13 +187,36 @@ class ImageBuild:
         try:
             async with self._make_request() as response:
                 await self._process_response(response)
-        except:
-            log.exception('Unhandled error in request to Docker Engine')
+        except Exception as e:
+            if not self._status_received.is_set():
+                # start() is still waiting, let it raise this.
+                self._request_error = e
+                self._status_received.set()
+            else:
+                log.exception('Unhandled error in request to Docker Engine')
 
     def _make_request(self):
         params = {'t': self.image_name}
         if self.labels:
             params['labels'] = json.dumps(self.labels)
+        if self.version is not None:
+            params['version'] = self.version
+        if self.platform is not None:
+            params['platform'] = self.platform
+        if self.buildargs:
+            params['buildargs'] = json.dumps(self.buildargs)
+        if self.target is not None:
+            params['target'] = self.target
+        if self.pull:
+            params['pull'] = '1'
+        if self.networkmode is not None:
+            params['networkmode'] = self.networkmode
+        if self.memory is not None:
+            params['memory'] = str(self.memory)
+        if self.cpushares is not None:
+            params['cpushares'] = str(self.cpushares)
+        if self.cachefrom:
+            params['cachefrom'] = json.dumps(self.cachefrom)
         headers = {'Content-Type': 'application/x-tar'}
         url = self.base_url + '/build'
         return self._session.post(
@@ -137,15 +240,52 @@ class ImageBuild:
         self._status_received.set()
         await self._ready_to_receive.wait()
         assert self._messages_consumer is not None
+        consumer = self._messages_consumer
+        receive_batch = getattr(consumer, 'messages_received', None)
+        if receive_batch is None:
+            receive_batch = _per_message(consumer)
+        drain = getattr(consumer, 'drain', None)
+        observe = self.stream_observer
+        if self.version == '2':
+            # Only BuildKit sends trace messages to turn into text
+            receive_batch = _rendering_traces(receive_batch)
 
+        partial_line = b''
         while True:
-            line = await response.content.readline()
-            if not line:
-                await self._messages_consumer.last_message_received()
+            data = await response.content.readany()
+            if not data:
                 break
-            linetext = line.decode('utf-8')
-            message = json.loads(linetext)
-            self._messages_consumer.message_received(message)
+            if observe is not None:
+                observe(data)
+            lines = (partial_line + data).split(b'\n')
+            partial_line = lines.pop()
+            messages = [_json_loads(line) for line in lines if line]
+            if messages:
+                receive_batch(messages)
+                if drain is not None:
+                    await drain()
+        if partial_line.strip():
+            receive_batch([_json_loads(partial_line)])
+        await consumer.last_message_received()
+
+
+def _rendering_traces(receive_batch):
+    renderer = buildkit.TraceRenderer()
+
+    def receive_rendered_batch(messages):
+        messages = renderer.translate(messages)
+        if messages:
+            receive_batch(messages)
+    return receive_rendered_batch
+
+
+def _per_message(consumer):
+    message_received = consumer.message_received
+
+    def receive_batch(messages):
+        for message in messages:
+            message_received(message)
+    return receive_batch
 
 
 class BuildNotAccepted(Exception):
@@ -162,36 +302,764 @@ class BuildNotAccepted(Exception):
         )
 
 
+class EngineRequestFailed(Exception):
+    def __init__(self, reason, status_code):
+        self.reason = reason
+        self.status_code = status_code
+
+    def __str__(self):
+        fmt = '{class_name}(reason={reason!r}, status_code={status_code!r})'
+        return fmt.format(
+            class_name=type(self).__name__,
+            reason=self.reason,
+            status_code=self.status_code,
+        )
+
+
+async def inspect_image(client_session, image, *, base_url=DEFAULT_BASE_URL):
+    """
+    Return the Engine API's description (a dict) of ``image``, a name
+    or ID, or ``None`` if there's no such image.
+    """
+    url = '{0}/images/{1}/json'.format(base_url, image)
+    async with client_session.get(url) as response:
+        if response.status == 404:
+            return None
+        await _raise_for_status(response)
+        return await response.json()
+
+
+async def find_images(client_session, labels, *, base_url=DEFAULT_BASE_URL):
+    """
+    Return the Engine API's summaries (a list of dicts) of the images
+    having all of the ``labels`` (a mapping of str -> str).
+    """
+    filters = {
+        'label': [
+            '{0}={1}'.format(name, value) for name, value in labels.items()
+        ],
+    }
+    url = base_url + '/images/json'
+    params = {'filters': json.dumps(filters)}
+    async with client_session.get(url, params=params) as response:
+        await _raise_for_status(response)
+        return await response.json()
+
+
+async def tag_image(
+        client_session, image, repo, tag, *, base_url=DEFAULT_BASE_URL
+    ):
+    """
+    Tag ``image`` (a name or ID) as ``repo:tag``.
+    """
+    url = '{0}/images/{1}/tag'.format(base_url, image)
+    params = {'repo': repo, 'tag': tag}
+    async with client_session.post(url, params=params) as response:
+        await _raise_for_status(response)
+
+
+async def _raise_for_status(response):
+    if response.status < 400:
+        return
+    try:
+        reason = (await response.json())['message']
+    except (ValueError, KeyError, TypeError, aiohttp.ContentTypeError):
+        reason = response.reason
+    raise EngineRequestFailed(reason, response.status)
+
+
 class StreamOnlyConsumer:
-    def __init__(self, writeable):
+    """
+    Writes the ``stream`` portion of the messages to ``writeable`` (which
+    has a ``write`` coroutine method, like
+    :class:`aiohttp.web.StreamResponse`).
+
+    Chunks are coalesced into writes of up to ``flush_bytes``, waiting
+    at most ``flush_interval`` seconds for more to arrive. At most
+    ``max_buffer_bytes`` are held waiting to be written; past that,
+    :meth:`drain` blocks, which makes :class:`ImageBuild` stop reading
+    from the engine until the writeable catches up.
+    """
+    def __init__(
+            self, writeable, *, max_buffer_bytes=1024 * 1024,
+            flush_bytes=64 * 1024, flush_interval=0.05
+        ):
         self._writeable = writeable
-        self._stream_chunks = asyncio.Queue()
+        self.max_buffer_bytes = max_buffer_bytes
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._data_available = asyncio.Event()
+        self._space_available = asyncio.Event()
+        self._space_available.set()
         self._write_task = asyncio.ensure_future(self._write_messages())
         self._closed = False
 
+    @property
+    def buffered_bytes(self):
+        return self._buffered_bytes
+
     def message_received(self, message):
+        self.messages_received((message,))
+
+    def messages_received(self, messages):
         if self._closed:
             raise Exception('Cannot add after last_message_received() called')
+        text = stream_text(messages)
+        if text:
+            data = text.encode('utf-8')
+            self._buffer.append(data)
+            self._buffered_bytes += len(data)
+            self._data_available.set()
+            if self._buffered_bytes >= self.max_buffer_bytes:
+                self._space_available.clear()
+
+    async def drain(self):
+        """
+        Wait until the buffer is below ``max_buffer_bytes``. Raises
+        the write error if writing failed.
+        """
+        if self._space_available.is_set():
+            return
+        waiter = asyncio.ensure_future(self._space_available.wait())
+        await asyncio.wait(
+            [waiter, self._write_task],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not waiter.done():
+            waiter.cancel()
+            # The write task ended early, which means it failed.
+            self._write_task.result()
+
+    async def last_message_received(self):
+        self._closed = True
+        self._data_available.set()
+        await self._write_task
+
+    async def _write_messages(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self._buffer:
+                if self._closed:
+                    return
+                self._data_available.clear()
+                await self._data_available.wait()
+                continue
+            # Give a fast build the chance to fill a bigger write.
+            deadline = loop.time() + self.flush_interval
+            while (
+                    not self._closed
+                    and self._buffered_bytes < self.flush_bytes
+                    and loop.time() < deadline
+                ):
+                self._data_available.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._data_available.wait(),
+                        deadline - loop.time(),
+                    )
+                except asyncio.TimeoutError:
+                    break
+            data = b''.join(self._buffer)
+            self._buffer = []
+            self._buffered_bytes = 0
+            self._space_available.set()
+            await self._writeable.write(data)
+
+
+def stream_text(messages):
+    """
+    Return the ``stream`` portions of the build ``messages`` joined
+    together.
+    """
+    chunks = []
+    for message in messages:
         stream_chunk = message.get('stream')
         if stream_chunk is not None:
             if not isinstance(stream_chunk, str):
                 raise TypeError(
                     "For message['stream'] expected str but got {0}".format(
                         type(stream_chunk)))
-            self._stream_chunks.put_nowait(stream_chunk)
+            chunks.append(stream_chunk)
+    return ''.join(chunks)
+
+
+@attr.s
+class StepTiming:
+    # int, the step's number, counting from 1. For BuildKit builds, the
+    # vertex's number in the progress output
+    number = attr.ib()
+    # int, the number of steps in the build, or None for BuildKit builds,
+    # whose stages run in parallel
+    total = attr.ib()
+    # str, the Dockerfile instruction
+    instruction = attr.ib()
+    # float, seconds from the step's start to the next one's (or the
+    # end of the build). For BuildKit builds, the engine's own timing,
+    # and 0.0 for cached steps
+    seconds = attr.ib(default=None)
+
+
+@attr.s
+class BuildResult:
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    # The stream ended without saying either way.
+    UNKNOWN = 'unknown'
+
+    status = attr.ib()
+    # str, the built image's ID
+    image_id = attr.ib(default=None)
+    # str, the engine's error message
+    error = attr.ib(default=None)
+    # list of StepTiming
+    steps = attr.ib(default=attr.Factory(list))
+    # float seconds, from the first message to the last
+    seconds = attr.ib(default=None)
+
+    def describe(self):
+        """
+        Return a JSON-serializable dict of the result.
+        """
+        return attr.asdict(self)
+
+
+class BuildResultConsumer:
+    """
+    Works out the outcome of a build from its messages as they pass:
+    the image ID from the ``aux`` message, any ``error``/``errorDetail``,
+    and how long each Dockerfile step took from the ``Step N/M : ...``
+    lines, or for BuildKit, the ``#N [...]`` and ``#N DONE`` lines of
+    :class:`.buildkit.TraceRenderer`. Apart from a partial line and the
+    names of BuildKit steps, nothing is buffered.
+
+    The outcome is :attr:`result`, a :class:`BuildResult`, once
+    ``last_message_received`` has been called.
+    """
+    _step_pattern = re.compile(r'Step (\d+)/(\d+) : (.*)')
+    _successfully_built_pattern = re.compile(r'Successfully built (\w+)')
+    _vertex_pattern = re.compile(r'#(\d+) (.*)')
+    # Longest partial line kept while waiting for its end. Step lines are
+    # short, so anything longer can't be one.
+    max_partial_line = 4096
+
+    def __init__(self):
+        self.result = None
+        self.image_id = None
+        self.error = None
+        self.steps = []
+        self._partial_line = ''
+        self._clock = time.monotonic
+        self._first_message_at = None
+        self._step_started_at = None
+        # BuildKit vertex number -> name, of the Dockerfile steps
+        self._vertex_names = {}
+
+    def message_received(self, message):
+        self.messages_received((message,))
+
+    def messages_received(self, messages):
+        now = self._clock()
+        if self._first_message_at is None:
+            self._first_message_at = now
+        for message in messages:
+            stream_chunk = message.get('stream')
+            if stream_chunk is not None:
+                self._stream_received(stream_chunk, now)
+                continue
+            aux = message.get('aux')
+            if isinstance(aux, dict) and 'ID' in aux:
+                self.image_id = aux['ID']
+                continue
+            error = message.get('error')
+            if error is None and 'errorDetail' in message:
+                error = message['errorDetail'].get('message')
+            if error is not None:
+                self.error = error
+
+    async def last_message_received(self):
+        now = self._clock()
+        self._end_step(now)
+        if self.error is not None:
+            status = BuildResult.FAILED
+        elif self.image_id is not None:
+            status = BuildResult.SUCCEEDED
+        else:
+            status = BuildResult.UNKNOWN
+        self.result = BuildResult(
+            status=status,
+            image_id=self.image_id,
+            error=self.error,
+            steps=self.steps,
+            seconds=(
+                now - self._first_message_at
+                if self._first_message_at is not None else 0.0
+            ),
+        )
+
+    def _stream_received(self, stream_chunk, now):
+        lines = (self._partial_line + stream_chunk).split('\n')
+        self._partial_line = lines.pop()[:self.max_partial_line]
+        for line in lines:
+            if line.startswith('Step '):
+                match = self._step_pattern.match(line)
+                if match is not None:
+                    self._end_step(now)
+                    number, total, instruction = match.groups()
+                    self.steps.append(StepTiming(
+                        int(number), int(total), instruction.strip()))
+                    self._step_started_at = now
+            elif line.startswith('#'):
+                self._vertex_line_received(line)
+            elif line.startswith('Successfully built '):
+                match = self._successfully_built_pattern.match(line)
+                # Older engines don't send the aux message.
+                if match is not None and self.image_id is None:
+                    self.image_id = match.group(1)
+
+    def _vertex_line_received(self, line):
+        match = self._vertex_pattern.match(line)
+        if match is None:
+            return
+        number, text = int(match.group(1)), match.group(2)
+        name = self._vertex_names.get(number)
+        if name is None:
+            if number not in self._vertex_names:
+                # The first line names the vertex. Only instructions from
+                # the Dockerfile, like "[2/3] RUN make", are steps.
+                is_step = (
+                    text.startswith('[') and not text.startswith('[internal]'))
+                self._vertex_names[number] = text if is_step else None
+            return
+        seconds = None
+        if text == 'CACHED':
+            seconds = 0.0
+        elif text.startswith('DONE ') and text.endswith('s'):
+            try:
+                seconds = float(text[5:-1])
+            except ValueError:
+                return
+        if seconds is not None:
+            self.steps.append(StepTiming(number, None, name, seconds))
+
+    def _end_step(self, now):
+        if self.steps and self.steps[-1].seconds is None:
+            self.steps[-1].seconds = now - self._step_started_at
+
+
+class MultiConsumer:
+    """
+    Passes messages on to each of several consumers, in order.
+    """
+    def __init__(self, consumers):
+        self.consumers = list(consumers)
+
+    def message_received(self, message):
+        for consumer in self.consumers:
+            consumer.message_received(message)
+
+    def messages_received(self, messages):
+        for consumer in self.consumers:
+            receive_batch = getattr(consumer, 'messages_received', None)
+            if receive_batch is not None:
+                receive_batch(messages)
+            else:
+                for message in messages:
+                    consumer.message_received(message)
+
+    async def drain(self):
+        for consumer in self.consumers:
+            drain = getattr(consumer, 'drain', None)
+            if drain is not None:
+                await drain()
 
     async def last_message_received(self):
+        for consumer in self.consumers:
+            await consumer.last_message_received()
+
+
+class BroadcastConsumer:
+    """
+    Fans the ``stream`` portion of the messages out to any number of
+    subscribers, without ever waiting on them.
+
+    The most recent chunks, up to ``ring_bytes`` of them, are kept in
+    a ring buffer so subscribers joining late (or reconnecting) can
+    catch up. Each subscriber has a queue of at most ``max_subscriber_bytes``;
+    when a slow one falls further behind than that, it skips ahead to
+    the newest chunk and is told how much it missed.
+
+    Chunks are identified by their byte offset in the UTF-8 encoded
+    stream.
+    """
+    def __init__(
+            self, *, ring_bytes=256 * 1024, max_subscriber_bytes=256 * 1024
+        ):
+        self.ring_bytes = ring_bytes
+        self.max_subscriber_bytes = max_subscriber_bytes
+        self._ring = collections.deque()
+        self._ring_used = 0
+        self._subscribers = set()
+        self._offset = 0
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def message_received(self, message):
+        self.messages_received((message,))
+
+    def messages_received(self, messages):
+        text = stream_text(messages)
+        if not text:
+            return
+        data = text.encode('utf-8')
+        event = LogChunk(self._offset, data)
+        self._offset += len(data)
+        self._ring.append(event)
+        self._ring_used += len(data)
+        while self._ring_used > self.ring_bytes and len(self._ring) > 1:
+            self._ring_used -= len(self._ring.popleft().data)
+        for subscriber in self._subscribers:
+            subscriber._offer(event)
+
+    async def last_message_received(self):
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
         self._closed = True
-        await self._stream_chunks.join()
-        self._write_task.cancel()
+        for subscriber in self._subscribers:
+            subscriber._end()
+        self._subscribers.clear()
 
-    async def _write_messages(self):
-        while True:
-            chunk = await self._stream_chunks.get()
-            await self._writeable.write(chunk.encode('utf-8'))
-            self._stream_chunks.task_done()
+    def subscribe(self, offset=0):
+        """
+        Return a :class:`Subscription` receiving chunks from byte
+        ``offset`` onward. If the start of that is no longer in the
+        ring buffer, the subscription begins with a :class:`LogGap`.
+        """
+        subscription = Subscription(self, offset, self.max_subscriber_bytes)
+        backlog = [event for event in self._ring if event.end > offset]
+        backlog_start = backlog[0].offset if backlog else self._offset
+        if offset < backlog_start:
+            subscription._offer(LogGap(offset, backlog_start))
+        for event in backlog:
+            subscription._offer(event)
+        if self._closed:
+            subscription._end()
+        else:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+
+@attr.s(frozen=True)
+class LogChunk:
+    # int, byte offset of the start of data in the stream
+    offset = attr.ib()
+    # bytes
+    data = attr.ib()
+
+    @property
+    def end(self):
+        return self.offset + len(self.data)
+
+
+@attr.s(frozen=True)
+class LogGap:
+    """
+    Marks bytes from ``offset`` to ``end`` that a subscriber missed.
+    """
+    offset = attr.ib()
+    end = attr.ib()
+
+
+class Subscription:
+    """
+    A subscriber's view of a :class:`BroadcastConsumer`. Asynchronously
+    iterate over it for :class:`LogChunk` and :class:`LogGap` events,
+    ending when the stream does; call :meth:`close` to stop early.
+    """
+    def __init__(self, broadcast, offset, max_bytes):
+        self._broadcast = broadcast
+        self._offset = offset
+        self._max_bytes = max_bytes
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._ended = False
+        self._waiter = None
+        # int, total bytes skipped because this subscriber was too slow
+        self.skipped_bytes = 0
+
+    def close(self):
+        self._broadcast._unsubscribe(self)
+        self._end()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self._ended:
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        event = self._queue.popleft()
+        if isinstance(event, LogChunk):
+            self._queued_bytes -= len(event.data)
+        return event
+
+    def _offer(self, event):
+        if isinstance(event, LogChunk):
+            if event.end <= self._offset:
+                return
+            if event.offset < self._offset:
+                event = LogChunk(
+                    self._offset, event.data[self._offset - event.offset:])
+            if self._queued_bytes + len(event.data) > self._max_bytes:
+                self._skip_to(event.offset)
+            self._queued_bytes += len(event.data)
+        self._queue.append(event)
+        self._wake()
+
+    def _skip_to(self, offset):
+        start = None
+        while self._queue:
+            dropped = self._queue.popleft()
+            if start is None:
+                start = dropped.offset
+        if start is not None:
+            self.skipped_bytes += offset - start
+            self._queue.append(LogGap(start, offset))
+        self._queued_bytes = 0
 
+    def _end(self):
+        self._ended = True
+        self._wake()
 
-def make_session():
-    conn = aiohttp.UnixConnector(path='/var/run/docker.sock')
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+DEFAULT_ENGINE_URL = 'unix:///var/run/docker.sock'
+
+
+def make_session(
+        url=DEFAULT_ENGINE_URL, *, max_connections=100,
+        keepalive_timeout=15.0
+    ):
+    """
+    Return a client session for the engine at ``url`` (see
+    :func:`engine_base_url`), keeping at most ``max_connections``
+    connections to it, each idle for at most ``keepalive_timeout``
+    seconds.
+    """
+    if url.startswith('unix://'):
+        conn = aiohttp.UnixConnector(
+            path=url[len('unix://'):],
+            limit=max_connections,
+            keepalive_timeout=keepalive_timeout,
+        )
+    else:
+        conn = aiohttp.TCPConnector(
+            limit=max_connections,
+            keepalive_timeout=keepalive_timeout,
+        )
     return aiohttp.ClientSession(connector=conn)
+
+
+def engine_base_url(url):
+    """
+    Return the base URL for requests to the engine at ``url``, which is
+    ``unix://`` and a socket path, or ``tcp://`` or ``http://`` and a
+    host and port.
+    """
+    if url.startswith('unix://'):
+        return DEFAULT_BASE_URL
+    if url.startswith('tcp://'):
+        return 'http://' + url[len('tcp://'):].rstrip('/')
+    if url.startswith('http://'):
+        return url.rstrip('/')
+    raise ValueError('Unsupported engine URL {0!r}'.format(url))
+
+
+class Engine:
+    """
+    A Docker Engine that builds can be placed on, reached through
+    ``client_session`` at ``base_url``.
+    """
+    def __init__(self, client_session, *, base_url=DEFAULT_BASE_URL,
+                 name=None):
+        self.session = client_session
+        self.base_url = base_url
+        self.name = name or base_url
+        # Builds placed on this engine and not finished yet
+        self.active_builds = 0
+        # Whether the last health check succeeded
+        self.healthy = True
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """
+        Return the engine at ``url``, with a new session made by
+        :func:`make_session` with the keyword arguments.
+        """
+        base_url = engine_base_url(url)
+        return cls(make_session(url, **kwargs), base_url=base_url, name=url)
+
+    async def ping(self):
+        """
+        Return whether the engine answers ``/_ping``.
+        """
+        try:
+            async with self.session.get(self.base_url + '/_ping') as response:
+                await response.read()
+                return response.status == 200
+        except (aiohttp.ClientError, OSError):
+            return False
+
+    async def close(self):
+        # Zero-sleep to allow underlying connections to close
+        await asyncio.sleep(0)
+        await self.session.close()
+
+
+class EnginePool:
+    """
+    The engines builds are spread across, by one of the ``placement``
+    strategies:
+
+    ``least_loaded``
+        The healthy engine with the fewest active builds.
+    ``consistent_hash``
+        The engine the build name hashes to, so its layer cache is warm.
+        If it's down, the next healthy one on the hash ring is used, and
+        adding or removing an engine only moves the build names hashed
+        to it.
+
+    If ``health_check_interval`` is given, every engine is pinged that
+    often once :meth:`start` is called, and the ones that don't answer
+    within it are skipped until they do.
+    """
+    LEAST_LOADED = 'least_loaded'
+    CONSISTENT_HASH = 'consistent_hash'
+    PLACEMENTS = (LEAST_LOADED, CONSISTENT_HASH)
+
+    # Points on the hash ring per engine, to even out the share of each
+    virtual_nodes = 64
+
+    def __init__(self, engines, *, placement=LEAST_LOADED,
+                 health_check_interval=None):
+        if not engines:
+            raise ValueError('At least one engine is required')
+        if placement not in self.PLACEMENTS:
+            raise ValueError('Unknown placement {0!r}'.format(placement))
+        self.engines = list(engines)
+        self.placement = placement
+        self.health_check_interval = health_check_interval
+        self._ring = sorted(
+            (_ring_hash('{0}#{1}'.format(engine.name, index)), position)
+            for position, engine in enumerate(self.engines)
+            for index in range(self.virtual_nodes)
+        )
+        self._ring_hashes = [point for point, position in self._ring]
+        self._health_task = None
+
+    def place(self, build_name):
+        """
+        Return the :class:`Engine` to run a build of ``build_name`` on.
+        Raises :exc:`NoEngineAvailable` if every engine is down.
+        """
+        if self.placement == self.CONSISTENT_HASH:
+            start = bisect.bisect(self._ring_hashes, _ring_hash(build_name))
+            for index in range(len(self._ring)):
+                point, position = self._ring[
+                    (start + index) % len(self._ring)]
+                engine = self.engines[position]
+                if engine.healthy:
+                    return engine
+        else:
+            healthy = [engine for engine in self.engines if engine.healthy]
+            if healthy:
+                return min(healthy, key=lambda e: e.active_builds)
+        raise NoEngineAvailable(build_name)
+
+    @contextlib.contextmanager
+    def placed(self, build_name):
+        """
+        Context manager placing a build of ``build_name`` and yielding
+        its :class:`Engine`, which counts it as active until the block
+        exits.
+        """
+        engine = self.place(build_name)
+        engine.active_builds += 1
+        try:
+            yield engine
+        finally:
+            engine.active_builds -= 1
+
+    def start(self):
+        if self.health_check_interval is not None:
+            self._health_task = asyncio.ensure_future(self._check_health())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        for engine in self.engines:
+            await engine.close()
+
+    async def check_health(self):
+        """
+        Ping every engine at once, marking the ones that don't answer
+        within ``health_check_interval`` as down.
+        """
+        results = await asyncio.gather(*[
+            asyncio.wait_for(engine.ping(), self.health_check_interval)
+            for engine in self.engines
+        ], return_exceptions=True)
+        for engine, healthy in zip(self.engines, results):
+            healthy = healthy is True
+            if healthy != engine.healthy:
+                if healthy:
+                    log.info('Engine {0} is back up'.format(engine.name))
+                else:
+                    log.warning('Engine {0} is down'.format(engine.name))
+            engine.healthy = healthy
+
+    async def _check_health(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_check_interval)
+
+
+def _ring_hash(key):
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class NoEngineAvailable(Exception):
+    def __init__(self, build_name):
+        self.build_name = build_name
+
+    def __str__(self):
+        return 'No healthy Docker engine to build {0} on'.format(
+            self.build_name)
@@ -0,0 +1,182 @@
+"""
+Matching paths against ``.dockerignore`` patterns, the way the Docker CLI
+does when it builds a context.
+
+A path is excluded if the last pattern matching it, or any directory it's
+in, is an ordinary pattern, and kept if it's an exception (starting with
+``!``). ``*`` and ``?`` don't match ``/``, and ``**`` matches any number of
+directories, including none.
+"""
+import re
+import posixpath
+
+
+# Always sent, even if the patterns exclude them, like the Docker CLI does.
+ALWAYS_INCLUDED = ['Dockerfile', '.dockerignore']
+
+# No match, so the path is kept
+NO_MATCH = -1
+
+
+class InvalidPattern(Exception):
+    def __init__(self, pattern, reason):
+        self.pattern = pattern
+        self.reason = reason
+
+    def __str__(self):
+        fmt = '{classname}(pattern={pattern!r}, reason={reason!r})'
+        return fmt.format(
+            classname=type(self).__name__,
+            pattern=self.pattern,
+            reason=self.reason,
+        )
+
+
+def parse(text):
+    """
+    Return the patterns in the text of a ``.dockerignore`` file, cleaned
+    up like Docker does.
+    """
+    patterns = []
+    for line in text.lstrip('\ufeff').splitlines():
+        if line.startswith('#'):
+            continue
+        pattern = line.strip()
+        if not pattern:
+            continue
+        exception = pattern.startswith('!')
+        if exception:
+            pattern = pattern[1:].strip()
+        if pattern:
+            pattern = posixpath.normpath(pattern)
+            if len(pattern) > 1:
+                pattern = pattern.lstrip('/')
+        patterns.append('!' + pattern if exception else pattern)
+    return patterns
+
+
+def _translate(pattern):
+    """
+    Return the regular expression source matching what ``pattern``
+    matches.
+    """
+    parts = ['^']
+    i = 0
+    n = len(pattern)
+    while i < n:
+        ch = pattern[i]
+        i += 1
+        if ch == '*':
+            if i < n and pattern[i] == '*':
+                i += 1
+                # Treat **/ as **
+                if i < n and pattern[i] == '/':
+                    i += 1
+                if i == n:
+                    parts.append('.*')
+                else:
+                    # Anywhere, even within a name, as Docker does
+                    parts.append('(.*/)?')
+            else:
+                parts.append('[^/]*')
+        elif ch == '?':
+            parts.append('[^/]')
+        elif ch == '\\':
+            if i < n:
+                parts.append(re.escape(pattern[i]))
+                i += 1
+            else:
+                parts.append(re.escape(ch))
+        elif ch == '[':
+            end = pattern.find(']', i)
+            if end == -1:
+                raise InvalidPattern(pattern, 'unterminated character class')
+            body = pattern[i:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append('[' + body + ']')
+            i = end + 1
+        else:
+            parts.append(re.escape(ch))
+    parts.append('$')
+    return ''.join(parts)
+
+
+class DockerIgnore:
+    """
+    A compiled list of ``.dockerignore`` patterns (as returned by
+    :func:`parse`), which never exclude the paths in
+    ``always_included``.
+
+    To filter a tree top-down without checking every directory of every
+    path against every pattern, pass :meth:`match` the result for the
+    path's directory, and skip directories for which
+    :meth:`prunes` is true.
+    """
+    def __init__(self, patterns, *, always_included=()):
+        self.always_included = frozenset(always_included)
+        self.patterns = []
+        self._regexes = []
+        self._exceptions = []
+        for pattern in patterns:
+            exception = pattern.startswith('!')
+            if exception:
+                pattern = pattern[1:]
+                if not pattern:
+                    raise InvalidPattern('!', 'illegal exclusion pattern')
+            if not pattern or pattern == '.':
+                continue
+            try:
+                regex = re.compile(_translate(pattern), re.DOTALL)
+            except re.error as e:
+                raise InvalidPattern(pattern, str(e))
+            self.patterns.append(pattern)
+            self._regexes.append(regex)
+            self._exceptions.append(exception)
+        self.has_exceptions = any(self._exceptions)
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Return the matcher for the text of a ``.dockerignore`` file,
+        which never excludes the files in :data:`ALWAYS_INCLUDED`.
+        """
+        return cls(parse(text), always_included=ALWAYS_INCLUDED)
+
+    def match(self, path, parent_match=None):
+        """
+        Return the index of the last pattern matching the relative
+        ``path`` or one of its directories, or :data:`NO_MATCH`.
+
+        ``parent_match`` is the result for the directory ``path`` is in,
+        if known; otherwise all of its directories are checked too.
+        """
+        if path in self.always_included:
+            return NO_MATCH
+        if parent_match is None:
+            parent = posixpath.dirname(path)
+            parent_match = self.match(parent) if parent else NO_MATCH
+        # Only a later pattern can override the directory's match
+        for index in range(len(self._regexes) - 1, parent_match, -1):
+            if self._regexes[index].match(path):
+                return index
+        return parent_match
+
+    def excluded(self, match):
+        """
+        Return whether the result of :meth:`match` means exclusion.
+        """
+        return match != NO_MATCH and not self._exceptions[match]
+
+    def prunes(self, match):
+        """
+        Return whether everything under a directory with the result
+        ``match`` is excluded, so it needn't be looked in.
+        """
+        return self.excluded(match) and not self.has_exceptions
+
+    def excludes(self, path):
+        """
+        Return whether the relative ``path`` is excluded.
+        """
+        return self.excluded(self.match(path))
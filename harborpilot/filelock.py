@@ -0,0 +1,82 @@
+"""
+Locks on files, for on-disk state shared by several HarborPilot
+processes.
+"""
+import os
+import fcntl
+import asyncio
+import pathlib
+
+
+class FileLock:
+    """
+    An ``flock`` of the file at ``path`` (created if necessary), held
+    exclusively, or with ``shared`` alongside other shared holders.
+
+    Each acquisition opens the file anew, so holders in the same process
+    exclude each other just like those in different ones. Use it as an
+    async context manager, or :meth:`try_acquire` and :meth:`release`.
+    """
+    def __init__(self, path, *, shared=False):
+        self.path = pathlib.Path(path)
+        self.shared = shared
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    async def acquire(self):
+        """
+        Wait for the lock, on an executor thread.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(None, self._lock, True)
+        try:
+            self._fd = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The thread still gets the lock, which must be let go.
+            future.add_done_callback(_close_acquired)
+            raise
+
+    def try_acquire(self):
+        """
+        Take the lock if nobody holds it in a conflicting way, and
+        return whether it was taken.
+        """
+        self._fd = self._lock(False)
+        return self._fd is not None
+
+    def release(self):
+        if self._fd is not None:
+            # Closing the file lets go of the lock.
+            os.close(self._fd)
+            self._fd = None
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def _lock(self, blocking):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+
+def _close_acquired(future):
+    if not future.cancelled() and future.exception() is None:
+        os.close(future.result())
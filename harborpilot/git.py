@@ -1,10 +1,29 @@
 import os
+import stat
+import time
+import shutil
+import struct
+import tarfile
+import logging
 import pathlib
+import functools
+import hashlib
+import posixpath
 import asyncio.subprocess
 import tempfile
+import collections
 
+import attr
 
-async def build_archive(config):
+from harborpilot import filelock
+from harborpilot import dockerignore
+from harborpilot.config import SYMLINKS_REJECT, SYMLINKS_INTERNAL
+
+
+log = logging.getLogger(__name__)
+
+
+async def build_archive(config, *, mirror_cache=None):
     """
     Create a tar archive of a Docker build context retrieved from
     a Git repository.
@@ -17,24 +36,40 @@ async def build_archive(config):
     Arguments:
         config (.config.GitDockerBuildContextConfig):
             The Git repo configuration to build the archive from.
-    """
-    with tempfile.TemporaryDirectory(suffix='.harborpilot') as clonedir:
-        try:
-            await _clone(config.remote, config.branch, clonedir)
-        except _ProcFailed as e:
-            e.config = config
-            raise e
 
+    Keyword Arguments:
+        mirror_cache (MirrorCache):
+            If given, the context is checked out from the cache's
+            mirror of the remote (fetching only what changed) instead
+            of from a fresh clone.
+    """
+    with tempfile.TemporaryDirectory(suffix='.harborpilot') as tempdir:
+        clonedir = os.path.join(tempdir, 'clone')
         try:
-            commit_hash = await _revparse(clonedir)
+            if mirror_cache is None:
+                await _clone(config.remote, config.branch, clonedir)
+                commit_hash = await _revparse(clonedir)
+            else:
+                async with mirror_cache.mirror(
+                        config.remote, config.branch) as mirror:
+                    commit_hash = mirror.commit_hash
+                    await _checkout(
+                        mirror.path,
+                        commit_hash,
+                        clonedir,
+                        index_file=os.path.join(tempdir, 'index'),
+                        relpath=config.context_relpath,
+                        partial=mirror.partial,
+                    )
         except _ProcFailed as e:
             e.config = config
             raise e
 
-        tar_root = config.remote / config.context_relpath
+        tar_root = os.path.join(clonedir, str(config.context_relpath))
         _, tar_file = tempfile.mkstemp(suffix='.harborpilot.tar')
         try:
-            await _archive(str(tar_root), tar_file)
+            await _archive(
+                str(tar_root), tar_file, symlinks=config.symlinks)
         except _ProcFailed as e:
             os.unlink(tar_file)
             e.config = config
@@ -47,6 +82,472 @@ async def build_archive(config):
         return (commit_hash, tar_file)
 
 
+def stream_archive(config, *, mirror_cache, timings=None):
+    """
+    Return an async context manager yielding a :class:`StreamedArchive`
+    of the Docker build context, read straight from the mirror of the
+    configured remote with nothing written to disk.
+
+    The mirror is kept from eviction until the block exits, so the
+    archive must be consumed inside it.
+
+    Arguments:
+        config (.config.GitDockerBuildContextConfig):
+            The Git repo configuration to build the archive from.
+
+    Keyword Arguments:
+        mirror_cache (MirrorCache):
+            The cache holding the mirror of the remote.
+        timings (dict):
+            If given, the seconds taken to ``'fetch'`` the mirror and to
+            ``'scan'`` the context's tree are stored in it.
+    """
+    return _StreamedArchiveLease(config, mirror_cache, timings)
+
+
+class StreamedArchive:
+    """
+    The tar data of a build context at a single commit.
+
+    Iterate over :meth:`chunks` (once) to receive the tar data as it's
+    produced. Paths excluded by the context's ``.dockerignore`` are left
+    out; without one, the archive comes straight from ``git archive``.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, config, git_dir, commit_hash, *, partial=False):
+        self.config = config
+        self.git_dir = git_dir
+        self.commit_hash = commit_hash
+        # Whether blobs may be missing from the repository
+        self.partial = partial
+        # Object IDs of the blobs in the context not fetched yet
+        self._missing = None
+        # .dockerignore.DockerIgnore, if the context has a .dockerignore
+        self.ignore = None
+        # (mode, type, object ID, path) of each included tree entry, in
+        # the order git lists them (directories before their contents).
+        self._entries = None
+
+    @property
+    def tree_ish(self):
+        relpath = str(self.config.context_relpath)
+        if relpath == '.':
+            relpath = ''
+        return '{0}:{1}'.format(self.commit_hash, relpath)
+
+    async def check_tree(self):
+        """
+        Raise :exc:`SymlinkDetected` if the context contains a symlink
+        that isn't excluded by its ``.dockerignore``, or with the
+        ``internal`` symlink policy, one pointing outside the context.
+        """
+        listing = await _run_git([
+            '--git-dir={0}'.format(self.git_dir),
+            'ls-tree', '-r', '-t', '-z', self.tree_ish,
+        ], ArchiveFailed)
+        entries = []
+        for entry in listing.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.split(b'\t', 1)
+            mode, object_type, object_id = info.decode('ascii').split(' ')
+            path = path.decode('utf-8', 'surrogateescape')
+            entries.append((mode, object_type, object_id, path))
+
+        for mode, object_type, object_id, path in entries:
+            if path == '.dockerignore' and object_type == 'blob':
+                text = await _run_git([
+                    '--git-dir={0}'.format(self.git_dir),
+                    'cat-file', 'blob', object_id,
+                ], ArchiveFailed)
+                self.ignore = dockerignore.DockerIgnore.from_text(
+                    text.decode('utf-8', 'replace'))
+                entries = list(_filter_entries(entries, self.ignore))
+                break
+
+        links = [
+            (object_id, path)
+            for mode, object_type, object_id, path in entries
+            if mode == SYMLINK_MODE
+        ]
+        if links and self.config.symlinks != SYMLINKS_INTERNAL:
+            raise SymlinkDetected('./' + links[0][1])
+        if links:
+            await self.prefetch([object_id for object_id, path in links])
+            targets = await _cat_blobs(
+                self.git_dir, [object_id for object_id, path in links])
+            for (object_id, path), target in zip(links, targets):
+                target = target.decode('utf-8', 'surrogateescape')
+                if not _symlink_inside(path, target):
+                    raise SymlinkDetected('./' + path)
+        self._entries = entries
+
+    async def object_id(self, path):
+        """
+        Return the Git object ID of ``path`` (relative to the context)
+        at this commit, or ``None`` if it doesn't exist.
+        """
+        try:
+            object_id = await _run_git([
+                '--git-dir={0}'.format(self.git_dir),
+                'rev-parse', '--verify', '--quiet',
+                '{0}:{1}'.format(
+                    self.commit_hash, self.config.context_relpath / path),
+            ], GitRevParseFailed)
+        except GitRevParseFailed:
+            return None
+        return object_id.decode('ascii')
+
+    @property
+    def entries(self):
+        """
+        ``(mode, type, object ID, path)`` of each entry in the archive,
+        in order, once :meth:`check_tree` has run.
+        """
+        return self._entries
+
+    async def commit_time(self):
+        """
+        Return the commit's timestamp, which every entry's mtime is set
+        to.
+        """
+        return int(await _run_git([
+            '--git-dir={0}'.format(self.git_dir),
+            'show', '-s', '--format=%ct', self.commit_hash,
+        ], ArchiveFailed))
+
+    async def chunks(self):
+        if self._entries is None:
+            await self.check_tree()
+        await self.prefetch([
+            object_id for mode, object_type, object_id, path in self._entries
+            if object_type == 'blob'
+        ])
+        if self.ignore is None:
+            chunks = self._git_archive_chunks()
+        else:
+            chunks = self._filtered_chunks()
+        async for chunk in chunks:
+            yield chunk
+
+    async def prefetch(self, object_ids):
+        """
+        Fetch whichever of the blobs ``object_ids`` are missing from a
+        partial mirror, all at once. Otherwise Git would fetch them one
+        by one as it reads them.
+        """
+        if not self.partial:
+            return
+        if self._missing is None:
+            self._missing = await _missing_objects(
+                self.git_dir, self.tree_ish)
+        wanted = [
+            object_id for object_id in object_ids
+            if object_id in self._missing
+        ]
+        if wanted:
+            await _fetch_objects(self.git_dir, wanted)
+            self._missing.difference_update(wanted)
+
+    async def _git_archive_chunks(self):
+        proc = await asyncio.create_subprocess_exec(
+            'git', '--git-dir={0}'.format(self.git_dir),
+            'archive', '--format=tar', self.tree_ish,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            while True:
+                chunk = await proc.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            stderr = await proc.stderr.read()
+            await proc.wait()
+            if proc.returncode != 0:
+                error = ArchiveFailed(proc.returncode, b'', stderr)
+                error.config = self.config
+                raise error
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+    async def _filtered_chunks(self):
+        """
+        Produce the tar data of just the included entries, with their
+        contents read from ``git cat-file --batch``, laid out like
+        ``git archive`` does.
+        """
+        mtime = await self.commit_time()
+        proc = await asyncio.create_subprocess_exec(
+            'git', '--git-dir={0}'.format(self.git_dir),
+            'cat-file', '--batch',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        blob_ids = [
+            object_id for mode, object_type, object_id, path in self._entries
+            if object_type == 'blob'
+        ]
+        # Fed from its own task, so a full stdout pipe can't block it.
+        feeder = asyncio.ensure_future(_feed_lines(proc.stdin, blob_ids))
+        buffer = bytearray()
+        try:
+            for mode, object_type, object_id, path in self._entries:
+                if object_type != 'blob':
+                    # Trees, and submodules which are left empty
+                    buffer += _tar_header(
+                        path, 0o775, mtime, type=tarfile.DIRTYPE)
+                    continue
+                header = await proc.stdout.readline()
+                fields = header.split()
+                if len(fields) != 3 or fields[1] != b'blob':
+                    raise ArchiveFailed(None, header, b'')
+                size = int(fields[2])
+                if mode == SYMLINK_MODE:
+                    target = await proc.stdout.readexactly(size + 1)
+                    buffer += _tar_header(
+                        path, 0o777, mtime, type=tarfile.SYMTYPE,
+                        linkname=target[:-1].decode(
+                            'utf-8', 'surrogateescape'),
+                    )
+                    continue
+                buffer += _tar_header(
+                    path, 0o775 if mode == '100755' else 0o664, mtime,
+                    size=size,
+                )
+                remaining = size
+                while remaining:
+                    data = await proc.stdout.readexactly(
+                        min(remaining, self.chunk_size))
+                    remaining -= len(data)
+                    buffer += data
+                    if len(buffer) >= self.chunk_size:
+                        yield bytes(buffer)
+                        buffer.clear()
+                await proc.stdout.readexactly(1)  # The newline after it
+                buffer += tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+            # End of archive, padded to a whole record like tar does
+            buffer += tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+            buffer += tarfile.NUL * (-len(buffer) % tarfile.RECORDSIZE)
+            yield bytes(buffer)
+            await feeder
+            await proc.wait()
+        except _ProcFailed as e:
+            e.config = self.config
+            raise e
+        except asyncio.IncompleteReadError:
+            stderr = await proc.stderr.read()
+            error = ArchiveFailed(proc.returncode, b'', stderr)
+            error.config = self.config
+            raise error
+        finally:
+            feeder.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+
+# Git's mode for symlinks in trees
+SYMLINK_MODE = '120000'
+
+
+async def _missing_objects(git_dir, tree_ish):
+    """
+    Return the set of IDs of the objects under ``tree_ish`` that a
+    partial clone hasn't fetched, without fetching them.
+    """
+    listing = await _run_git([
+        '--git-dir={0}'.format(git_dir),
+        'rev-list', '--objects', '--missing=print', '--no-object-names',
+        tree_ish,
+    ], ArchiveFailed)
+    return {
+        line[1:].decode('ascii')
+        for line in listing.splitlines() if line.startswith(b'?')
+    }
+
+
+async def _fetch_objects(git_dir, object_ids):
+    """
+    Fetch the objects ``object_ids`` from the origin of the partial
+    clone at ``git_dir`` in one request, as Git does when it fetches
+    missing objects itself.
+    """
+    log.debug('Fetching {0} objects into {1}'.format(
+        len(object_ids), git_dir))
+    proc = await asyncio.create_subprocess_exec(
+        'git', '--git-dir={0}'.format(git_dir),
+        '-c', 'fetch.negotiationAlgorithm=noop',
+        'fetch', '--quiet', '--no-tags', '--no-write-fetch-head',
+        '--recurse-submodules=no', '--filter=blob:none', '--stdin', 'origin',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdin = ''.join(object_id + '\n' for object_id in object_ids)
+    stdout, stderr = await proc.communicate(stdin.encode('ascii'))
+    if proc.returncode != 0:
+        raise GitFetchFailed(proc.returncode, stdout, stderr)
+
+
+async def _cat_blobs(git_dir, object_ids):
+    """
+    Return the contents of the blobs ``object_ids``, read in one go with
+    ``git cat-file --batch``.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        'git', '--git-dir={0}'.format(git_dir), 'cat-file', '--batch',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdin = ''.join(object_id + '\n' for object_id in object_ids)
+    stdout, stderr = await proc.communicate(stdin.encode('ascii'))
+    if proc.returncode != 0:
+        raise ArchiveFailed(proc.returncode, stdout, stderr)
+    contents = []
+    position = 0
+    for object_id in object_ids:
+        header_end = stdout.index(b'\n', position)
+        fields = stdout[position:header_end].split()
+        if len(fields) != 3 or fields[1] != b'blob':
+            raise ArchiveFailed(proc.returncode, stdout, stderr)
+        start = header_end + 1
+        end = start + int(fields[2])
+        contents.append(stdout[start:end])
+        position = end + 1
+    return contents
+
+
+def _filter_entries(entries, ignore):
+    """
+    Yield the tree ``entries`` not excluded by ``ignore``, checking each
+    against the patterns only once, given its directory's result.
+    """
+    dir_matches = {'': dockerignore.NO_MATCH}
+    pruned = None
+    for entry in entries:
+        mode, object_type, object_id, path = entry
+        if pruned is not None and path.startswith(pruned):
+            continue
+        match = ignore.match(path, dir_matches[posixpath.dirname(path)])
+        if object_type == 'tree':
+            if ignore.prunes(match):
+                pruned = path + '/'
+                continue
+            dir_matches[path] = match
+        if not ignore.excluded(match):
+            yield entry
+
+
+_USTAR = struct.Struct('100s8s8s8s12s12s8s1s100s8s32s32s8s8s155s12s')
+# The checksum of the fixed fields: uid, gid, magic and version, and the
+# checksum field itself counted as spaces
+_USTAR_CHECKSUM_BASE = sum(b'0000000\0' * 2 + b'ustar\x0000' + b' ' * 8)
+
+
+@functools.lru_cache(maxsize=1024)
+def _octal_field(value, digits):
+    """
+    Return a tar octal field and its checksum, remembered as most
+    entries share a handful of modes and modification times.
+    """
+    field = b'%0*o\0' % (digits, value)
+    return field, sum(field)
+
+
+def _tar_header(name, mode, mtime, *, type=tarfile.REGTYPE, size=0,
+                linkname=''):
+    """
+    Return the tar header block(s) for an entry owned by root.
+
+    Building a plain ustar header here is several times faster than
+    :meth:`tarfile.TarInfo.tobuf`, which is only used for the entries
+    ustar can't describe, like long or non-ASCII names.
+    """
+    if type == tarfile.DIRTYPE and not name.endswith('/'):
+        name += '/'
+    prefix = ''
+    if len(name) > 100:
+        # The first slash leaving at most 100 characters after it
+        split = name.find('/', len(name) - 101, len(name) - 1)
+        if 0 < split <= 155:
+            prefix, name = name[:split], name[split + 1:]
+    if (len(name) > 100 or len(linkname) > 100 or size >= 0o77777777777
+            or not (name.isascii() and linkname.isascii()
+                    and prefix.isascii())):
+        info = tarfile.TarInfo(prefix + '/' + name if prefix else name)
+        info.type = type
+        info.mode = mode
+        info.mtime = mtime
+        info.size = size
+        info.linkname = linkname
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+    name = name.encode('ascii')
+    mode, mode_checksum = _octal_field(mode, 7)
+    mtime, mtime_checksum = _octal_field(mtime, 11)
+    size = b'%011o\0' % size
+    # Summing the variable fields is quicker than the whole block
+    checksum = _USTAR_CHECKSUM_BASE + type[0] + sum(name) + sum(size) + (
+        mode_checksum + mtime_checksum)
+    if linkname or prefix:
+        linkname = linkname.encode('ascii')
+        prefix = prefix.encode('ascii')
+        checksum += sum(linkname) + sum(prefix)
+    else:
+        linkname = prefix = b''
+    return _USTAR.pack(
+        name, mode, b'0000000\0', b'0000000\0', size, mtime,
+        b'%06o\0 ' % checksum, type, linkname, b'ustar\x0000',
+        b'', b'', b'', b'', prefix, b'',
+    )
+
+
+async def _feed_lines(stream, lines, *, batch_size=1000):
+    for start in range(0, len(lines), batch_size):
+        batch = lines[start:start + batch_size]
+        stream.write(''.join(line + '\n' for line in batch).encode('ascii'))
+        await stream.drain()
+    stream.close()
+
+
+class _StreamedArchiveLease:
+    def __init__(self, config, mirror_cache, timings):
+        self._config = config
+        self._lease = mirror_cache.mirror(config.remote, config.branch)
+        self._timings = timings if timings is not None else {}
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        try:
+            mirror = await self._lease.__aenter__()
+        except _ProcFailed as e:
+            e.config = self._config
+            raise e
+        fetched = time.monotonic()
+        self._timings['fetch'] = fetched - started
+        archive = StreamedArchive(
+            self._config, mirror.path, mirror.commit_hash,
+            partial=mirror.partial,
+        )
+        try:
+            await archive.check_tree()
+            self._timings['scan'] = time.monotonic() - fetched
+        except BaseException as e:
+            if isinstance(e, _ProcFailed):
+                e.config = self._config
+            await self._lease.__aexit__(type(e), e, e.__traceback__)
+            raise
+        return archive
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._lease.__aexit__(exc_type, exc, tb)
+
+
 async def _clone(remote, branch, clonedir):
     """
     Clone the Git repo into ``clonedir``.
@@ -88,24 +589,574 @@ async def _revparse(clonedir):
     return stdout.strip().decode('ascii')
 
 
-async def _archive(tar_root, dest_file):
-    # TODO: Check that a Dockerfile exists in the tar root?
-    for dirpath, dirnames, filenames in os.walk(tar_root):
-        for filename in filenames:
-            link_path = os.path.join(dirpath, filename)
-            if os.path.islink(link_path):
-                relpath = os.path.relpath(link_path, tar_root)
-                raise SymlinkDetected('./' + relpath)
-    tar_args = ['tar', '-cf', dest_file, '-C', tar_root, '.']
+async def _checkout(
+        git_dir, commit_hash, work_tree, *, index_file, relpath='.',
+        partial=False
+    ):
+    """
+    Write the tree at ``relpath`` in ``commit_hash`` from the (bare)
+    repository at ``git_dir`` into the same path under ``work_tree``,
+    using ``index_file`` as a scratch index so the repository itself
+    isn't modified.
+
+    If the repository is a ``partial`` clone, the blobs under
+    ``relpath`` are fetched first, in one go.
+    """
+    env = {'GIT_INDEX_FILE': str(index_file)}
+    git_args = [
+        '--git-dir={0}'.format(git_dir),
+        '--work-tree={0}'.format(work_tree),
+    ]
+    relpath = str(relpath)
+    tree_ish = '{0}:{1}'.format(commit_hash, '' if relpath == '.' else relpath)
+    if partial:
+        missing = await _missing_objects(git_dir, tree_ish)
+        if missing:
+            await _fetch_objects(git_dir, sorted(missing))
+    os.makedirs(work_tree, exist_ok=True)
+    read_tree_args = ['read-tree']
+    if relpath != '.':
+        read_tree_args.append('--prefix={0}/'.format(relpath))
+    await _run_git(
+        git_args + read_tree_args + [tree_ish], GitCheckoutFailed, env=env)
+    await _run_git(
+        git_args + ['checkout-index', '--all'], GitCheckoutFailed, env=env)
+
+
+async def _run_git(git_args, error_class, *, env=None):
+    """
+    Run ``git`` with ``git_args`` and return its stripped stdout,
+    raising ``error_class`` (a :class:`_ProcFailed` subclass) if it
+    exits nonzero.
+
+    ``env``, if given, is a mapping of variables to add to the
+    parent's environment.
+    """
+    proc_env = None
+    if env is not None:
+        proc_env = os.environ.copy()
+        proc_env.update(env)
     proc = await asyncio.create_subprocess_exec(
-        *tar_args,
+        'git', *git_args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        env=proc_env,
     )
     stdout, stderr = await proc.communicate()
     if proc.returncode != 0:
-        raise ArchiveFailed(proc.returncode, stdout, stderr)
-    
+        raise error_class(proc.returncode, stdout, stderr)
+    return stdout.strip()
+
+
+@attr.s
+class Mirror:
+    # pathlib.Path, the bare repository's directory
+    path = attr.ib()
+    # str, the remote URL or path the mirror fetches from
+    remote = attr.ib()
+    # str, the branch that was fetched
+    branch = attr.ib()
+    # str, the commit hash at the tip of the branch after fetching
+    commit_hash = attr.ib()
+    # bool, whether blobs are only fetched when needed
+    partial = attr.ib(default=False)
+
+
+class MirrorCache:
+    """
+    A managed directory of bare Git mirrors, one per remote.
+
+    Instead of cloning for every build, the mirror for the remote is
+    brought up to date with a fetch of just the configured branch, and
+    the build reads from the mirror. Fetches for the same remote are
+    serialized. When the mirrors take up more than ``max_bytes``, the
+    least recently used ones that aren't in use are removed. Lock files
+    next to each mirror extend both to other HarborPilot processes
+    sharing ``root``.
+
+    Use :meth:`mirror` as an async context manager; the mirror won't
+    be evicted until the block exits.
+
+    With ``partial`` (the default), the fetch leaves out file contents
+    (``--filter=blob:none``), and archiving fetches just the blobs in
+    the build context. Remotes that don't support filtering send
+    everything as before.
+    """
+    def __init__(self, root, *, max_bytes=None, partial=True):
+        """
+        Arguments:
+            root (str or path-like):
+                The directory to keep mirrors in. Created if necessary.
+
+        Keyword Arguments:
+            max_bytes (int):
+                Total size of the mirrors to allow before evicting.
+                ``None`` disables eviction.
+            partial (bool):
+                Whether to fetch blobs only as they're needed.
+        """
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self.partial = partial
+        self._locks = collections.defaultdict(asyncio.Lock)
+        self._leases = collections.Counter()
+        self._sizes = None  # Lazily loaded: path -> size in bytes
+        self._last_used = {}  # path -> int, larger is more recent
+        self._use_counter = 0
+
+    def mirror_path(self, remote):
+        """
+        Return the directory used for the mirror of ``remote``.
+        """
+        digest = hashlib.sha256(remote.encode('utf-8')).hexdigest()
+        return self.root / digest
+
+    def mirror(self, remote, branch):
+        """
+        Return an async context manager that updates the mirror of
+        ``remote`` to the tip of ``branch`` and yields a :class:`Mirror`.
+        """
+        return _MirrorLease(self, remote, branch)
+
+    def _lock_path(self, path, purpose):
+        return self.root / '{0}.{1}.lock'.format(path.name, purpose)
+
+    async def _update(self, remote, branch):
+        path = self.mirror_path(remote)
+        fetch_lock = filelock.FileLock(self._lock_path(path, 'fetch'))
+        async with self._locks[path], fetch_lock:
+            if not (path / 'HEAD').exists():
+                await self._create(path, remote)
+            ref = 'refs/heads/{0}'.format(branch)
+            fetch_args = ['fetch', '--depth=1', '--no-tags', '--quiet']
+            if self.partial:
+                # Also marks the mirror as a partial clone of origin, so
+                # missing blobs can be fetched later.
+                fetch_args.append('--filter=blob:none')
+            await _run_git([
+                '--git-dir={0}'.format(path),
+            ] + fetch_args + ['origin', '+{0}:{0}'.format(ref)],
+                GitFetchFailed)
+            commit_hash = await _run_git([
+                '--git-dir={0}'.format(path),
+                'rev-parse', '--verify', ref + '^{commit}',
+            ], GitRevParseFailed)
+        return Mirror(
+            path=path,
+            remote=remote,
+            branch=branch,
+            commit_hash=commit_hash.decode('ascii'),
+            partial=self.partial,
+        )
+
+    async def _create(self, path, remote):
+        log.debug('Creating mirror of {0!r} at {1}'.format(remote, path))
+        self.root.mkdir(parents=True, exist_ok=True)
+        try:
+            await _run_git(
+                ['init', '--bare', '--quiet', str(path)], GitFetchFailed)
+            for key, value in [
+                    ('remote.origin.url', remote),
+                    # Objects of a build in progress must not disappear
+                    # from under it.
+                    ('gc.auto', '0'),
+                ]:
+                await _run_git([
+                    '--git-dir={0}'.format(path), 'config', key, value,
+                ], GitFetchFailed)
+        except:
+            shutil.rmtree(str(path), ignore_errors=True)
+            raise
+
+    def _acquire(self, path):
+        self._leases[path] += 1
+        self._touch(path)
+
+    async def _release(self, path):
+        self._leases[path] -= 1
+        if not self._leases[path]:
+            del self._leases[path]
+        self._touch(path)
+        if self.max_bytes is not None:
+            await self._evict(path)
+
+    def _touch(self, path):
+        self._use_counter += 1
+        self._last_used[path] = self._use_counter
+
+    async def _evict(self, updated_path):
+        """
+        Remeasure ``updated_path`` and remove least recently used
+        mirrors until the total size is within ``max_bytes``.
+        """
+        loop = asyncio.get_event_loop()
+        if self._sizes is None:
+            self._sizes = await loop.run_in_executor(
+                None, _measure_mirrors, self.root)
+        if updated_path.is_dir():
+            self._sizes[updated_path] = await loop.run_in_executor(
+                None, _directory_size, updated_path)
+        candidates = sorted(
+            self._sizes, key=lambda p: self._last_used.get(p, 0))
+        for path in candidates:
+            if sum(self._sizes.values()) <= self.max_bytes:
+                break
+            if path in self._leases:
+                continue
+            async with self._locks[path]:
+                # A build may have started using it while waiting.
+                if path in self._leases or path not in self._sizes:
+                    continue
+                if not path.is_dir():
+                    # Evicted by another process
+                    del self._sizes[path]
+                    continue
+                use_lock = filelock.FileLock(self._lock_path(path, 'use'))
+                if not use_lock.try_acquire():
+                    # In use by another process
+                    continue
+                try:
+                    log.info('Evicting mirror {0}'.format(path))
+                    await loop.run_in_executor(
+                        None, shutil.rmtree, str(path), True)
+                finally:
+                    use_lock.release()
+                del self._sizes[path]
+                self._last_used.pop(path, None)
+
+
+class _MirrorLease:
+    def __init__(self, cache, remote, branch):
+        self._cache = cache
+        self._remote = remote
+        self._branch = branch
+        self._path = cache.mirror_path(remote)
+        # Held shared while the mirror is in use, so other processes
+        # don't evict it
+        self._use_lock = filelock.FileLock(
+            cache._lock_path(self._path, 'use'), shared=True)
+
+    async def __aenter__(self):
+        self._cache._acquire(self._path)
+        try:
+            await self._use_lock.acquire()
+            return await self._cache._update(self._remote, self._branch)
+        except:
+            self._use_lock.release()
+            await self._cache._release(self._path)
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._use_lock.release()
+        await self._cache._release(self._path)
+
+
+def _measure_mirrors(root):
+    """
+    Return a dict of mirror directory path -> size for the mirrors
+    already in ``root``.
+    """
+    if not root.is_dir():
+        return {}
+    return {
+        path: _directory_size(path)
+        for path in root.iterdir()
+        if path.is_dir()
+    }
+
+
+def _directory_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+async def _archive(tar_root, dest_file, *, symlinks=SYMLINKS_REJECT):
+    """
+    Write a tar archive of the directory ``tar_root`` to ``dest_file``,
+    leaving out what its ``.dockerignore`` excludes.
+
+    Raises :exc:`SymlinkDetected` for any included symlink, unless
+    ``symlinks`` is ``SYMLINKS_INTERNAL`` and its target is inside
+    ``tar_root``.
+    """
+    # TODO: Check that a Dockerfile exists in the tar root?
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(
+        None, _write_tar, tar_root, dest_file, symlinks)
+
+
+def _write_tar(tar_root, dest_file, symlinks):
+    """
+    Write the archive for :func:`_archive` in a single pass over the
+    tree with :func:`os.scandir`, which gives the file type of each
+    entry without another system call.
+    """
+    ignore = None
+    ignore_path = os.path.join(tar_root, '.dockerignore')
+    if os.path.isfile(ignore_path):
+        with open(ignore_path, encoding='utf-8', errors='replace') as f:
+            ignore = dockerignore.DockerIgnore.from_text(f.read())
+    with open(dest_file, 'wb', buffering=0) as dest:
+        writer = TarWriter(dest)
+        root_stat = os.stat(tar_root)
+        writer.add(
+            '.', root_stat.st_mode & 0o7777, int(root_stat.st_mtime),
+            type=tarfile.DIRTYPE,
+        )
+        # (directory path, path relative to tar_root, its ignore match)
+        stack = [(tar_root, '', dockerignore.NO_MATCH)]
+        while stack:
+            dirpath, reldir, dir_match = stack.pop()
+            # Entries are looked at relative to their directory, which
+            # spares the kernel walking the whole path for each of them
+            dir_fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                subdirs = _write_tar_directory(
+                    writer, dir_fd, dirpath, reldir, dir_match, ignore,
+                    symlinks,
+                )
+            finally:
+                os.close(dir_fd)
+            # Reversed, so they're popped in name order
+            stack.extend(reversed(subdirs))
+        writer.close()
+
+
+def _write_tar_directory(writer, dir_fd, dirpath, reldir, dir_match, ignore,
+                         symlinks):
+    """
+    Add the entries of the directory open as ``dir_fd`` for
+    :func:`_write_tar`, returning the subdirectories to go into.
+    """
+    with os.scandir(dir_fd) as scan:
+        entries = sorted(scan, key=lambda entry: entry.name)
+    subdirs = []
+    for entry in entries:
+        relpath = reldir + entry.name
+        is_dir = entry.is_dir(follow_symlinks=False)
+        match = dockerignore.NO_MATCH
+        if ignore is not None:
+            match = ignore.match(relpath, dir_match)
+            if is_dir and ignore.prunes(match):
+                continue
+        if is_dir:
+            subdirs.append(
+                (os.path.join(dirpath, entry.name), relpath + '/', match))
+        if ignore is not None and ignore.excluded(match):
+            continue
+        entry_stat = entry.stat(follow_symlinks=False)
+        name = './' + relpath
+        file_type = stat.S_IFMT(entry_stat.st_mode)
+        mode = entry_stat.st_mode & 0o7777
+        mtime = int(entry_stat.st_mtime)
+        # Most likely first
+        if file_type == stat.S_IFREG:
+            writer.add(
+                name, mode, mtime,
+                size=entry_stat.st_size, path=entry.name, dir_fd=dir_fd,
+            )
+        elif file_type == stat.S_IFDIR:
+            writer.add(name, mode, mtime, type=tarfile.DIRTYPE)
+        elif file_type == stat.S_IFLNK:
+            target = os.readlink(entry.name, dir_fd=dir_fd)
+            if (symlinks != SYMLINKS_INTERNAL
+                    or not _symlink_inside(relpath, target)):
+                raise SymlinkDetected(name)
+            writer.add(
+                name, mode, mtime,
+                type=tarfile.SYMTYPE, linkname=target,
+            )
+        else:
+            log.debug('Leaving special file {0} out of archive'.format(
+                os.path.join(dirpath, entry.name)))
+    return subdirs
+
+
+class TarWriter:
+    """
+    Writes tar entries to the unbuffered file ``dest``, collecting small
+    ones into large writes and copying file contents in the kernel where
+    it can.
+
+    Each ``add`` method returns the offset in ``dest`` where the entry's
+    contents start, so they can be copied out again later.
+    """
+    buffer_size = 1024 * 1024
+    # Files at least this big are copied with copy_file_range/sendfile
+    copy_threshold = 64 * 1024
+
+    def __init__(self, dest):
+        self._dest = dest
+        self._buffer = bytearray()
+        # Counted here rather than asked of dest, which would be another
+        # system call for every entry
+        self._flushed = dest.tell()
+
+    @property
+    def position(self):
+        """
+        The offset in ``dest`` of the next byte written.
+        """
+        return self._flushed + len(self._buffer)
+
+    def add(self, name, mode, mtime, *, path=None, dir_fd=None, size=0,
+            **kwargs):
+        """
+        Add an entry, with the contents of the file at ``path`` if
+        given, which is relative to the directory ``dir_fd`` if that is
+        given too. The other arguments are those of :func:`_tar_header`.
+        """
+        buffer = self._buffer
+        buffer += _tar_header(name, mode, mtime, size=size, **kwargs)
+        offset = self._flushed + len(buffer)
+        if path is None:
+            self._pad(size)
+            return offset
+        # Plain descriptors, file objects add up for many small files
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            if size < self.copy_threshold:
+                # Inline, as this is most of the entries in most trees
+                data = os.read(fd, size)
+                if len(data) != size:
+                    self._check_size(name, size, len(data))
+                buffer += data
+                buffer += tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+                if len(buffer) >= self.buffer_size:
+                    self._flush()
+                return offset
+            self._flush()
+            self._copy(fd, name, size)
+        finally:
+            os.close(fd)
+        self._pad(size)
+        return offset
+
+    def add_range(self, name, mode, mtime, source_fd, source_offset, size):
+        """
+        Add a file entry with the ``size`` bytes at ``source_offset`` in
+        the open file ``source_fd`` as its contents.
+        """
+        self._buffer += _tar_header(name, mode, mtime, size=size)
+        offset = self.position
+        if size < self.copy_threshold:
+            data = os.pread(source_fd, size, source_offset)
+            self._check_size(source_fd, size, len(data))
+            self._buffer += data
+        else:
+            self._flush()
+            self._copy(source_fd, source_fd, size, source_offset)
+        self._pad(size)
+        return offset
+
+    def add_stream(self, name, mode, mtime, stream, size):
+        """
+        Add a file entry with the next ``size`` bytes read from the
+        binary file object ``stream`` as its contents.
+        """
+        self._buffer += _tar_header(name, mode, mtime, size=size)
+        offset = self.position
+        remaining = size
+        while remaining:
+            data = stream.read(min(remaining, self.buffer_size))
+            if not data:
+                break
+            self._buffer += data
+            remaining -= len(data)
+            if len(self._buffer) >= self.buffer_size:
+                self._flush()
+        self._check_size(stream, size, size - remaining)
+        self._pad(size)
+        return offset
+
+    def close(self):
+        self._buffer += tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        self._buffer += tarfile.NUL * (-self.position % tarfile.RECORDSIZE)
+        self._flush()
+
+    def _pad(self, size):
+        self._buffer += tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        view = memoryview(self._buffer)
+        while view:
+            written = self._dest.write(view)
+            self._flushed += written
+            view = view[written:]
+        view.release()
+        self._buffer.clear()
+
+    def _copy(self, source_fd, path, size, source_offset=None):
+        """
+        Copy ``size`` bytes from ``source_fd``, from ``source_offset``
+        or else its current position.
+        """
+        dest_fd = self._dest.fileno()
+        copied = 0
+        try:
+            while copied < size:
+                count = _kernel_copy(
+                    source_fd, dest_fd, size - copied,
+                    None if source_offset is None
+                    else source_offset + copied,
+                )
+                if not count:
+                    break
+                copied += count
+                self._flushed += count
+        except OSError:
+            # Not supported between these files; copy what's left by hand
+            while copied < size:
+                count = min(size - copied, self.buffer_size)
+                if source_offset is None:
+                    data = os.read(source_fd, count)
+                else:
+                    data = os.pread(source_fd, count, source_offset + copied)
+                if not data:
+                    break
+                self._buffer += data
+                copied += len(data)
+                self._flush()
+        self._check_size(path, size, copied)
+
+    @staticmethod
+    def _check_size(path, expected, actual):
+        if actual != expected:
+            raise ArchiveFailed(
+                None, b'',
+                '{0} changed size while being archived'.format(path).encode(
+                    'utf-8', 'surrogateescape'),
+            )
+
+
+if hasattr(os, 'copy_file_range'):
+    def _kernel_copy(source_fd, dest_fd, count, source_offset=None):
+        return os.copy_file_range(
+            source_fd, dest_fd, count, offset_src=source_offset)
+else:  # pragma: no cover
+    def _kernel_copy(source_fd, dest_fd, count, source_offset=None):
+        return os.sendfile(dest_fd, source_fd, source_offset, count)
+
+
+def _symlink_inside(relpath, target):
+    """
+    Return whether the symlink at ``relpath`` (relative to the context)
+    pointing at ``target`` stays inside the context.
+    """
+    if posixpath.isabs(target):
+        return False
+    resolved = posixpath.normpath(
+        posixpath.join(posixpath.dirname(relpath), target))
+    return resolved != '..' and not resolved.startswith('../')
+
 
 # To clone just the tip of the branch:
 #   git clone --depth=1 --branch=$BRANCH $REMOTE $DESTDIR
@@ -140,6 +1191,14 @@ class GitRevParseFailed(_ProcFailed):
     pass
 
 
+class GitFetchFailed(_ProcFailed):
+    pass
+
+
+class GitCheckoutFailed(_ProcFailed):
+    pass
+
+
 class ArchiveFailed(_ProcFailed):
     pass
 
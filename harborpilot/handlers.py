@@ -1,62 +1,418 @@
-import os
+import re
+import json
+import time
 import logging
 
 from aiohttp import web as aweb
 
 from harborpilot import docker
-from harborpilot import git
+from harborpilot import scheduler
+from harborpilot import history
+from harborpilot import logstore
+from harborpilot import metrics
+from harborpilot import workers
 
 
 log = logging.getLogger(__name__)
 
 
 class ImagePushHookReceiver:
-    def __init__(self, client_session, image_build_configs):
-        self._client = client_session
+    """
+    With ``worker`` (a :class:`.workers.Worker`), requests that belong
+    to another worker are forwarded to it: pushes for builds it's
+    running, and requests about builds it has in memory.
+
+    With ``trace_recorder`` (a :class:`.trace.TraceRecorder`), build
+    requests are recorded in its trace where they're handled.
+    """
+    def __init__(
+            self, build_coordinator, image_build_configs, *,
+            build_history=None, log_store=None, worker=None,
+            trace_recorder=None
+        ):
+        self._coordinator = build_coordinator
+        self._configs = image_build_configs
+        self._history = build_history
+        self._log_store = log_store
+        self._worker = worker
+        self._trace_recorder = trace_recorder
+
+    def update_configs(self, image_build_configs):
+        """
+        Serve ``image_build_configs`` from now on. Builds already
+        started keep the config they started with.
+        """
         self._configs = image_build_configs
 
     async def build_image_from_git(self, request):
         # TODO: Verify credentials and permission (before the handler maybe?)
         # TODO: Get the image details from the DB or conf or whatever
+        arrived = time.time()
         build_name = request.match_info['build_name']
         image_build_config = self._configs.get(build_name)
         if image_build_config is None:
             raise aweb.HTTPNotFound()
 
-        # Do the git dance and make a tarball
-        log.debug('Using config {0}'.format(image_build_config))
-        log.debug('Building archive')
-        commit_hash, tarball_path = await git.build_archive(image_build_config.git)
+        if self._worker is not None:
+            owner = self._worker.shared_state.claim(
+                build_name, image_build_config.git.branch)
+            if owner != self._worker.index and not workers.is_forwarded(
+                    request):
+                return await self._worker.forward(request, owner)
+
+        # Concurrent requests for the same build share one build, which
+        # runs on its own; the client checks on it with the returned URLs.
         try:
-            with open(tarball_path, 'rb') as archive:
-                # TODO: Trap known exceptions and provide a reasonable explanation
-                #       in an error (500?) response.
-                log.debug('Sending archive to Docker')
-                # TODO: Label properly with commit hash and configured tag
-                build = docker.ImageBuild(
-                    self._client,
-                    archive=archive,
-                    image_name=image_build_config.image_name,
-                )
-                try:
-                    await build.start()
-                except docker.BuildNotAccepted as e:
-                    raise aweb.HTTPInternalServerError(
-                        text='Docker did not accept the build: {0}:{1}'.format(
-                            e.reason, e.status_code)
-                    )
-        finally:
-            os.remove(tarball_path)
+            build = self._coordinator.submit(image_build_config)
+        except scheduler.QueueFull as e:
+            if self._trace_recorder is not None:
+                self._trace_recorder.request(
+                    build_name, arrived, aweb.HTTPServiceUnavailable.status)
+            raise aweb.HTTPServiceUnavailable(
+                headers={'Retry-After': str(e.retry_after)},
+                text='Too many builds queued ({0}), try again later'.format(
+                    e.queued),
+            )
+
+        status_url = request.app.router['build_status'].url_for(
+            build_name=build_name, build_id=build.build_id)
+        log_url = request.app.router['build_log'].url_for(
+            build_name=build_name, build_id=build.build_id)
+        body = build.describe()
+        body['status_url'] = str(status_url)
+        body['log_url'] = str(log_url)
+        if self._trace_recorder is not None:
+            self._trace_recorder.request(
+                build_name, arrived, 202, build.build_id)
+        return aweb.json_response(
+            body,
+            status=202,
+            headers={'Location': str(status_url)},
+        )
+
+    async def get_build_status(self, request):
+        build_name = request.match_info['build_name']
+        build_id = request.match_info['build_id']
+        build = self._coordinator.get(build_name, build_id)
+        if build is not None:
+            return aweb.json_response(build.describe())
+        response = await self._forward_to_owner(request, build_id)
+        if response is not None:
+            return response
+        # Builds that are no longer retained may still be in the history
+        if self._history is not None:
+            row = await self._history.get(build_id)
+            if row is not None and row['build_name'] == build_name:
+                return aweb.json_response(history.describe_row(row))
+        raise aweb.HTTPNotFound()
+
+    async def get_build_history(self, request):
+        """
+        Send the recorded builds of a build name, newest first.
+
+        The query parameters are ``limit`` (default 50, at most 500),
+        ``commit`` to only include builds of a commit hash, and
+        ``before``, a timestamp for paging through older builds, with
+        ``before_id`` to include those created at the same time with
+        lower build IDs. The ``next`` URL in the response continues
+        where this page ends, and is null on the last page.
+        """
+        build_name = request.match_info['build_name']
+        if build_name not in self._configs or self._history is None:
+            raise aweb.HTTPNotFound()
+        limit = _parse_int_param(request.query, 'limit', 50)
+        if not 1 <= limit <= 500:
+            raise aweb.HTTPBadRequest(text='limit must be from 1 to 500')
+        before = request.query.get('before')
+        if before is not None:
+            try:
+                before = float(before)
+            except ValueError:
+                raise aweb.HTTPBadRequest(text='before must be a number')
+        before_id = request.query.get('before_id')
+        commit = request.query.get('commit')
+        rows = await self._history.query(
+            build_name, limit=limit, before=before, before_id=before_id,
+            commit=commit,
+        )
+        next_url = None
+        if len(rows) == limit:
+            query = dict(request.query)
+            query['before'] = repr(rows[-1]['created_at'])
+            # Builds can share a timestamp, so it's not enough alone
+            query['before_id'] = rows[-1]['build_id']
+            next_url = str(request.rel_url.with_query(query))
+        return aweb.json_response({
+            'builds': [history.describe_row(row) for row in rows],
+            'next': next_url,
+        })
+
+    async def get_build_log(self, request):
+        """
+        Send the build's output from the ``offset`` query parameter
+        (default 0) onward, or its last ``tail`` bytes, limited to
+        ``length`` bytes if given. With ``follow=1``, keep sending until
+        the build ends; otherwise send what's there now, with the offset
+        to resume from in the ``X-Next-Offset`` header.
+
+        Output no longer kept in memory is read from the log store.
+        """
+        build_name = request.match_info['build_name']
+        build_id = request.match_info['build_id']
+        build = self._coordinator.get(build_name, build_id)
+        if build is None:
+            response = await self._forward_to_owner(request, build_id)
+            if response is not None:
+                return response
+            return await self._get_stored_build_log(
+                request, build_name, build_id)
+        offset, length = _parse_log_range(request.query, len(build.output))
+        follow = request.query.get('follow', '0') not in ('', '0', 'false')
+
+        output = build.output
+        # Everything is in the store, if there is one.
+        start_offset = 0 if output.log_writer is not None else (
+            output.start_offset)
+        if not follow:
+            if offset < output.start_offset and output.log_writer is not None:
+                data = await output.log_writer.read(offset, length)
+                if not data and length != 0:
+                    # The store no longer has it, so skip to what's kept
+                    # in memory rather than answer with the same offset.
+                    offset = output.start_offset
+                    data = output.read(offset)[:length]
+            else:
+                data = output.read(offset)[:length]
+            next_offset = max(offset, start_offset) + len(data)
+            return aweb.Response(
+                body=data,
+                content_type='text/plain',
+                headers={
+                    'X-Next-Offset': str(next_offset),
+                    'X-Log-Start-Offset': str(start_offset),
+                    'X-Build-Status': build.status,
+                },
+            )
+
+        response = aweb.StreamResponse(
+            headers={'X-Log-Start-Offset': str(start_offset)})
+        response.content_type = 'text/plain'
+        await response.prepare(request)
+        async for chunk in output.follow(offset):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    async def _get_stored_build_log(self, request, build_name, build_id):
+        if self._log_store is None:
+            raise aweb.HTTPNotFound()
+        try:
+            size = await self._log_store.size(build_name, build_id)
+            if size is None:
+                raise aweb.HTTPNotFound()
+            offset, length = _parse_log_range(request.query, size)
+            data = await self._log_store.read(
+                build_name, build_id, offset, length)
+        except logstore.LogStoreError as e:
+            log.warning(str(e))
+            raise aweb.HTTPNotFound()
+        if data is None:
+            # Removed since its size was looked up
+            raise aweb.HTTPNotFound()
+        headers = {
+            'X-Next-Offset': str(offset + len(data)),
+            'X-Log-Start-Offset': '0',
+        }
+        if self._history is not None:
+            row = await self._history.get(build_id)
+            if row is not None:
+                headers['X-Build-Status'] = row['status']
+        return aweb.Response(
+            body=data,
+            content_type='text/plain',
+            headers=headers,
+        )
+
+    async def get_build_events(self, request):
+        """
+        Send the build's live output as Server-Sent Events.
 
-        # The Docker engine accepted the build, so send the stream messages
-        # it provides out to the client.
-        response = aweb.StreamResponse()
+        Each ``log`` event's ID is the byte offset its data ends at, so a
+        reconnecting client resumes with ``Last-Event-ID`` (or the
+        ``offset`` query parameter). Output this client was too slow for,
+        or that's no longer buffered, is reported with a ``gap`` event,
+        and an ``end`` event carries the build's final description.
+        """
+        build = self._get_build(request)
+        if build is None:
+            return await self._forward_or_not_found(request)
+        offset = _parse_offset(
+            request.headers.get('Last-Event-ID')
+            or request.query.get('offset', '0'))
+        response = aweb.StreamResponse(headers={'Cache-Control': 'no-cache'})
+        response.content_type = 'text/event-stream'
         await response.prepare(request)
-        build_message_consumer = docker.StreamOnlyConsumer(writeable=response)
-        await build.dispatch_messages(build_message_consumer)
-        # Maybe record the build results somewhere? This would be another
-        # consumer though.
-        # TODO: Need some way of detecting if the build actually completed
-        #       successfully or not.
+        subscription = build.broadcast.subscribe(offset)
+        try:
+            async for event in subscription:
+                if isinstance(event, docker.LogGap):
+                    await response.write(_sse_event(
+                        'gap',
+                        json.dumps({'offset': event.offset, 'end': event.end}),
+                        event_id=event.end,
+                    ))
+                else:
+                    await response.write(_sse_event(
+                        'log',
+                        event.data.decode('utf-8', errors='replace'),
+                        event_id=event.end,
+                    ))
+            # The stream ends a little before the build does.
+            await build.wait_done()
+            await response.write(
+                _sse_event('end', json.dumps(build.describe())))
+        finally:
+            subscription.close()
         await response.write_eof()
         return response
+
+    async def get_build_websocket(self, request):
+        """
+        Send the build's live output over a WebSocket, as JSON text
+        messages: ``{"offset": ..., "data": ...}`` for output,
+        ``{"gap": {"offset": ..., "end": ...}}`` for skipped output and
+        ``{"end": <build description>}`` before closing.
+        """
+        build = self._get_build(request)
+        if build is None:
+            return await self._forward_or_not_found(request)
+        offset = _parse_offset(request.query.get('offset', '0'))
+        ws = aweb.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        subscription = build.broadcast.subscribe(offset)
+        try:
+            async for event in subscription:
+                if ws.closed:
+                    break
+                if isinstance(event, docker.LogGap):
+                    message = {
+                        'gap': {'offset': event.offset, 'end': event.end},
+                    }
+                else:
+                    message = {
+                        'offset': event.offset,
+                        'data': event.data.decode('utf-8', errors='replace'),
+                    }
+                await ws.send_str(json.dumps(message))
+            if not ws.closed:
+                await build.wait_done()
+                await ws.send_str(json.dumps({'end': build.describe()}))
+        finally:
+            subscription.close()
+            await ws.close()
+        return ws
+
+    def _get_build(self, request):
+        return self._coordinator.get(
+            request.match_info['build_name'],
+            request.match_info['build_id'],
+        )
+
+    async def _forward_to_owner(self, request, build_id):
+        """
+        Return the response of the worker that has ``build_id`` in
+        memory, or ``None`` if that isn't another worker.
+        """
+        if self._worker is None or workers.is_forwarded(request):
+            return None
+        owner = self._worker.shared_state.locate(build_id)
+        if owner is None or owner == self._worker.index:
+            return None
+        return await self._worker.forward(request, owner)
+
+    async def _forward_or_not_found(self, request):
+        response = await self._forward_to_owner(
+            request, request.match_info['build_id'])
+        if response is None:
+            raise aweb.HTTPNotFound()
+        return response
+
+
+def _parse_offset(value, name='offset'):
+    try:
+        offset = int(value)
+    except ValueError:
+        raise aweb.HTTPBadRequest(text='{0} must be an integer'.format(name))
+    if offset < 0:
+        raise aweb.HTTPBadRequest(
+            text='{0} must not be negative'.format(name))
+    return offset
+
+
+def _parse_log_range(query, size):
+    """
+    Return the offset and length (or None) of the part of a log of
+    ``size`` bytes asked for by the ``offset``, ``tail`` and ``length``
+    query parameters.
+    """
+    if 'tail' in query:
+        tail = _parse_offset(query['tail'], 'tail')
+        offset = max(size - tail, 0)
+    else:
+        offset = _parse_offset(query.get('offset', '0'))
+    length = None
+    if 'length' in query:
+        length = _parse_offset(query['length'], 'length')
+    return offset, length
+
+
+def _parse_int_param(query, name, default):
+    value = query.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise aweb.HTTPBadRequest(text='{0} must be an integer'.format(name))
+
+
+_LINE_END = re.compile(r'\r\n|\r|\n')
+
+
+def _sse_event(event_type, data, *, event_id=None):
+    lines = ['event: ' + event_type]
+    if event_id is not None:
+        lines.append('id: {0}'.format(event_id))
+    # Each of these ends a line in an event stream, progress output's
+    # bare carriage returns included; clients see them as newlines.
+    lines.extend('data: ' + line for line in _LINE_END.split(data))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class SchedulerStatus:
+    def __init__(self, build_scheduler):
+        self._scheduler = build_scheduler
+
+    async def get_status(self, request):
+        return aweb.json_response(self._scheduler.stats())
+
+
+class MetricsExporter:
+    """
+    With ``worker`` (a :class:`.workers.Worker`), the other workers'
+    metrics are included too, told apart by their ``worker`` label.
+    """
+    def __init__(self, registry, *, worker=None):
+        self._registry = registry
+        self._worker = worker
+
+    async def get_metrics(self, request):
+        text = self._registry.render()
+        if self._worker is not None and not workers.is_forwarded(request):
+            others = await self._worker.gather(request.rel_url.path)
+            text = metrics.merge(
+                [text] + [body.decode('utf-8') for body in others])
+        return aweb.Response(
+            body=text.encode('utf-8'),
+            headers={'Content-Type': metrics.CONTENT_TYPE},
+        )
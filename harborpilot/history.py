@@ -0,0 +1,285 @@
+"""
+A record of finished builds, kept in SQLite.
+"""
+import sqlite3
+import asyncio
+import logging
+import pathlib
+import concurrent.futures
+
+from harborpilot import builds
+
+
+log = logging.getLogger(__name__)
+
+
+_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS builds (
+        id INTEGER PRIMARY KEY,
+        build_id TEXT NOT NULL UNIQUE,
+        build_name TEXT NOT NULL,
+        commit_hash TEXT,
+        status TEXT NOT NULL,
+        image_id TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        queue_wait_seconds REAL,
+        fetch_seconds REAL,
+        scan_seconds REAL,
+        archive_seconds REAL,
+        accept_seconds REAL,
+        stream_seconds REAL
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS builds_by_name_time
+    ON builds (build_name, created_at)
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS builds_by_commit
+    ON builds (commit_hash)
+    ''',
+]
+
+# Columns in the order of insertion, after id.
+COLUMNS = [
+    'build_id',
+    'build_name',
+    'commit_hash',
+    'status',
+    'image_id',
+    'error',
+    'created_at',
+    'started_at',
+    'finished_at',
+    'queue_wait_seconds',
+    'fetch_seconds',
+    'scan_seconds',
+    'archive_seconds',
+    'accept_seconds',
+    'stream_seconds',
+]
+
+_PHASES = ['fetch', 'scan', 'archive', 'accept', 'stream']
+
+# Statuses of builds that left a usable image
+_GOOD_STATUSES = ['succeeded', 'reused']
+
+
+def build_row(build):
+    """
+    Return the history row (a dict) for a finished
+    :class:`.builds.Build`.
+    """
+    row = {
+        'build_id': build.build_id,
+        'build_name': build.build_name,
+        'commit_hash': build.commit_hash,
+        'status': build.status,
+        'image_id': build.image_id,
+        'error': build.error,
+        'created_at': build.created_at,
+        'started_at': build.started_at,
+        'finished_at': build.finished_at,
+        'queue_wait_seconds': build.ticket.wait_seconds,
+    }
+    for phase in _PHASES:
+        row[phase + '_seconds'] = build.phase_seconds.get(phase)
+    return row
+
+
+def describe_row(row):
+    """
+    Return a JSON-serializable dict describing the build in ``row``,
+    in the shape of :meth:`.builds.Build.describe`.
+    """
+    description = {
+        column: row[column] for column in COLUMNS
+        if not column.endswith('_seconds') and not column.endswith('_at')
+    }
+    for column in ['created_at', 'started_at', 'finished_at']:
+        description[column] = builds._isoformat(row[column])
+    description['queue_wait_seconds'] = row['queue_wait_seconds']
+    description['phase_seconds'] = {
+        phase: row[phase + '_seconds'] for phase in _PHASES
+        if row[phase + '_seconds'] is not None
+    }
+    return description
+
+
+class BuildHistory:
+    """
+    Finished builds, stored in an SQLite database in WAL mode.
+
+    All database access happens on one background thread, so the event
+    loop never waits on disk. Rows passed to :meth:`record` are buffered
+    and written in one transaction per ``flush_interval`` seconds (or
+    every ``flush_rows`` rows), rather than one per build.
+    """
+    flush_interval = 1.0
+    flush_rows = 100
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='harborpilot-history')
+        self._connection = None
+        self._pending = []
+        self._flush_handle = None
+        self._closed = False
+
+    def record(self, row):
+        """
+        Queue ``row`` (see :func:`build_row`) to be written.
+        """
+        if self._closed:
+            log.warning('Build history closed, not recording {0}'.format(
+                row['build_id']))
+            return
+        self._pending.append(row)
+        if len(self._pending) >= self.flush_rows:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(
+                self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Start writing the queued rows, returning a future for when
+        they're written.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        rows, self._pending = self._pending, []
+        future = self._submit(self._insert, rows)
+        future.add_done_callback(_log_failure)
+        return future
+
+    async def query(self, build_name, *, limit=50, before=None,
+                    before_id=None, commit=None):
+        """
+        Return up to ``limit`` rows for ``build_name``, newest first,
+        those created at the same time in descending order of build ID.
+
+        Keyword Arguments:
+            before (float):
+                Only return builds created before this timestamp, for
+                paging through older builds.
+            before_id (str):
+                With ``before``, also return the builds created at that
+                time with IDs before this one: those of the last row of
+                the previous page, so none are skipped.
+            commit (str):
+                Only return builds of this commit hash.
+        """
+        self.flush()
+        return await self._submit(
+            self._select, build_name, limit, before, before_id, commit)
+
+    async def last_image(self, build_name):
+        """
+        Return the ID of the image of the newest build of
+        ``build_name`` that succeeded or reused one, or ``None``.
+        """
+        self.flush()
+        return await self._submit(self._select_last_image, build_name)
+
+    async def get(self, build_id):
+        """
+        Return the row for ``build_id``, or ``None``.
+        """
+        self.flush()
+        return await self._submit(self._select_one, build_id)
+
+    async def close(self):
+        if self._closed:
+            return
+        await self.flush()
+        self._closed = True
+        await self._submit(self._close_connection)
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, function, *args)
+
+    # The rest run on the executor's thread.
+
+    def _connect(self):
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path))
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            # With WAL, this is still safe against corruption, only the
+            # last transactions may be lost in a power failure.
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+            self._connection = connection
+        return self._connection
+
+    def _insert(self, rows):
+        if not rows:
+            return
+        connection = self._connect()
+        statement = 'INSERT OR REPLACE INTO builds ({0}) VALUES ({1})'.format(
+            ', '.join(COLUMNS),
+            ', '.join(':' + column for column in COLUMNS),
+        )
+        with connection:
+            connection.executemany(statement, rows)
+
+    def _select(self, build_name, limit, before, before_id, commit):
+        clauses = ['build_name = ?']
+        params = [build_name]
+        if before is not None and before_id is not None:
+            clauses.append(
+                '(created_at < ? OR (created_at = ? AND build_id < ?))')
+            params.extend([before, before, before_id])
+        elif before is not None:
+            clauses.append('created_at < ?')
+            params.append(before)
+        if commit is not None:
+            clauses.append('commit_hash = ?')
+            params.append(commit)
+        params.append(limit)
+        statement = (
+            'SELECT {0} FROM builds WHERE {1} '
+            'ORDER BY created_at DESC, build_id DESC LIMIT ?'
+        ).format(', '.join(COLUMNS), ' AND '.join(clauses))
+        cursor = self._connect().execute(statement, params)
+        return [dict(row) for row in cursor]
+
+    def _select_last_image(self, build_name):
+        statement = (
+            'SELECT image_id FROM builds '
+            'WHERE build_name = ? AND image_id IS NOT NULL '
+            'AND status IN (?, ?) '
+            'ORDER BY created_at DESC LIMIT 1'
+        )
+        row = self._connect().execute(
+            statement, [build_name] + _GOOD_STATUSES).fetchone()
+        return row['image_id'] if row is not None else None
+
+    def _select_one(self, build_id):
+        statement = 'SELECT {0} FROM builds WHERE build_id = ?'.format(
+            ', '.join(COLUMNS))
+        row = self._connect().execute(statement, [build_id]).fetchone()
+        return dict(row) if row is not None else None
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error('Failed to write build history', exc_info=future.exception())
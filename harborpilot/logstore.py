@@ -0,0 +1,418 @@
+"""
+Build output kept on disk, compressed in independently readable chunks.
+
+Each build's output is two files in the store's directory:
+
+``<build_id>.log``
+    The output split into chunks of about :attr:`LogStore.chunk_size`
+    bytes, each compressed on its own and appended in order.
+
+``<build_id>.idx``
+    A header naming the codec and build name, followed by one fixed
+    size entry per chunk giving its offset and length in both the
+    output and the ``.log`` file.
+
+Reading a byte range only has to decompress the chunks covering it, so
+the tail of a large log is as cheap to get as the head.
+
+While a log is being written, its writer holds an ``flock`` of
+``<build_id>.lock``, so no worker sharing the directory removes it.
+"""
+import time
+import zlib
+import struct
+import asyncio
+import bisect
+import logging
+import pathlib
+import concurrent.futures
+
+from harborpilot import filelock
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+log = logging.getLogger(__name__)
+
+
+_MAGIC = b'HPLOG\x01'
+# codec ID, length of the build name
+_HEADER = struct.Struct('>BH')
+# output offset, .log file offset, output length, compressed length
+_ENTRY = struct.Struct('>QQII')
+
+_CODEC_ZLIB = 0
+_CODEC_ZSTD = 1
+
+
+class LogStoreError(Exception):
+    def __init__(self, build_id, reason):
+        self.build_id = build_id
+        self.reason = reason
+
+    def __str__(self):
+        return 'Bad stored log for build {0}: {1}'.format(
+            self.build_id, self.reason)
+
+
+def _compressor(codec):
+    if codec == _CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress
+    return lambda data: zlib.compress(data, 6)
+
+
+def _decompressor(codec, build_id):
+    if codec == _CODEC_ZSTD:
+        if zstandard is None:
+            raise LogStoreError(build_id, 'zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress
+    if codec == _CODEC_ZLIB:
+        return zlib.decompress
+    raise LogStoreError(build_id, 'unknown codec {0}'.format(codec))
+
+
+class LogStore:
+    """
+    A directory of build logs, with the oldest removed once they're more
+    than ``max_age_seconds`` old or take up more than ``max_total_bytes``.
+
+    All file access happens on one background thread. Since that thread
+    runs jobs in order, a read always sees every chunk written before it
+    was asked for.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, root, *, max_age_seconds=None, max_total_bytes=None):
+        self.root = pathlib.Path(root)
+        self.max_age_seconds = max_age_seconds
+        self.max_total_bytes = max_total_bytes
+        self.codec = _CODEC_ZSTD if zstandard is not None else _CODEC_ZLIB
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='harborpilot-logstore')
+        self._writers = {}  # build_id -> open LogWriter
+
+    def open_writer(self, build_name, build_id):
+        """
+        Return a new :class:`LogWriter` for the output of ``build_id``.
+        """
+        writer = LogWriter(self, build_name, build_id)
+        self._writers[build_id] = writer
+        return writer
+
+    async def size(self, build_name, build_id):
+        """
+        Return the number of bytes of output stored for ``build_id``, or
+        ``None`` if there's no log of ``build_name`` by that ID.
+        """
+        writer = self._writers.get(build_id)
+        if writer is not None:
+            return len(writer) if writer.build_name == build_name else None
+        index = await self._submit(self._load_index, build_name, build_id)
+        return None if index is None else index.size
+
+    async def read(self, build_name, build_id, offset=0, length=None):
+        """
+        Return up to ``length`` bytes (or all) of the output of
+        ``build_id`` from byte ``offset`` onward, or ``None`` if there's
+        no log of ``build_name`` by that ID.
+
+        For a build still being written, fewer bytes than there are come
+        back if its stored log was removed or cut short.
+        """
+        writer = self._writers.get(build_id)
+        if writer is None:
+            return await self._submit(
+                self._read, build_name, build_id, offset, length)
+        if writer.build_name != build_name:
+            return None
+        end = len(writer) if length is None else offset + length
+        # What the writer hasn't handed over yet is only in its buffer.
+        buffered = writer.buffered(offset, end)
+        data = b''
+        if offset < writer.submitted:
+            stored_length = min(end, writer.submitted) - offset
+            data = await self._submit(
+                self._read, build_name, build_id, offset, stored_length)
+            if data is None or len(data) < stored_length:
+                # The rest wouldn't follow on from it.
+                return data or b''
+        return data + buffered
+
+    def evict(self):
+        """
+        Start removing logs past the age or size limits, returning a
+        future for when that's done.
+        """
+        return self._submit(self._evict, set(self._writers))
+
+    async def close(self):
+        for writer in list(self._writers.values()):
+            writer.close()
+        await self._submit(lambda: None)
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, function, *args)
+
+    def _paths(self, build_id):
+        return (
+            self.root / (build_id + '.log'),
+            self.root / (build_id + '.idx'),
+        )
+
+    def _lock(self, build_id):
+        return filelock.FileLock(self.root / (build_id + '.lock'))
+
+    # The rest run on the executor's thread.
+
+    def _load_index(self, build_name, build_id):
+        log_path, index_path = self._paths(build_id)
+        try:
+            with index_path.open('rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        index = _Index.parse(build_id, raw)
+        if index.build_name != build_name:
+            return None
+        return index
+
+    def _read(self, build_name, build_id, offset, length):
+        index = self._load_index(build_name, build_id)
+        if index is None:
+            return None
+        end = index.size
+        if length is not None:
+            end = min(end, offset + length)
+        if offset >= end:
+            return b''
+        decompress = _decompressor(index.codec, build_id)
+        pieces = []
+        log_path, index_path = self._paths(build_id)
+        try:
+            f = log_path.open('rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            for entry in index.entries_between(offset, end):
+                chunk_offset, file_offset, chunk_length, compressed_length = (
+                    entry)
+                f.seek(file_offset)
+                chunk = decompress(f.read(compressed_length))
+                if len(chunk) != chunk_length:
+                    raise LogStoreError(build_id, 'truncated chunk')
+                pieces.append(chunk[
+                    max(offset - chunk_offset, 0):end - chunk_offset])
+        return b''.join(pieces)
+
+    def _evict(self, open_build_ids):
+        try:
+            paths = list(self.root.glob('*.idx'))
+        except FileNotFoundError:
+            return
+        logs = []
+        for index_path in paths:
+            build_id = index_path.stem
+            if build_id in open_build_ids:
+                continue
+            log_path = index_path.with_suffix('.log')
+            try:
+                stat = index_path.stat()
+                size = stat.st_size + log_path.stat().st_size
+            except FileNotFoundError:
+                continue
+            logs.append((stat.st_mtime, size, build_id))
+        logs.sort()
+        total = sum(size for mtime, size, build_id in logs)
+        cutoff = None
+        if self.max_age_seconds is not None:
+            cutoff = time.time() - self.max_age_seconds
+        for mtime, size, build_id in logs:
+            too_old = cutoff is not None and mtime < cutoff
+            too_big = (
+                self.max_total_bytes is not None
+                and total > self.max_total_bytes
+            )
+            if not (too_old or too_big):
+                break
+            lock = self._lock(build_id)
+            if not lock.try_acquire():
+                # Still being written, by another worker
+                continue
+            try:
+                log.info('Removing stored log of build {0}'.format(
+                    build_id))
+                for path in self._paths(build_id) + (lock.path,):
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+            finally:
+                lock.release()
+            total -= size
+
+
+class _Index:
+    def __init__(self, codec, build_name, entries):
+        self.codec = codec
+        self.build_name = build_name
+        self.entries = entries
+        self._offsets = [entry[0] for entry in entries]
+
+    @classmethod
+    def parse(cls, build_id, raw):
+        if not raw.startswith(_MAGIC):
+            raise LogStoreError(build_id, 'not a log index')
+        position = len(_MAGIC)
+        codec, name_length = _HEADER.unpack_from(raw, position)
+        position += _HEADER.size
+        build_name = raw[position:position + name_length].decode('utf-8')
+        position += name_length
+        entries = [
+            _ENTRY.unpack_from(raw, entry_position)
+            for entry_position in range(
+                # A partly written last entry is ignored
+                position, len(raw) - _ENTRY.size + 1, _ENTRY.size)
+        ]
+        return cls(codec, build_name, entries)
+
+    @staticmethod
+    def header(codec, build_name):
+        name = build_name.encode('utf-8')
+        return _MAGIC + _HEADER.pack(codec, len(name)) + name
+
+    @property
+    def size(self):
+        if not self.entries:
+            return 0
+        last = self.entries[-1]
+        return last[0] + last[2]
+
+    def entries_between(self, offset, end):
+        first = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        for entry in self.entries[first:]:
+            if entry[0] >= end:
+                break
+            yield entry
+
+
+class LogWriter:
+    """
+    Appends a build's output to a :class:`LogStore`.
+
+    Output is buffered until there's a chunk's worth, which is then
+    compressed and written on the store's thread, so :meth:`write` never
+    blocks.
+    """
+    def __init__(self, store, build_name, build_id):
+        self.build_name = build_name
+        self.build_id = build_id
+        self._store = store
+        self._buffer = bytearray()
+        # Bytes handed to the store's thread so far
+        self.submitted = 0
+        # File offset of the next chunk, only used on the store's thread
+        self._file_offset = 0
+        self._compress = _compressor(store.codec)
+        self._closed = False
+        self._lock = store._lock(build_id)
+        store._submit(self._take_lock)
+
+    def __len__(self):
+        return self.submitted + len(self._buffer)
+
+    def write(self, data):
+        if self._closed:
+            raise Exception('Cannot write after close() called')
+        self._buffer += data
+        chunk_size = self._store.chunk_size
+        if len(self._buffer) >= chunk_size:
+            whole = len(self._buffer) - len(self._buffer) % chunk_size
+            chunks = [
+                bytes(self._buffer[start:start + chunk_size])
+                for start in range(0, whole, chunk_size)
+            ]
+            del self._buffer[:whole]
+            self._submit_chunks(chunks)
+
+    def buffered(self, offset, end):
+        """
+        Return the bytes between ``offset`` and ``end`` that haven't
+        been handed to the store's thread yet.
+        """
+        start = max(offset - self.submitted, 0)
+        return bytes(self._buffer[start:max(end - self.submitted, 0)])
+
+    async def read(self, offset, length=None):
+        """
+        Return up to ``length`` bytes (or all) of the output written so
+        far from byte ``offset`` onward; fewer, or none, if the stored
+        log was removed or damaged.
+        """
+        try:
+            data = await self._store.read(
+                self.build_name, self.build_id, offset, length)
+        except LogStoreError as e:
+            log.warning(str(e))
+            return b''
+        return data or b''
+
+    def close(self):
+        """
+        Write out the rest of the output, returning a future for when
+        it's on disk.
+        """
+        if self._closed:
+            return self._store._submit(lambda: None)
+        self._closed = True
+        chunks = [bytes(self._buffer)] if self._buffer else []
+        self._buffer = bytearray()
+        future = self._submit_chunks(chunks, True)
+        del self._store._writers[self.build_id]
+        self._store.evict()
+        return future
+
+    def _submit_chunks(self, chunks, last=False):
+        offset = self.submitted
+        self.submitted += sum(len(chunk) for chunk in chunks)
+        return self._store._submit(self._write_chunks, offset, chunks, last)
+
+    def _take_lock(self):
+        # Runs on the store's thread, before any chunk is written
+        if not self._lock.try_acquire():
+            log.warning('Stored log of build {0} is locked elsewhere'.format(
+                self.build_id))
+
+    def _write_chunks(self, offset, chunks, last):
+        # Runs on the store's thread
+        try:
+            self._write_chunk_files(offset, chunks)
+        finally:
+            if last:
+                self._lock.release()
+
+    def _write_chunk_files(self, offset, chunks):
+        log_path, index_path = self._store._paths(self.build_id)
+        if offset == 0:
+            self._store.root.mkdir(parents=True, exist_ok=True)
+            with index_path.open('wb') as f:
+                f.write(_Index.header(self._store.codec, self.build_name))
+            log_path.touch()
+        entries = []
+        compressed = []
+        for chunk in chunks:
+            data = self._compress(chunk)
+            entries.append(_ENTRY.pack(
+                offset, self._file_offset, len(chunk), len(data)))
+            compressed.append(data)
+            offset += len(chunk)
+            self._file_offset += len(data)
+        # The chunks go in before the index entries pointing at them.
+        with log_path.open('ab') as f:
+            f.write(b''.join(compressed))
+        with index_path.open('ab') as f:
+            f.write(b''.join(entries))
@@ -0,0 +1,336 @@
+"""
+Counters, gauges and histograms, exported in the Prometheus text format.
+
+Updating a metric is a dict lookup and an addition or two, cheap enough
+to do per build or per batch of messages. Anything that's already
+counted elsewhere, like the scheduler's queue, is read when the metrics
+are rendered instead.
+"""
+import time
+import bisect
+import asyncio
+import logging
+import collections
+
+
+log = logging.getLogger(__name__)
+
+
+# Seconds, from a fast cache hit up to a long build
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Registry:
+    """
+    A set of metrics to render together. Every sample gets the labels
+    in the dict ``const_labels`` too, if given.
+    """
+    def __init__(self, *, const_labels=None):
+        self.const_labels = tuple(sorted((const_labels or {}).items()))
+        self._metrics = []
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), *, function=None):
+        return self._add(Gauge(name, help_text, labelnames, function=function))
+
+    def histogram(
+            self, name, help_text, labelnames=(), *,
+            buckets=DEFAULT_BUCKETS
+        ):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """
+        Return all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {0} {1}'.format(
+                metric.name, _escape_help(metric.help_text)))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        metric.const_labels = self.const_labels
+        self._metrics.append(metric)
+        return metric
+
+
+def merge(texts):
+    """
+    Return the metrics rendered by several registries as one text, with
+    the samples of each metric together after its HELP and TYPE lines.
+    The registries' samples must be told apart by their const labels.
+    """
+    # Metric name -> (HELP and TYPE lines, sample lines)
+    families = collections.OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                family[1].append(line)
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        # Pairs of label name and value added to every sample
+        self.const_labels = ()
+        self._values = {}  # tuple of label values -> value
+
+    def _check_labels(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('{0} takes labels {1}, got {2!r}'.format(
+                self.name, self.labelnames, labels))
+
+    def _sample(self, suffix, labels, value, extra=()):
+        pairs = (
+            list(self.const_labels)
+            + list(zip(self.labelnames, labels))
+            + list(extra)
+        )
+        label_text = ''
+        if pairs:
+            label_text = '{' + ','.join(
+                '{0}="{1}"'.format(name, _escape_label(value))
+                for name, value in pairs
+            ) + '}'
+        return '{0}{1}{2} {3}'.format(
+            self.name, suffix, label_text, _format_value(value))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """
+        Add ``amount`` to the count for the tuple of label values
+        ``labels``.
+        """
+        try:
+            self._values[labels] += amount
+        except KeyError:
+            self._check_labels(labels)
+            self._values[labels] = amount
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self._sample('', labels, value)
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, either set directly or, if
+    ``function`` is given, the dict of label values tuples to values it
+    returns when rendered.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames, *, function=None):
+        super().__init__(name, help_text, labelnames)
+        self._function = function
+
+    def set(self, value, labels=()):
+        self._check_labels(labels)
+        self._values[labels] = value
+
+    def samples(self):
+        values = self._values
+        if self._function is not None:
+            values = self._function()
+        for labels, value in sorted(values.items()):
+            yield self._sample('', labels, value)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames, buckets):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """
+        Record ``value`` for the tuple of label values ``labels``.
+        """
+        try:
+            counts = self._values[labels]
+        except KeyError:
+            self._check_labels(labels)
+            # One count per bucket, then +Inf, then the sum
+            counts = self._values[labels] = [0] * (len(self.buckets) + 1)
+            counts.append(0.0)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self._sample(
+                    '_bucket', labels, cumulative,
+                    extra=[('le', _format_value(bound))],
+                )
+            yield self._sample('_sum', labels, counts[-1])
+            yield self._sample('_count', labels, cumulative)
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\n', '\\n')
+        .replace('"', '\\"')
+    )
+
+
+class BuildMetrics:
+    """
+    The metrics HarborPilot exports about builds, in ``registry``.
+
+    Gauges for the scheduler's running and queued builds read
+    ``build_scheduler`` when rendered, and those for each engine read
+    ``engine_pool`` (a :class:`.docker.EnginePool`), if given.
+    """
+    def __init__(self, registry, build_scheduler, *, engine_pool=None):
+        self.builds = registry.counter(
+            'harborpilot_builds_total',
+            'Builds finished, by build name and final status.',
+            ['build_name', 'status'],
+        )
+        self.phase_seconds = registry.histogram(
+            'harborpilot_build_phase_seconds',
+            'Time spent in each phase of a build.',
+            ['build_name', 'phase'],
+        )
+        self.queue_wait_seconds = registry.histogram(
+            'harborpilot_build_queue_wait_seconds',
+            'Time builds waited for a slot to run in.',
+            ['build_name'],
+        )
+        self.context_bytes = registry.counter(
+            'harborpilot_build_context_bytes_total',
+            'Bytes of build context sent to the engine.',
+            ['build_name'],
+        )
+        self.log_bytes = registry.counter(
+            'harborpilot_build_log_bytes_total',
+            'Bytes of build output received.',
+            ['build_name'],
+        )
+        registry.gauge(
+            'harborpilot_builds_running',
+            'Builds running now.',
+            function=lambda: {(): build_scheduler.running},
+        )
+        registry.gauge(
+            'harborpilot_builds_queued',
+            'Builds waiting in the queue for a slot to run in.',
+            function=lambda: {(): build_scheduler.queued},
+        )
+        if engine_pool is not None:
+            registry.gauge(
+                'harborpilot_engine_up',
+                'Whether the engine passed its last health check.',
+                ['engine'],
+                function=lambda: {
+                    (engine.name,): int(engine.healthy)
+                    for engine in engine_pool.engines
+                },
+            )
+            registry.gauge(
+                'harborpilot_engine_builds_active',
+                'Builds placed on the engine and not finished yet.',
+                ['engine'],
+                function=lambda: {
+                    (engine.name,): engine.active_builds
+                    for engine in engine_pool.engines
+                },
+            )
+        self.loop_lag_seconds = registry.histogram(
+            'harborpilot_event_loop_lag_seconds',
+            'How late the event loop ran a callback scheduled to run at '
+            'a given time.',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+        )
+
+    def build_finished(self, build):
+        """
+        Record the finished :class:`.builds.Build` ``build``.
+        """
+        build_name = build.build_name
+        self.builds.inc((build_name, build.status))
+        for phase, seconds in build.phase_seconds.items():
+            self.phase_seconds.observe(seconds, (build_name, phase))
+        if build.ticket.wait_seconds is not None:
+            self.queue_wait_seconds.observe(
+                build.ticket.wait_seconds, (build_name,))
+        self.context_bytes.inc((build_name,), build.context_bytes)
+        self.log_bytes.inc((build_name,), len(build.output))
+
+
+class LoopLagMonitor:
+    """
+    Measures how far behind the event loop is running, by sleeping for
+    ``interval`` seconds at a time and recording how much longer than
+    that it took to wake up in the ``histogram``.
+    """
+    def __init__(self, histogram, *, interval=0.5):
+        self.histogram = histogram
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - started - self.interval
+            self.histogram.observe(max(lag, 0.0))
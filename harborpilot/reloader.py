@@ -0,0 +1,134 @@
+"""
+Reloading the configuration file while HarborPilot runs.
+"""
+import signal
+import asyncio
+import logging
+import pathlib
+
+import attr
+import yaml
+import marshmallow as mm
+
+from harborpilot import config
+from harborpilot import configfiles
+
+
+log = logging.getLogger(__name__)
+
+
+class ConfigReloader:
+    """
+    Keeps :attr:`config` up to date with the file at ``path`` it was
+    read from (``current``, a :class:`.config.HarborPilotConfig`).
+
+    The file is read again on SIGHUP, and when it or a file in its
+    ``builds_dir`` changes, which is checked every ``poll_interval``
+    seconds (unless that's ``None``).
+    A file that doesn't load or validate is logged and otherwise
+    ignored, keeping the current config. A valid one replaces it, and
+    is passed to each of :attr:`listeners`.
+
+    Only the builds can change without a restart; changes to the other
+    settings are logged and left for the next one.
+    """
+    def __init__(self, path, current, *, poll_interval=2.0):
+        self.path = pathlib.Path(path)
+        self.config = current
+        self.poll_interval = poll_interval
+        # Callables taking the new config
+        self.listeners = []
+        self._lock = asyncio.Lock()
+        self._file_state = self._stat()
+        self._poll_task = None
+        self._signals = False
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGHUP, self._reload_soon)
+        self._signals = True
+        if self.poll_interval is not None:
+            self._poll_task = asyncio.ensure_future(self._poll())
+
+    async def stop(self):
+        if self._signals:
+            asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+            self._signals = False
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+    async def reload(self):
+        """
+        Read the file again, and return whether its config was applied.
+        """
+        async with self._lock:
+            # Taken first, so changes made while reading aren't missed
+            self._file_state = self._stat()
+            loop = asyncio.get_event_loop()
+            try:
+                new = await loop.run_in_executor(
+                    None, configfiles.load, self.path)
+            except (OSError, yaml.YAMLError, mm.ValidationError) as e:
+                log.error(
+                    'Keeping the current config, {0} is bad: {1}'.format(
+                        self.path, e))
+                return False
+            old, self.config = self.config, new
+            _log_changes(self.path, old, new)
+            for listener in self.listeners:
+                listener(new)
+            return True
+
+    def _reload_soon(self):
+        log.info('Reloading {0} on SIGHUP'.format(self.path))
+        task = asyncio.ensure_future(self.reload())
+        task.add_done_callback(self._log_failure)
+
+    def _log_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error(
+                'Failed to reload {0}'.format(self.path),
+                exc_info=task.exception(),
+            )
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            # Whatever goes wrong, carry on watching for the next change
+            try:
+                if self._stat() != self._file_state:
+                    log.info('Reloading {0}, it changed'.format(self.path))
+                    await self.reload()
+            except Exception:
+                log.exception('Failed to reload {0}'.format(self.path))
+
+    def _stat(self):
+        return configfiles.file_states(self.path, self.config.builds_dir)
+
+
+def _log_changes(path, old, new):
+    added = sorted(set(new.builds) - set(old.builds))
+    removed = sorted(set(old.builds) - set(new.builds))
+    changed = sorted(
+        build_name for build_name in set(old.builds) & set(new.builds)
+        if old.builds[build_name] != new.builds[build_name]
+    )
+    log.info(
+        'Reloaded {0}, builds added: {1}; changed: {2}; removed: {3}'.format(
+            path,
+            ', '.join(added) or 'none',
+            ', '.join(changed) or 'none',
+            ', '.join(removed) or 'none',
+        ))
+    for field in attr.fields(config.HarborPilotConfig):
+        if field.name in ('builds', 'builds_dir'):
+            continue
+        if getattr(old, field.name) != getattr(new, field.name):
+            log.warning(
+                'The {0} setting changed, but only takes effect on '
+                'restart'.format(field.name))
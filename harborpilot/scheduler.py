@@ -0,0 +1,272 @@
+"""
+Limiting how many builds run at once.
+"""
+import math
+import time
+import uuid
+import asyncio
+import logging
+import collections
+
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    def __init__(self, queued, retry_after):
+        self.queued = queued
+        # int, suggested number of seconds before trying again
+        self.retry_after = retry_after
+
+    def __str__(self):
+        fmt = '{class_name}(queued={queued!r}, retry_after={retry_after!r})'
+        return fmt.format(
+            class_name=type(self).__name__,
+            queued=self.queued,
+            retry_after=self.retry_after,
+        )
+
+
+class BuildScheduler:
+    """
+    Hands out slots for running builds, with a global limit and a limit
+    per build name, and a bounded queue for builds waiting on a slot.
+
+    Waiting builds are served by build name in least recently served
+    order, so a storm of pushes for one build can't starve the others.
+
+    Reserve a :class:`Ticket` with :meth:`reserve` when a build is
+    requested (this is where :exc:`QueueFull` is raised), then use the
+    ticket as an async context manager around running the build.
+
+    With ``shared_state`` (a :class:`.workers.SharedState`), the limits
+    are for all the workers sharing it together, and tickets also need
+    a slot there to run. Since other workers don't say when they free
+    one, waiting tickets check again every ``poll_interval`` seconds.
+    Fairness is still by build name, but only among this worker's
+    tickets.
+    """
+    # Number of recent waits and run times to keep for statistics.
+    history_size = 100
+    poll_interval = 0.5
+
+    def __init__(
+            self, *, max_concurrent, max_per_build, max_queued,
+            shared_state=None
+        ):
+        self.max_concurrent = max_concurrent
+        self.max_per_build = max_per_build
+        self.max_queued = max_queued
+        self._shared = shared_state
+        self._poll_handle = None
+        self._reserved = 0
+        self._waiting = {}  # build_name -> deque of Ticket
+        self._running = collections.Counter()  # build_name -> count
+        self._last_served = {}  # build_name -> _total_started when served
+        self._recent_waits = collections.deque(maxlen=self.history_size)
+        self._recent_runs = collections.deque(maxlen=self.history_size)
+        self._total_started = 0
+
+    @property
+    def running(self):
+        """
+        The number of builds running, in this worker.
+        """
+        return sum(self._running.values())
+
+    @property
+    def queued(self):
+        """
+        The number of builds waiting for a slot, in this worker.
+        """
+        return self._reserved
+
+    def reserve(self, build_name):
+        """
+        Return a :class:`Ticket` holding a place in the queue for a
+        build of ``build_name``, or raise :exc:`QueueFull`.
+        """
+        ticket_id = uuid.uuid4().hex
+        if self._shared is None:
+            if self._reserved >= self.max_queued:
+                raise QueueFull(
+                    self._reserved, self._estimate_retry_after())
+        elif not self._shared.reserve_ticket(
+                ticket_id, build_name, self.max_queued):
+            running, waiting = self._shared.ticket_counts()
+            raise QueueFull(
+                sum(waiting.values()), self._estimate_retry_after())
+        self._reserved += 1
+        return Ticket(self, build_name, ticket_id)
+
+    def stats(self):
+        """
+        Return a JSON-serializable dict describing the queue. With
+        shared state, the counts are for all the workers, and the wait
+        statistics for this one.
+        """
+        waits = sorted(self._recent_waits)
+        if self._shared is None:
+            running_by_build = dict(self._running)
+            waiting_by_build = {
+                build_name: len(tickets)
+                for build_name, tickets in self._waiting.items()
+            }
+            running, queued = self.running, self.queued
+        else:
+            running_by_build, waiting_by_build = self._shared.ticket_counts()
+            running = sum(running_by_build.values())
+            queued = sum(waiting_by_build.values())
+        return {
+            'running': running,
+            'queued': queued,
+            'max_concurrent': self.max_concurrent,
+            'max_per_build': self.max_per_build,
+            'max_queued': self.max_queued,
+            'running_by_build': running_by_build,
+            'waiting_by_build': waiting_by_build,
+            'total_started': self._total_started,
+            'recent_wait_seconds': {
+                'count': len(waits),
+                'mean': sum(waits) / len(waits) if waits else 0.0,
+                'p50': _percentile(waits, 0.5),
+                'p95': _percentile(waits, 0.95),
+                'max': waits[-1] if waits else 0.0,
+            },
+        }
+
+    def _estimate_retry_after(self):
+        if self._recent_runs:
+            mean_run = sum(self._recent_runs) / len(self._recent_runs)
+        else:
+            mean_run = 30.0
+        batches = self._reserved / max(self.max_concurrent, 1)
+        return max(1, int(math.ceil(mean_run * batches)))
+
+    def _enqueue(self, ticket):
+        self._waiting.setdefault(ticket.build_name, collections.deque())
+        self._waiting[ticket.build_name].append(ticket)
+        self._dispatch()
+
+    def _cancel(self, ticket):
+        tickets = self._waiting.get(ticket.build_name)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[ticket.build_name]
+
+    def _unreserve(self):
+        self._reserved -= 1
+
+    def _forget(self, ticket):
+        if self._shared is not None:
+            self._shared.remove_ticket(ticket.ticket_id)
+
+    def _release(self, ticket):
+        self._running[ticket.build_name] -= 1
+        if not self._running[ticket.build_name]:
+            del self._running[ticket.build_name]
+        self._recent_runs.append(ticket.run_seconds)
+        self._forget(ticket)
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Start waiting tickets while there are free slots, each time
+        picking the eligible build name that was served least recently.
+        """
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
+        # Build names with no shared slot free
+        blocked = set()
+        while self.running < self.max_concurrent:
+            eligible = [
+                build_name for build_name in self._waiting
+                if self._running[build_name] < self.max_per_build
+                and build_name not in blocked
+            ]
+            if not eligible:
+                break
+            build_name = min(
+                eligible, key=lambda name: self._last_served.get(name, -1))
+            tickets = self._waiting[build_name]
+            if self._shared is not None and not self._shared.start_ticket(
+                    tickets[0].ticket_id, build_name,
+                    self.max_concurrent, self.max_per_build):
+                blocked.add(build_name)
+                continue
+            ticket = tickets.popleft()
+            if not tickets:
+                del self._waiting[build_name]
+            self._running[build_name] += 1
+            self._total_started += 1
+            self._last_served[build_name] = self._total_started
+            self._recent_waits.append(ticket._grant())
+        if blocked:
+            loop = asyncio.get_event_loop()
+            self._poll_handle = loop.call_later(
+                self.poll_interval, self._dispatch)
+
+
+class Ticket:
+    """
+    A build's place in a :class:`BuildScheduler`.
+
+    ``async with ticket:`` waits for a slot and holds it for the block.
+    A ticket that's never entered must be given up with :meth:`cancel`.
+    """
+    def __init__(self, scheduler, build_name, ticket_id):
+        self.build_name = build_name
+        # str, identifies the ticket in the scheduler's shared state
+        self.ticket_id = ticket_id
+        # float seconds, set once the ticket gets a slot
+        self.wait_seconds = None
+        self.run_seconds = None
+        self._scheduler = scheduler
+        self._granted = asyncio.get_event_loop().create_future()
+        self._enqueued_at = None
+        self._started_at = None
+        self._finished = False
+
+    def cancel(self):
+        if not self._finished:
+            self._finished = True
+            self._scheduler._unreserve()
+            self._scheduler._forget(self)
+
+    async def __aenter__(self):
+        self._enqueued_at = time.monotonic()
+        self._scheduler._enqueue(self)
+        try:
+            await self._granted
+        except BaseException:
+            if self._granted.done() and not self._granted.cancelled():
+                self._release()
+            else:
+                self._scheduler._cancel(self)
+                self.cancel()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release()
+
+    def _grant(self):
+        self._started_at = time.monotonic()
+        self.wait_seconds = self._started_at - self._enqueued_at
+        self._finished = True
+        self._scheduler._unreserve()
+        self._granted.set_result(None)
+        return self.wait_seconds
+
+    def _release(self):
+        self.run_seconds = time.monotonic() - self._started_at
+        self._scheduler._release(self)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
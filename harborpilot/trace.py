@@ -0,0 +1,197 @@
+"""
+Recording the build requests HarborPilot receives, with their timing,
+and the engine output of the builds they start, to replay them later
+(see ``benchmarks/replay.py``).
+
+A trace is a gzip-compressed file of JSON lines, one event each. Every
+event has a ``type``, and a ``time`` in seconds since the epoch:
+
+``start``
+    First in each file, with the ``pid`` of the recording process and
+    the ``version`` of the format.
+
+``request``
+    A build request for ``build_name`` arrived, and was answered with
+    ``status`` (202, or 503 if the queue was full) for ``build_id``
+    (``null`` if refused).
+
+``stream``
+    The engine's response to the build ``build_id`` of ``build_name``,
+    as read: ``chunks`` is a list of [seconds since ``time``, text]
+    pairs, ``time`` being when the engine accepted the build. Only the
+    first ``max_stream_bytes`` are kept, ``truncated`` says whether
+    there were more.
+
+Events are written in batches, each batch a gzip member of its own, so
+a trace cut short by a crash is still readable up to the last batch.
+"""
+import os
+import gzip
+import json
+import time
+import codecs
+import asyncio
+import logging
+import pathlib
+import concurrent.futures
+
+
+log = logging.getLogger(__name__)
+
+
+TRACE_VERSION = 1
+
+
+def trace_path(state_dir):
+    """
+    Return the path for a new trace of this process's, in the
+    ``traces`` directory of ``state_dir``.
+    """
+    return pathlib.Path(state_dir) / 'traces' / '{0}-{1}.jsonl.gz'.format(
+        time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), os.getpid())
+
+
+def read_events(paths):
+    """
+    Return the events in the trace files at ``paths`` (several workers'
+    traces of the same time, say), as one list in order of time.
+    """
+    events = []
+    for path in paths:
+        with gzip.open(str(path), 'rt', encoding='utf-8') as trace_file:
+            try:
+                for line in trace_file:
+                    events.append(json.loads(line))
+            except EOFError:
+                # The last batch of a trace that was cut short
+                log.warning('{0} is truncated'.format(path))
+    events.sort(key=lambda event: event['time'])
+    return events
+
+
+class TraceRecorder:
+    """
+    Writes a trace to the file at ``path``, keeping up to
+    ``max_stream_bytes`` of each build's engine output.
+
+    Events are buffered, and written every :attr:`flush_interval`
+    seconds on a thread of the recorder's.
+    """
+    flush_interval = 1.0
+
+    def __init__(self, path, *, max_stream_bytes=1024 ** 2):
+        self.path = pathlib.Path(path)
+        self.max_stream_bytes = max_stream_bytes
+        self._lines = []
+        self._flush_handle = None
+        # One thread, so batches are written in order
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        self._pending = None
+        self._record({
+            'type': 'start',
+            'version': TRACE_VERSION,
+            'pid': os.getpid(),
+        }, time.time())
+
+    def request(self, build_name, arrived, status, build_id=None):
+        """
+        Record a request for a build of ``build_name`` that ``arrived``
+        (a :func:`time.time`), and was answered with ``status``.
+        """
+        self._record({
+            'type': 'request',
+            'build_name': build_name,
+            'status': status,
+            'build_id': build_id,
+        }, arrived)
+
+    def stream(self, build_name, build_id):
+        """
+        Return a :class:`StreamRecording` of the engine output of a
+        build starting now.
+        """
+        return StreamRecording(self, build_name, build_id)
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._flush()
+        if self._pending is not None:
+            await asyncio.wrap_future(self._pending)
+        self._executor.shutdown(wait=True)
+
+    def _record(self, event, event_time):
+        event['time'] = event_time
+        self._lines.append(json.dumps(event, separators=(',', ':')))
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_event_loop()
+            except RuntimeError:
+                return
+            self._flush_handle = loop.call_later(
+                self.flush_interval, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if not self._lines:
+            return
+        data = ('\n'.join(self._lines) + '\n').encode('utf-8')
+        self._lines = []
+        self._pending = self._executor.submit(self._write, data)
+
+    def _write(self, data):
+        # On the executor's thread
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open('ab') as trace_file:
+                trace_file.write(gzip.compress(data))
+        except OSError as e:
+            log.warning('Could not write to trace {0}: {1}'.format(
+                self.path, e))
+
+
+class StreamRecording:
+    """
+    The engine output of one build, see :meth:`TraceRecorder.stream`.
+    Pass :meth:`chunk_received` the pieces of the response as they're
+    read, and call :meth:`close` at its end.
+    """
+    def __init__(self, recorder, build_name, build_id):
+        self._recorder = recorder
+        self._build_name = build_name
+        self._build_id = build_id
+        self._started = time.time()
+        self._started_monotonic = time.monotonic()
+        self._chunks = []
+        # Pieces may end partway through a character.
+        self._decoder = codecs.getincrementaldecoder('utf-8')(
+            errors='replace')
+        self._bytes_left = recorder.max_stream_bytes
+        self._truncated = False
+        self._closed = False
+
+    def chunk_received(self, data):
+        if len(data) > self._bytes_left:
+            self._truncated = True
+            data = data[:self._bytes_left]
+        if not data:
+            return
+        self._bytes_left -= len(data)
+        self._chunks.append([
+            round(time.monotonic() - self._started_monotonic, 6),
+            self._decoder.decode(data),
+        ])
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._recorder._record({
+            'type': 'stream',
+            'build_name': self._build_name,
+            'build_id': self._build_id,
+            'chunks': self._chunks,
+            'truncated': self._truncated,
+        }, self._started)
@@ -0,0 +1,418 @@
+"""
+Running HarborPilot as several worker processes listening on the same
+port (with ``SO_REUSEPORT``), so request handling, log fan-out and
+context archiving are spread over more than one core.
+
+The kernel hands each connection to any of the workers, so what has to
+be consistent across them is kept in a small SQLite database in the
+state directory, the :class:`SharedState`:
+
+-   Which worker runs the builds of each build name and branch. A push
+    arriving at another worker is forwarded to that one, so concurrent
+    pushes coalesce just as they do in a single process.
+-   Which worker has each build in memory, so requests about the build
+    arriving at another worker are forwarded to it.
+-   The scheduler's tickets, so the limits on running and queued builds
+    hold for all the workers together.
+
+Each worker also listens on a UNIX socket in the state directory, which
+the others forward requests to.
+"""
+import sqlite3
+import asyncio
+import logging
+import pathlib
+import contextlib
+
+import aiohttp
+import aiohttp.web as aweb
+
+from harborpilot import docker
+
+
+log = logging.getLogger(__name__)
+
+
+# Set on requests forwarded from another worker, to the sender's number.
+# These are always handled where they arrive.
+FORWARDED_HEADER = 'X-HarborPilot-Worker'
+
+# Any host will do, the connection is to the worker's socket
+_FORWARD_BASE_URL = 'http://harborpilot.local'
+
+# Left out when passing on a request or response
+_HOP_BY_HOP_HEADERS = frozenset([
+    'connection',
+    'keep-alive',
+    'transfer-encoding',
+    'te',
+    'upgrade',
+    'host',
+    'content-length',
+    'content-encoding',
+])
+
+_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS owners (
+        build_name TEXT NOT NULL,
+        branch TEXT NOT NULL,
+        worker INTEGER NOT NULL,
+        PRIMARY KEY (build_name, branch)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS builds (
+        build_id TEXT PRIMARY KEY,
+        worker INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS tickets (
+        ticket_id TEXT PRIMARY KEY,
+        build_name TEXT NOT NULL,
+        worker INTEGER NOT NULL,
+        running INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+]
+
+_TABLES = ['owners', 'builds', 'tickets']
+
+
+def shared_state_path(state_dir):
+    return pathlib.Path(state_dir) / 'workers.sqlite'
+
+
+def is_forwarded(request):
+    """
+    Return whether ``request`` was forwarded from another worker.
+    """
+    return FORWARDED_HEADER in request.headers
+
+
+class SharedState:
+    """
+    The state shared by the workers, in the SQLite database at ``path``,
+    as seen by worker number ``worker``.
+
+    Unlike :class:`.history.BuildHistory`, calls are made right on the
+    event loop: each is a short transaction on small tables, which only
+    ever waits for the other workers' equally short ones.
+    """
+    # Seconds to wait for another worker's transaction to finish
+    busy_timeout = 10.0
+
+    def __init__(self, path, worker):
+        self.path = pathlib.Path(path)
+        self.worker = worker
+        self._connection = None
+
+    def claim(self, build_name, branch):
+        """
+        Return the number of the worker running builds of
+        ``build_name`` and ``branch``, making it this one if none is.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO owners (build_name, branch, worker) '
+                'VALUES (?, ?, ?)',
+                [build_name, branch, self.worker],
+            )
+            row = connection.execute(
+                'SELECT worker FROM owners '
+                'WHERE build_name = ? AND branch = ?',
+                [build_name, branch],
+            ).fetchone()
+        return row[0]
+
+    def release(self, build_name, branch):
+        """
+        Stop running builds of ``build_name`` and ``branch`` here, so
+        the next push for them can go to any worker.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                'DELETE FROM owners '
+                'WHERE build_name = ? AND branch = ? AND worker = ?',
+                [build_name, branch, self.worker],
+            )
+
+    def add_build(self, build_id):
+        with self._transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO builds (build_id, worker) '
+                'VALUES (?, ?)',
+                [build_id, self.worker],
+            )
+
+    def remove_build(self, build_id):
+        with self._transaction() as connection:
+            connection.execute(
+                'DELETE FROM builds WHERE build_id = ? AND worker = ?',
+                [build_id, self.worker],
+            )
+
+    def locate(self, build_id):
+        """
+        Return the number of the worker with ``build_id`` in memory, or
+        ``None``.
+        """
+        row = self._connect().execute(
+            'SELECT worker FROM builds WHERE build_id = ?', [build_id],
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def reserve_ticket(self, ticket_id, build_name, max_queued):
+        """
+        Add a waiting ticket for a build of ``build_name``, unless
+        ``max_queued`` are waiting already, and return whether it was
+        added.
+        """
+        with self._transaction() as connection:
+            waiting, = connection.execute(
+                'SELECT COUNT(*) FROM tickets WHERE running = 0',
+            ).fetchone()
+            if waiting >= max_queued:
+                return False
+            connection.execute(
+                'INSERT INTO tickets (ticket_id, build_name, worker) '
+                'VALUES (?, ?, ?)',
+                [ticket_id, build_name, self.worker],
+            )
+        return True
+
+    def start_ticket(self, ticket_id, build_name, max_concurrent,
+                     max_per_build):
+        """
+        Mark the waiting ticket ``ticket_id`` running, if fewer than
+        ``max_concurrent`` tickets, and fewer than ``max_per_build`` of
+        ``build_name``, are running. Return whether it was.
+        """
+        with self._transaction() as connection:
+            running, running_here = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(build_name = ?), 0) '
+                'FROM tickets WHERE running = 1',
+                [build_name],
+            ).fetchone()
+            if running >= max_concurrent or running_here >= max_per_build:
+                return False
+            connection.execute(
+                'UPDATE tickets SET running = 1 WHERE ticket_id = ?',
+                [ticket_id],
+            )
+        return True
+
+    def remove_ticket(self, ticket_id):
+        with self._transaction() as connection:
+            connection.execute(
+                'DELETE FROM tickets WHERE ticket_id = ?', [ticket_id])
+
+    def ticket_counts(self):
+        """
+        Return dicts of build name -> running tickets and build name ->
+        waiting tickets, for all the workers.
+        """
+        running = {}
+        waiting = {}
+        cursor = self._connect().execute(
+            'SELECT build_name, running, COUNT(*) FROM tickets '
+            'GROUP BY build_name, running'
+        )
+        for build_name, is_running, count in cursor:
+            (running if is_running else waiting)[build_name] = count
+        return running, waiting
+
+    def clear_worker(self):
+        """
+        Remove everything of this worker's, for when it has exited.
+        """
+        with self._transaction() as connection:
+            for table in _TABLES:
+                connection.execute(
+                    'DELETE FROM {0} WHERE worker = ?'.format(table),
+                    [self.worker],
+                )
+
+    def reset(self):
+        """
+        Remove everything, for when no workers are running.
+        """
+        with self._transaction() as connection:
+            for table in _TABLES:
+                connection.execute('DELETE FROM {0}'.format(table))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        # Take the write lock up front, so checks and updates can't be
+        # interleaved with another worker's.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _connect(self):
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                str(self.path),
+                timeout=self.busy_timeout,
+                isolation_level=None,
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Reset whenever the workers start, so there's nothing to
+            # lose in a crash.
+            connection.execute('PRAGMA synchronous=OFF')
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            self._connection = connection
+        return self._connection
+
+
+class Worker:
+    """
+    This process's place among ``count`` workers: number ``index``,
+    keeping its shared state and socket under ``state_dir``.
+    """
+    def __init__(self, state_dir, index, count):
+        self.state_dir = pathlib.Path(state_dir)
+        self.index = index
+        self.count = count
+        self.shared_state = SharedState(shared_state_path(state_dir), index)
+        self._sessions = {}  # worker number -> aiohttp.ClientSession
+
+    def socket_path(self, index=None):
+        """
+        Return the path of the UNIX socket of worker number ``index``,
+        or of this one.
+        """
+        if index is None:
+            index = self.index
+        return self.state_dir / 'workers' / '{0}.sock'.format(index)
+
+    async def forward(self, request, index):
+        """
+        Pass ``request`` on to worker number ``index``, and return its
+        response, streamed back as it arrives. WebSocket requests are
+        connected through.
+        """
+        try:
+            if request.headers.get('Upgrade', '').lower() == 'websocket':
+                return await self._forward_websocket(request, index)
+            return await self._forward_http(request, index)
+        except aiohttp.ClientConnectionError as e:
+            # Its rows are cleared once the supervisor sees it exit
+            log.warning('Could not forward to worker {0}: {1}'.format(
+                index, e))
+            raise aweb.HTTPServiceUnavailable(
+                headers={'Retry-After': '1'},
+                text='Worker {0} is unavailable, try again'.format(index),
+            )
+
+    async def gather(self, path):
+        """
+        Return the bodies of the other workers' responses to a GET of
+        ``path``, leaving out any that fail.
+        """
+        bodies = []
+        for index in range(self.count):
+            if index == self.index:
+                continue
+            try:
+                async with self._session(index).get(
+                        _FORWARD_BASE_URL + path,
+                        headers={FORWARDED_HEADER: str(self.index)},
+                    ) as response:
+                    response.raise_for_status()
+                    bodies.append(await response.read())
+            except aiohttp.ClientError as e:
+                log.warning('Could not get {0} from worker {1}: {2}'.format(
+                    path, index, e))
+        return bodies
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        self.shared_state.close()
+
+    def _session(self, index):
+        session = self._sessions.get(index)
+        if session is None:
+            session = self._sessions[index] = docker.make_session(
+                'unix://{0}'.format(self.socket_path(index)))
+        return session
+
+    def _forward_headers(self, request):
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.lower() not in _HOP_BY_HOP_HEADERS
+        }
+        headers[FORWARDED_HEADER] = str(self.index)
+        return headers
+
+    async def _forward_http(self, request, index):
+        data = await request.read() if request.body_exists else None
+        async with self._session(index).request(
+                request.method,
+                _FORWARD_BASE_URL + str(request.rel_url),
+                headers=self._forward_headers(request),
+                data=data,
+            ) as upstream:
+            response = aweb.StreamResponse(
+                status=upstream.status,
+                reason=upstream.reason,
+                headers={
+                    name: value for name, value in upstream.headers.items()
+                    if name.lower() not in _HOP_BY_HOP_HEADERS
+                },
+            )
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+    async def _forward_websocket(self, request, index):
+        headers = self._forward_headers(request)
+        # ws_connect sets its own handshake headers
+        for name in list(headers):
+            if name.lower().startswith('sec-websocket-'):
+                del headers[name]
+        async with self._session(index).ws_connect(
+                _FORWARD_BASE_URL + str(request.rel_url),
+                headers=headers,
+            ) as upstream:
+            ws = aweb.WebSocketResponse(heartbeat=30)
+            await ws.prepare(request)
+            pipes = [
+                asyncio.ensure_future(_pipe_websocket(upstream, ws)),
+                asyncio.ensure_future(_pipe_websocket(ws, upstream)),
+            ]
+            try:
+                await asyncio.wait(
+                    pipes, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for pipe in pipes:
+                    pipe.cancel()
+                await ws.close()
+        return ws
+
+
+async def _pipe_websocket(source, destination):
+    async for message in source:
+        if message.type == aiohttp.WSMsgType.TEXT:
+            await destination.send_str(message.data)
+        elif message.type == aiohttp.WSMsgType.BINARY:
+            await destination.send_bytes(message.data)
+        else:
+            break
@@ -0,0 +1,173 @@
+import io
+import json
+import base64
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+from harborpilot import buildkit
+from harborpilot import docker
+
+
+def _varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def _field(number, value):
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _timestamp(seconds):
+    return _field(1, int(seconds)) + _field(2, int(seconds % 1 * 1e9))
+
+
+def _vertex(digest, name, *, started=None, completed=None, cached=False,
+            error=''):
+    data = _field(1, digest) + _field(2, 'sha256:input') + _field(3, name)
+    if cached:
+        data += _field(4, 1)
+    if started is not None:
+        data += _field(5, _timestamp(started))
+    if completed is not None:
+        data += _field(6, _timestamp(completed))
+    if error:
+        data += _field(7, error)
+    return _field(1, data)
+
+
+def _log(digest, timestamp, msg):
+    return _field(3, (
+        _field(1, digest) + _field(2, _timestamp(timestamp))
+        + _field(3, 1) + _field(4, msg)
+    ))
+
+
+def _trace(*fields):
+    return {
+        'id': buildkit.TRACE_ID,
+        'aux': base64.b64encode(b''.join(fields)).decode('ascii'),
+    }
+
+
+_TRACES = [
+    _trace(
+        _vertex('sha256:a', '[internal] load build definition', started=10),
+        _vertex('sha256:b', '[1/2] FROM alpine', cached=True),
+    ),
+    _trace(
+        _vertex('sha256:a', '[internal] load build definition',
+                started=10, completed=10.25),
+        _vertex('sha256:c', '[2/2] RUN make', started=11),
+        _log('sha256:c', 11.5, 'cc -o app'),
+    ),
+    _trace(
+        _log('sha256:c', 12, ' app.c\nlinked\n'),
+        _vertex('sha256:c', '[2/2] RUN make', started=11, completed=13),
+    ),
+]
+
+_RENDERED = (
+    '#1 [internal] load build definition\n'
+    '#2 [1/2] FROM alpine\n'
+    '#2 CACHED\n'
+    '#3 [2/2] RUN make\n'
+    '#1 DONE 0.2s\n'
+    '#3 1.000 cc -o app app.c\n'
+    '#3 1.000 linked\n'
+    '#3 DONE 2.0s\n'
+)
+
+
+def test_status_response_decode():
+    status = buildkit.StatusResponse.from_message(_TRACES[1])
+    assert status.vertexes == [
+        buildkit.Vertex(
+            digest='sha256:a', name='[internal] load build definition',
+            started=10.0, completed=10.25,
+        ),
+        buildkit.Vertex(digest='sha256:c', name='[2/2] RUN make', started=11),
+    ]
+    assert status.logs == [
+        buildkit.VertexLog(
+            vertex='sha256:c', timestamp=11.5, msg=b'cc -o app'),
+    ]
+
+
+def test_status_response_bad_message():
+    with pytest.raises(buildkit.DecodeError):
+        buildkit.StatusResponse.from_message(
+            {'id': buildkit.TRACE_ID, 'aux': 'not base64!'})
+    with pytest.raises(buildkit.DecodeError):
+        # A length-delimited field longer than the data
+        buildkit.StatusResponse.decode(b'\x0a\x10abc')
+
+
+def test_trace_renderer():
+    renderer = buildkit.TraceRenderer()
+    translated = renderer.translate(
+        _TRACES + [{'aux': {'ID': 'sha256:abc'}, 'id': 'moby.image.id'}])
+    assert ''.join(m.get('stream', '') for m in translated) == _RENDERED
+    assert translated[-1] == {
+        'aux': {'ID': 'sha256:abc'}, 'id': 'moby.image.id'}
+
+
+@pytest.mark.asyncio
+async def test_build_result_consumer_buildkit_steps():
+    consumer = docker.BuildResultConsumer()
+    consumer.messages_received([{'stream': _RENDERED}])
+    consumer.message_received({'aux': {'ID': 'sha256:abc'}})
+    await consumer.last_message_received()
+    result = consumer.result
+    assert result.status == docker.BuildResult.SUCCEEDED
+    assert result.steps == [
+        docker.StepTiming(2, None, '[1/2] FROM alpine', 0.0),
+        docker.StepTiming(3, None, '[2/2] RUN make', 2.0),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_imagebuild_buildkit(aiohttp_server):
+    received = {}
+
+    async def build(request):
+        received.update(request.query)
+        await request.read()
+        response = aiohttp.web.StreamResponse()
+        await response.prepare(request)
+        for message in _TRACES:
+            await response.write(json.dumps(message).encode('utf-8') + b'\n')
+        await response.write_eof()
+        return response
+
+    app = aiohttp.web.Application()
+    app.router.add_post('/build', build)
+    server = await aiohttp_server(app)
+    consumer = docker.BuildResultConsumer()
+    async with aiohttp.ClientSession() as session:
+        image_build = docker.ImageBuild(
+            session,
+            io.BytesIO(b'tar'),
+            image_name='harborpilottest/someimage',
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+            version='2',
+            buildargs={'BUILDKIT_INLINE_CACHE': '1'},
+        )
+        await image_build.start()
+        await image_build.dispatch_messages(consumer)
+    assert received['version'] == '2'
+    assert json.loads(received['buildargs']) == {'BUILDKIT_INLINE_CACHE': '1'}
+    assert [step.instruction for step in consumer.result.steps] == [
+        '[1/2] FROM alpine', '[2/2] RUN make']
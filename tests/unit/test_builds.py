@@ -0,0 +1,323 @@
+import json
+import asyncio
+import pathlib
+import hashlib
+
+import attr
+import aiohttp
+import aiohttp.web
+import pytest
+
+from harborpilot import builds
+from harborpilot import config
+from harborpilot import dedup
+from harborpilot import docker
+from harborpilot import git
+from harborpilot import logstore
+from harborpilot import scheduler
+from harborpilot import trace
+
+from tests.unit.test_git import _make_git_repo, _add_git_commit
+
+
+class FakeEngine:
+    """
+    Just enough of the Engine API for builds: /build streams the given
+    messages once ``release`` is set, then records the image.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.release = asyncio.Event()
+        self.build_count = 0
+        self.build_queries = []
+        self.images = {}  # ID -> {'Id': ..., 'Labels': ..., 'Tags': [...]}
+
+    def make_app(self):
+        app = aiohttp.web.Application()
+        app.add_routes([
+            aiohttp.web.post('/build', self.build),
+            aiohttp.web.get('/images/json', self.list_images),
+            aiohttp.web.get('/images/{name}/json', self.inspect_image),
+            aiohttp.web.post('/images/{name}/tag', self.tag_image),
+        ])
+        return app
+
+    async def build(self, request):
+        self.build_count += 1
+        self.build_queries.append(dict(request.query))
+        content = await request.read()
+        labels = json.loads(request.query.get('labels', '{}'))
+        response = aiohttp.web.StreamResponse()
+        await response.prepare(request)
+        await self.release.wait()
+        image_id = 'sha256:' + hashlib.sha256(content).hexdigest()
+        for message in self.messages + [{'aux': {'ID': image_id}}]:
+            await response.write(json.dumps(message).encode('utf-8') + b'\n')
+        self._tag(image_id, request.query['t'])
+        self.images[image_id]['Labels'] = labels
+        await response.write_eof()
+        return response
+
+    async def list_images(self, request):
+        wanted = set(json.loads(request.query['filters'])['label'])
+        return aiohttp.web.json_response([
+            {'Id': image['Id']}
+            for image in self.images.values()
+            if wanted <= {
+                '{0}={1}'.format(name, value)
+                for name, value in image['Labels'].items()
+            }
+        ])
+
+    async def inspect_image(self, request):
+        image = self._find(request.match_info['name'])
+        if image is None:
+            raise aiohttp.web.HTTPNotFound()
+        return aiohttp.web.json_response(
+            {'Id': image['Id'], 'Config': {'Labels': image['Labels']}})
+
+    async def tag_image(self, request):
+        image = self._find(request.match_info['name'])
+        if image is None:
+            raise aiohttp.web.HTTPNotFound()
+        self._tag(image['Id'], '{0}:{1}'.format(
+            request.query['repo'], request.query['tag']))
+        return aiohttp.web.Response(status=201)
+
+    def _find(self, name):
+        if name in self.images:
+            return self.images[name]
+        for image in self.images.values():
+            if name in image['Tags']:
+                return image
+        return None
+
+    def _tag(self, image_id, ref):
+        for image in self.images.values():
+            if ref in image['Tags']:
+                image['Tags'].remove(ref)
+        image = self.images.setdefault(
+            image_id, {'Id': image_id, 'Labels': {}, 'Tags': []})
+        image['Tags'].append(ref)
+
+
+@pytest.fixture
+def source_repo(tmpdir):
+    repo_dir = pathlib.Path(tmpdir.strpath).resolve() / 'source'
+    repo_dir.mkdir()
+    _make_git_repo(repo_dir, [], [('Dockerfile', 'FROM scratch\n')])
+    return repo_dir
+
+
+@pytest.fixture
+async def engine_and_coordinator(aiohttp_server, tmpdir):
+    engine = FakeEngine([{'stream': 'Step 1/1\n'}, {'stream': 'done\n'}])
+    server = await aiohttp_server(engine.make_app())
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    async with aiohttp.ClientSession() as session:
+        engine_pool = docker.EnginePool([docker.Engine(
+            session,
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )])
+        coordinator = builds.BuildCoordinator(
+            engine_pool,
+            git.MirrorCache(root / 'mirrors'),
+            dedup.BuildIndex(root / 'index.jsonl'),
+            scheduler.BuildScheduler(
+                max_concurrent=4, max_per_build=1, max_queued=10),
+        )
+        yield engine, coordinator
+
+
+def _image_build_config(repo_dir):
+    return config.ImageBuildConfig(
+        build_name='some_build_name',
+        image_name='some_image',
+        image_tag='latest',
+        git=config.GitDockerBuildContextConfig(
+            remote=str(repo_dir),
+            branch='master',
+            context_relpath=pathlib.PurePosixPath('.'),
+        ),
+    )
+
+
+async def _collect(aiterable):
+    return b''.join([chunk async for chunk in aiterable])
+
+
+async def _read_all(build):
+    return await _collect(build.output.follow())
+
+
+async def test_build_output_follow_from_offset():
+    output = builds.BuildOutput()
+    output.write(b'abc')
+    follower = asyncio.ensure_future(_collect(output.follow(1)))
+    await asyncio.sleep(0)
+    output.write(b'def')
+    output.close()
+    assert await follower == b'bcdef'
+
+
+async def test_concurrent_requests_coalesce(
+        source_repo, engine_and_coordinator):
+    engine, coordinator = engine_and_coordinator
+    cfg = _image_build_config(source_repo)
+    first = coordinator.submit(cfg)
+    # Still fetching, so this attaches to the first build.
+    assert coordinator.submit(cfg) is first
+
+    while not first.commit_resolved:
+        await asyncio.sleep(0.01)
+    queued = coordinator.submit(cfg)
+    assert queued is not first
+    assert coordinator.submit(cfg) is queued
+
+    _add_git_commit(source_repo, [('Dockerfile', 'FROM scratch\n# new\n')])
+    engine.release.set()
+    await first.wait_accepted()
+    assert await _read_all(first) == b'Step 1/1\ndone\n'
+    await queued.wait_accepted()
+    # The first build's image is the cache source for the next
+    assert await _read_all(queued) == (
+        'Using cache from {0}\nStep 1/1\ndone\n'.format(
+            first.image_id).encode('utf-8'))
+    assert json.loads(engine.build_queries[1]['cachefrom']) == [
+        first.image_id]
+    assert queued.commit_hash != first.commit_hash
+    assert engine.build_count == 2
+    assert first.status == builds.Build.SUCCEEDED
+    assert first.image_id in engine.images
+
+
+async def test_already_built_commit_is_reused(
+        source_repo, engine_and_coordinator):
+    engine, coordinator = engine_and_coordinator
+    engine.release.set()
+    cfg = _image_build_config(source_repo)
+    first = coordinator.submit(cfg)
+    await first.wait_done()
+    second = coordinator.submit(cfg)
+    await second.wait_accepted()
+    output = await _read_all(second)
+    assert output.startswith(b'Image sha256:')
+    assert b'already built from commit ' + first.commit_hash.encode() in output
+    assert engine.build_count == 1
+
+
+async def test_mirror_held_until_build_ends(
+        source_repo, engine_and_coordinator, monkeypatch):
+    engine, coordinator = engine_and_coordinator
+    released = []
+    aexit = git._StreamedArchiveLease.__aexit__
+
+    async def recording_aexit(self, *exc_info):
+        released.append(exc_info)
+        await aexit(self, *exc_info)
+
+    monkeypatch.setattr(
+        git._StreamedArchiveLease, '__aexit__', recording_aexit)
+    build = coordinator.submit(_image_build_config(source_repo))
+    await build.wait_accepted()
+    # Docker might not have read all of the context yet
+    assert released == []
+    engine.release.set()
+    await build.wait_done()
+    assert released == [(None, None, None)]
+
+
+async def test_failed_build_setup_gives_up_its_place(
+        source_repo, engine_and_coordinator):
+    engine, coordinator = engine_and_coordinator
+
+    class BrokenLogStore:
+        def open_writer(self, build_name, build_id):
+            raise OSError('disk full')
+
+    coordinator._log_store = BrokenLogStore()
+    with pytest.raises(OSError):
+        coordinator.submit(_image_build_config(source_repo))
+    assert coordinator._scheduler.queued == 0
+
+
+async def test_build_options_forwarded(source_repo, engine_and_coordinator):
+    engine, coordinator = engine_and_coordinator
+    engine.release.set()
+    cfg = _image_build_config(source_repo)
+    first = coordinator.submit(cfg)
+    await first.wait_done()
+    cfg = attr.evolve(cfg, build_options=config.BuildOptionsConfig(
+        buildargs={'VERSION': '2'},
+        target='release',
+        pull=True,
+        memory=64 * 1024 ** 2,
+        cachefrom=['registry.example.com/app:latest'],
+        cache_from_last_build=False,
+    ))
+    second = coordinator.submit(cfg)
+    await second.wait_done()
+    # Built again, since build args can change the image
+    assert second.status == builds.Build.SUCCEEDED
+    assert engine.build_count == 2
+    query = engine.build_queries[1]
+    assert json.loads(query['buildargs']) == {'VERSION': '2'}
+    assert query['target'] == 'release'
+    assert query['pull'] == '1'
+    assert query['memory'] == str(64 * 1024 ** 2)
+    assert json.loads(query['cachefrom']) == [
+        'registry.example.com/app:latest']
+
+
+async def test_engine_output_traced(
+        tmpdir, source_repo, engine_and_coordinator):
+    engine, coordinator = engine_and_coordinator
+    engine.release.set()
+    path = pathlib.Path(tmpdir.strpath) / 'trace.jsonl.gz'
+    recorder = trace.TraceRecorder(path)
+    coordinator._trace_recorder = recorder
+    build = coordinator.submit(_image_build_config(source_repo))
+    await build.wait_done()
+    await recorder.close()
+    streams = [
+        event for event in trace.read_events([path])
+        if event['type'] == 'stream'
+    ]
+    assert len(streams) == 1
+    assert streams[0]['build_name'] == 'some_build_name'
+    assert streams[0]['build_id'] == build.build_id
+    output = ''.join(text for seconds, text in streams[0]['chunks'])
+    assert '"Step 1/1\\n"' in output
+    assert build.image_id in output
+
+
+async def test_build_output_keeps_most_recent_bytes():
+    output = builds.BuildOutput(max_bytes=4)
+    for chunk in [b'ab', b'cd', b'ef']:
+        output.write(chunk)
+    assert len(output) == 6
+    assert output.start_offset == 2
+    assert output.read(0) == b'cdef'
+    assert output.read(5) == b'f'
+    output.close()
+    assert await _collect(output.follow(1)) == b'cdef'
+
+
+async def test_build_output_follow_with_stored_log_gone(tmpdir):
+    store = logstore.LogStore(tmpdir.join('logs'))
+    store.chunk_size = 16
+    output = builds.BuildOutput(
+        max_bytes=16, log_writer=store.open_writer('spam', 'b0'))
+    output.write(b'0123456789')
+    follower = output.follow()
+    assert await follower.__anext__() == b'0123456789'
+
+    for i in range(10):
+        output.write(b'abcdefghij')
+    await store._submit(lambda: None)
+    for path in store.root.iterdir():
+        path.unlink()
+    output.close()
+    # What's no longer in memory is skipped, rather than read forever.
+    assert await _collect(follower) == output.read(0)
+    await store.close()
@@ -0,0 +1,46 @@
+import os
+import signal
+import pathlib
+
+from harborpilot import cli
+from harborpilot import configfiles
+
+from tests.unit.test_reloader import _write_config
+
+
+def test_restarted_worker_gets_reloaded_builds(tmpdir, monkeypatch):
+    root = pathlib.Path(tmpdir.strpath)
+    path = root / 'harborpilot.conf'
+    _write_config(path, ['spam'], state_dir=str(root / 'state'), port=8000)
+    cfg = configfiles.load(path)
+    started = []  # (worker number, config)
+
+    def start_worker(cfg, index, worker_count, config_path):
+        started.append((index, cfg))
+        return 1000 + len(started)
+
+    def wait():
+        if len(started) == 2:
+            # Worker 0 exits after the config changed
+            _write_config(
+                path, ['spam', 'eggs'], state_dir=str(root / 'state'),
+                port=9000)
+            return 1001, 256
+        if len(started) == 3:
+            # Then a bad change, which the next restart ignores
+            path.write_text('builds: [')
+            return 1003, 256
+        raise ChildProcessError()
+
+    monkeypatch.setattr(cli, '_start_worker', start_worker)
+    monkeypatch.setattr(cli, 'WORKER_RESTART_DELAY', 0)
+    monkeypatch.setattr(os, 'wait', wait)
+    monkeypatch.setattr(signal, 'signal', lambda signum, handler: None)
+    cli.serve_workers(cfg, 2, config_path=path)
+
+    assert [index for index, cfg in started] == [0, 1, 0, 0]
+    assert sorted(started[1][1].builds) == ['spam']
+    for index, restarted_cfg in started[2:]:
+        assert sorted(restarted_cfg.builds) == ['eggs', 'spam']
+        # Other settings only change when all the workers restart
+        assert restarted_cfg.port == 8000
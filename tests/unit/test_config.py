@@ -67,6 +67,40 @@ def _default_HarborPilotConfig(build_name, image_name, image_git_remote):
         builds={
             build_name: image_build_obj,
         },
+        state_dir='harborpilot-state',
+        git_cache=config.GitCacheConfig(
+            max_bytes=10 * 1024 ** 3,
+            partial_clone=True,
+        ),
+        scheduler=config.SchedulerConfig(
+            max_concurrent_builds=4,
+            max_concurrent_per_build=1,
+            max_queued_builds=100,
+        ),
+        logs=config.LogsConfig(
+            max_memory_bytes=4 * 1024 ** 2,
+            max_disk_bytes=1024 ** 3,
+            max_age_days=30,
+        ),
+        context_cache=config.ContextCacheConfig(
+            enabled=True,
+            max_bytes=10 * 1024 ** 3,
+        ),
+        engines=config.EnginesConfig(
+            placement='least_loaded',
+            health_check_interval=10.0,
+            endpoints=[
+                config.EngineConfig(
+                    url='unix:///var/run/docker.sock',
+                    max_connections=100,
+                    keepalive_timeout=15.0,
+                ),
+            ],
+        ),
+        trace=config.TraceConfig(
+            enabled=False,
+            max_stream_bytes=1024 ** 2,
+        ),
     )
 
 
@@ -162,6 +196,50 @@ class TestImageBuildConfigSchema:
         result = schema.load(structure)
         assert result == expected_result
 
+    def test_buildkit(self):
+        structure = _minimal_ImageBuildConfig_structure(
+            _IMAGE_NAME, _LOCAL_REMOTE)
+        structure['buildkit'] = {'enabled': True, 'platform': 'linux/arm64'}
+        result = config.ImageBuildConfigSchema().load(structure)
+        assert result.buildkit == config.BuildKitConfig(
+            enabled=True, inline_cache=False, platform='linux/arm64')
+        structure['buildkit'] = {'platform': 'arm64'}
+        with pytest.raises(mm.ValidationError) as exc_info:
+            config.ImageBuildConfigSchema().load(structure)
+        assert exc_info.value.messages == {
+            'buildkit': {
+                'platform': ['Platform must be OS/ARCH or OS/ARCH/VARIANT.'],
+            },
+        }
+
+
+    def test_build_options(self):
+        structure = _minimal_ImageBuildConfig_structure(
+            _IMAGE_NAME, _LOCAL_REMOTE)
+        result = config.ImageBuildConfigSchema().load(structure)
+        assert result.build_options == config.BuildOptionsConfig()
+        structure['build_options'] = {
+            'buildargs': {'VERSION': '1.2'},
+            'target': 'release',
+            'cachefrom': ['registry.example.com/app:latest'],
+            'cache_from_last_build': False,
+        }
+        result = config.ImageBuildConfigSchema().load(structure)
+        assert result.build_options == config.BuildOptionsConfig(
+            buildargs={'VERSION': '1.2'},
+            target='release',
+            cachefrom=['registry.example.com/app:latest'],
+            cache_from_last_build=False,
+        )
+        structure['build_options'] = {
+            'buildargs': {'not-a-name': 'x'},
+            'memory': 1024,
+        }
+        with pytest.raises(mm.ValidationError) as exc_info:
+            config.ImageBuildConfigSchema().load(structure)
+        errors = exc_info.value.messages['build_options']
+        assert set(errors) == {'buildargs', 'memory'}
+
 
 # TODO: Add tests for entire config error message structure.
 # TODO: Add tests for valid/invalid address and port.
@@ -194,3 +272,22 @@ class TestHarborPilotConfigSchema:
         schema = config.HarborPilotConfigSchema()
         result = schema.load(structure)
         assert result == expected_result
+
+    @pytest.mark.parametrize('section,structure,error_field', [
+        ('scheduler', {'max_concurrent_builds': 0}, 'max_concurrent_builds'),
+        ('scheduler', {'max_queued_builds': -1}, 'max_queued_builds'),
+        ('git_cache', {'max_bytes': -1}, 'max_bytes'),
+        ('context_cache', {'max_bytes': -1}, 'max_bytes'),
+        ('engines', {'placement': 'random'}, 'placement'),
+        ('engines', {'endpoints': []}, 'endpoints'),
+        ('engines', {'endpoints': [{'url': 'ftp://host'}]}, 'endpoints'),
+        ('trace', {'max_stream_bytes': -1}, 'max_stream_bytes'),
+    ])
+    def test_invalid_section_values(self, section, structure, error_field):
+        full_structure = _minimal_HarborPilotConfig_structure(
+            _BUILD_NAME, _IMAGE_NAME, _LOCAL_REMOTE)
+        full_structure[section] = structure
+        schema = config.HarborPilotConfigSchema()
+        with pytest.raises(mm.ValidationError) as exc_info:
+            schema.load(full_structure)
+        assert list(exc_info.value.messages[section]) == [error_field]
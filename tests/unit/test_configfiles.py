@@ -0,0 +1,113 @@
+import os
+import pathlib
+
+import pytest
+import yaml
+import marshmallow as mm
+
+from harborpilot import config
+from harborpilot import configfiles
+
+
+def _builds(*build_names):
+    return {
+        build_name: {'image_name': build_name, 'git': {'remote': '/repo'}}
+        for build_name in build_names
+    }
+
+
+def _write_configs(tmpdir, builds, files):
+    root = pathlib.Path(tmpdir.strpath)
+    path = root / 'harborpilot.conf'
+    path.write_text(yaml.safe_dump({
+        'state_dir': str(root / 'state'),
+        'builds_dir': 'builds.d',
+        'builds': builds,
+    }))
+    builds_dir = root / 'builds.d'
+    builds_dir.mkdir(exist_ok=True)
+    for name, file_builds in files.items():
+        (builds_dir / name).write_text(yaml.safe_dump(file_builds))
+    return path, builds_dir
+
+
+def _forbid_validation(monkeypatch):
+    def load_builds(structure):
+        raise AssertionError('Validated {0}'.format(sorted(structure)))
+    monkeypatch.setattr(config, 'load_builds', load_builds)
+
+
+def test_builds_dir(tmpdir, monkeypatch):
+    path, builds_dir = _write_configs(tmpdir, _builds('spam'), {
+        'a.yaml': _builds('eggs', 'ham'),
+        'b.yml': _builds('bacon'),
+        'README': 'Not builds',
+    })
+    cfg = configfiles.load(path)
+    assert sorted(cfg.builds) == ['bacon', 'eggs', 'ham', 'spam']
+    assert cfg.builds['eggs'].build_name == 'eggs'
+    assert cfg.builds['eggs'].image_name == 'eggs'
+    assert cfg.builds_dir == str(builds_dir)
+
+    # Unchanged and touched files come from the cache.
+    os.utime(str(builds_dir / 'a.yaml'), ns=(0, 0))
+    with monkeypatch.context() as patch:
+        _forbid_validation(patch)
+        assert configfiles.load(path) == cfg
+
+    (builds_dir / 'b.yml').write_text(yaml.safe_dump(_builds('beans')))
+    (builds_dir / 'a.yaml').unlink()
+    reloaded = configfiles.load(path)
+    assert sorted(reloaded.builds) == ['beans', 'spam']
+
+
+def test_bad_build_files(tmpdir):
+    path, builds_dir = _write_configs(tmpdir, _builds('spam'), {
+        'a.yaml': _builds('spam', 'eggs'),
+        'b.yaml': {'ham': {'git': {'remote': '/repo'}}},
+    })
+    with pytest.raises(mm.ValidationError) as exc_info:
+        configfiles.load(path)
+    assert exc_info.value.messages == {'builds_dir': {
+        'b.yaml': {
+            'ham': {'image_name': ['Missing data for required field.']},
+        },
+    }}
+
+    (builds_dir / 'b.yaml').unlink()
+    with pytest.raises(mm.ValidationError) as exc_info:
+        configfiles.load(path)
+    assert exc_info.value.messages == {'builds_dir': {
+        'a.yaml': {'spam': ['Also in harborpilot.conf.']},
+    }}
+
+
+def test_builds_dir_only(tmpdir):
+    path, builds_dir = _write_configs(tmpdir, {}, {
+        'a.yaml': _builds('eggs'),
+    })
+    assert sorted(configfiles.load(path).builds) == ['eggs']
+    (builds_dir / 'a.yaml').unlink()
+    with pytest.raises(mm.ValidationError) as exc_info:
+        configfiles.load(path)
+    assert exc_info.value.messages == {
+        'builds': ['At least one build is required.'],
+    }
+
+
+def test_build_files_validated_in_processes(tmpdir, monkeypatch):
+    files = {
+        '{0}.yaml'.format(index): _builds(
+            *('build-{0}-{1}'.format(index, n) for n in range(20)))
+        for index in range(4)
+    }
+    path, builds_dir = _write_configs(tmpdir, _builds('spam'), files)
+    monkeypatch.setattr(configfiles, 'PARALLEL_MIN_BYTES', 0)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    cfg = configfiles.load(path)
+    assert len(cfg.builds) == 81
+    assert cfg.builds['build-3-19'].build_name == 'build-3-19'
+    # And they were cached like any others
+    with monkeypatch.context() as patch:
+        _forbid_validation(patch)
+        assert configfiles.load(path) == cfg
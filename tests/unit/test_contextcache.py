@@ -0,0 +1,149 @@
+import io
+import asyncio
+import logging
+import threading
+import pathlib
+import tarfile
+
+import pytest
+
+from harborpilot import git
+from harborpilot import config
+from harborpilot import contextcache
+
+from tests.unit.test_git import _make_git_repo, _add_git_commit
+
+
+async def _cached_tar(cache, key, cfg, mirror_cache):
+    data = bytearray()
+    async with git.stream_archive(cfg, mirror_cache=mirror_cache) as archive:
+        async for chunk in cache.chunks(key, archive):
+            data += chunk
+    return tarfile.open(fileobj=io.BytesIO(bytes(data)))
+
+
+def _contents(tar):
+    return {
+        member.name: (
+            tar.extractfile(member).read() if member.isfile()
+            else member.linkname or None
+        )
+        for member in tar.getmembers()
+    }
+
+
+@pytest.fixture
+def repo(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    (repo_dir / 'link').symlink_to('sub/big.bin')
+    _make_git_repo(repo_dir, ['sub'], [
+        ('Dockerfile', 'FROM scratch\n'),
+        ('small.txt', 'before\n'),
+        ('sub/big.bin', 'x' * 200000),
+    ])
+    cfg = config.GitDockerBuildContextConfig(
+        remote=str(repo_dir),
+        branch='master',
+        context_relpath=pathlib.PurePosixPath('.'),
+        symlinks=config.SYMLINKS_INTERNAL,
+    )
+    return root, repo_dir, cfg
+
+
+@pytest.mark.asyncio
+async def test_chunks_reuses_unchanged_files(repo, caplog):
+    root, repo_dir, cfg = repo
+    mirror_cache = git.MirrorCache(root / 'mirrors')
+    cache = contextcache.ContextCache(root / 'contexts')
+    caplog.set_level(logging.DEBUG, logger='harborpilot.contextcache')
+    with await _cached_tar(cache, 'app', cfg, mirror_cache) as tar:
+        assert _contents(tar) == {
+            'Dockerfile': b'FROM scratch\n',
+            'link': 'sub/big.bin',
+            'small.txt': b'before\n',
+            'sub': None,
+            'sub/big.bin': b'x' * 200000,
+        }
+    assert '3 files read from Git, 0 reused' in caplog.text
+
+    _add_git_commit(repo_dir, [
+        ('small.txt', 'after\n'),
+        ('new.txt', 'added\n'),
+    ])
+    caplog.clear()
+    with await _cached_tar(cache, 'app', cfg, mirror_cache) as tar:
+        assert _contents(tar) == {
+            'Dockerfile': b'FROM scratch\n',
+            'link': 'sub/big.bin',
+            'new.txt': b'added\n',
+            'small.txt': b'after\n',
+            'sub': None,
+            'sub/big.bin': b'x' * 200000,
+        }
+        assert tar.getmember('sub/big.bin').mtime == (
+            tar.getmember('small.txt').mtime)
+    assert '2 files read from Git, 2 reused' in caplog.text
+    # Only the latest tar is kept
+    tars = list(cache.directory('app').glob('*.tar'))
+    assert len(tars) == 1
+
+
+@pytest.mark.asyncio
+async def test_chunks_same_commit_uses_cached_tar(repo, caplog):
+    root, repo_dir, cfg = repo
+    mirror_cache = git.MirrorCache(root / 'mirrors')
+    cache = contextcache.ContextCache(root / 'contexts')
+    caplog.set_level(logging.DEBUG, logger='harborpilot.contextcache')
+    with await _cached_tar(cache, 'app', cfg, mirror_cache) as tar:
+        first = _contents(tar)
+    caplog.clear()
+    with await _cached_tar(cache, 'app', cfg, mirror_cache) as tar:
+        assert _contents(tar) == first
+    assert 'files read from Git' not in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_chunks_evicts_least_recently_used(repo):
+    root, repo_dir, cfg = repo
+    mirror_cache = git.MirrorCache(root / 'mirrors')
+    cache = contextcache.ContextCache(root / 'contexts', max_bytes=0)
+    (await _cached_tar(cache, 'one', cfg, mirror_cache)).close()
+    assert cache.directory('one').exists()
+    (await _cached_tar(cache, 'two', cfg, mirror_cache)).close()
+    assert not cache.directory('one').exists()
+    assert cache.directory('two').exists()
+
+
+@pytest.mark.asyncio
+async def test_chunks_sent_while_archiving(repo, monkeypatch):
+    root, repo_dir, cfg = repo
+    mirror_cache = git.MirrorCache(root / 'mirrors')
+    cache = contextcache.ContextCache(root / 'contexts')
+    monkeypatch.setattr(git.TarWriter, 'buffer_size', 512)
+    # Hold up archiving partway, at the second blob read from Git
+    release = threading.Event()
+    started = []
+    start = contextcache._BlobReader.start
+
+    def held_start(self, object_id):
+        started.append(object_id)
+        if len(started) == 2:
+            assert release.wait(10)
+        return start(self, object_id)
+    monkeypatch.setattr(contextcache._BlobReader, 'start', held_start)
+
+    data = bytearray()
+    async with git.stream_archive(cfg, mirror_cache=mirror_cache) as archive:
+        chunks = cache.chunks('app', archive)
+        data += await asyncio.wait_for(chunks.__anext__(), 5)
+        # Before the archive is complete
+        assert not (cache.directory('app') / contextcache._MANIFEST).exists()
+        release.set()
+        async for chunk in chunks:
+            data += chunk
+    assert len(started) > 2
+    with tarfile.open(fileobj=io.BytesIO(bytes(data))) as tar:
+        assert _contents(tar)['small.txt'] == b'before\n'
+    assert (cache.directory('app') / contextcache._MANIFEST).is_file()
@@ -0,0 +1,68 @@
+import pathlib
+
+from harborpilot import dedup
+
+
+def _build_key(commit_hash='0123abcd'):
+    return dedup.BuildKey(
+        build_name='some_build_name',
+        commit_hash=commit_hash,
+        context_relpath=pathlib.PurePosixPath('sub'),
+        dockerfile_digest='4567ef',
+    )
+
+
+def test_build_key_labels_round_trip():
+    key = _build_key()
+    labels = key.labels()
+    assert labels == {
+        'harborpilot.build_name': 'some_build_name',
+        'harborpilot.commit_hash': '0123abcd',
+        'harborpilot.context_relpath': 'sub',
+        'harborpilot.dockerfile_digest': '4567ef',
+        'harborpilot.options_digest': '',
+    }
+    labels['unrelated'] = 'label'
+    assert dedup.BuildKey.from_labels(labels) == key
+
+
+def test_build_key_from_labels_missing():
+    assert dedup.BuildKey.from_labels(None) is None
+    assert dedup.BuildKey.from_labels({'harborpilot.commit_hash': 'a'}) is None
+
+
+def test_build_index_persists(tmpdir):
+    path = pathlib.Path(tmpdir.strpath) / 'state' / 'index.jsonl'
+    index = dedup.BuildIndex(path)
+    assert index.lookup(_build_key()) is None
+    index.record(_build_key(), 'sha256:1')
+    index.record(_build_key('other'), 'sha256:2')
+    index.record(_build_key(), 'sha256:3')
+
+    reloaded = dedup.BuildIndex(path)
+    assert reloaded.lookup(_build_key()) == 'sha256:3'
+    assert reloaded.lookup(_build_key('other')) == 'sha256:2'
+    reloaded.forget(_build_key('other'))
+    assert reloaded.lookup(_build_key('other')) is None
+
+
+def test_build_index_skips_bad_lines(tmpdir):
+    path = pathlib.Path(tmpdir.strpath) / 'index.jsonl'
+    path.write_text('not json\n')
+    index = dedup.BuildIndex(path)
+    index.record(_build_key(), 'sha256:1')
+    assert dedup.BuildIndex(path).lookup(_build_key()) == 'sha256:1'
+
+
+def test_build_index_sees_entries_from_other_processes(tmpdir):
+    path = tmpdir.join('index.jsonl')
+    index = dedup.BuildIndex(path)
+    other = dedup.BuildIndex(path)
+    index.record(_build_key('aaaa'), 'sha256:1')
+    assert other.lookup(_build_key('aaaa')) == 'sha256:1'
+    index.record(_build_key('bbbb'), 'sha256:2')
+    # Half a line, as if another process were still writing it
+    with open(str(path), 'a') as f:
+        f.write('{"key": ')
+    assert other.lookup(_build_key('bbbb')) == 'sha256:2'
+    assert other.lookup(_build_key('cccc')) is None
@@ -89,6 +89,94 @@ async def test_imagebuild_success(aiohttp_server):
     assert build_message_consumer.closed
 
 
+async def test_imagebuild_streams_async_iterable_archive(aiohttp_server):
+    messages = [{'stream': 'some data'}]
+    build_endpoint = FakeBuildEndpoint(BuildResponse(messages), 0)
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.post('/build', build_endpoint.handle_request),
+    ])
+    server = await aiohttp_server(app)
+
+    fake_tar_chunks = [b'this would ', b'be tar ', b'data']
+
+    async def archive_chunks():
+        for chunk in fake_tar_chunks:
+            yield chunk
+
+    async with aiohttp.ClientSession() as session:
+        build = docker.ImageBuild(
+            session,
+            archive_chunks(),
+            image_name='harborpilottest/someimage',
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )
+        await build.start()
+        build_message_consumer = StoringConsumer()
+        await build.dispatch_messages(build_message_consumer)
+
+    assert build_endpoint.received_content == b''.join(fake_tar_chunks)
+    assert build_message_consumer.messages == messages
+
+
+async def test_imagebuild_archive_error_raised_from_start(aiohttp_server):
+    build_endpoint = FakeBuildEndpoint(BuildResponse([]), 0)
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.post('/build', build_endpoint.handle_request),
+    ])
+    server = await aiohttp_server(app)
+
+    async def failing_archive_chunks():
+        yield b'partial'
+        raise RuntimeError('archive failed')
+
+    async with aiohttp.ClientSession() as session:
+        build = docker.ImageBuild(
+            session,
+            failing_archive_chunks(),
+            image_name='harborpilottest/someimage',
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )
+        with pytest.raises(aiohttp.ClientError, match='archive failed'):
+            await build.start()
+
+
+async def test_imagebuild_batches_messages(aiohttp_server):
+    messages = [{'stream': 'line {0}\n'.format(i)} for i in range(100)]
+    messages.append({'aux': {'ID': 'sha256:abc'}})
+    build_endpoint = FakeBuildEndpoint(BuildResponse(messages), 0)
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.post('/build', build_endpoint.handle_request),
+    ])
+    server = await aiohttp_server(app)
+
+    class BatchStoringConsumer(StoringConsumer):
+        def __init__(self):
+            super().__init__()
+            self.batch_sizes = []
+
+        def messages_received(self, messages):
+            self.batch_sizes.append(len(messages))
+            self.messages.extend(messages)
+
+    async with aiohttp.ClientSession() as session:
+        build = docker.ImageBuild(
+            session,
+            b'tar',
+            image_name='harborpilottest/someimage',
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )
+        await build.start()
+        consumer = BatchStoringConsumer()
+        await build.dispatch_messages(consumer)
+
+    assert consumer.messages == messages
+    assert len(consumer.batch_sizes) < len(messages)
+    assert consumer.closed
+
+
 async def test_imagebuild_failure(aiohttp_server):
     messages = [
         {'message': 'the server had a problem'},
@@ -115,3 +203,303 @@ async def test_imagebuild_failure(aiohttp_server):
         assert exc_info.value.status_code == 500
 
     assert build_endpoint.received_content == fake_tar_data
+
+
+async def test_find_images_filters_by_label(aiohttp_server):
+    received = {}
+
+    async def list_images(request):
+        received['filters'] = json.loads(request.query['filters'])
+        return aiohttp.web.json_response([{'Id': 'sha256:abc'}])
+
+    app = aiohttp.web.Application()
+    app.add_routes([aiohttp.web.get('/images/json', list_images)])
+    server = await aiohttp_server(app)
+
+    async with aiohttp.ClientSession() as session:
+        images = await docker.find_images(
+            session,
+            {'harborpilot.commit_hash': '0123'},
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )
+
+    assert images == [{'Id': 'sha256:abc'}]
+    assert received['filters'] == {'label': ['harborpilot.commit_hash=0123']}
+
+
+async def test_inspect_image_missing(aiohttp_server):
+    async def inspect(request):
+        raise aiohttp.web.HTTPNotFound()
+
+    app = aiohttp.web.Application()
+    app.add_routes([aiohttp.web.get('/images/{name}/json', inspect)])
+    server = await aiohttp_server(app)
+
+    async with aiohttp.ClientSession() as session:
+        image = await docker.inspect_image(
+            session,
+            'sha256:abc',
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )
+
+    assert image is None
+
+
+async def test_tag_image_failure(aiohttp_server):
+    async def tag(request):
+        return aiohttp.web.json_response(
+            {'message': 'no such image'}, status=404)
+
+    app = aiohttp.web.Application()
+    app.add_routes([aiohttp.web.post('/images/{name}/tag', tag)])
+    server = await aiohttp_server(app)
+
+    async with aiohttp.ClientSession() as session:
+        with pytest.raises(docker.EngineRequestFailed) as exc_info:
+            await docker.tag_image(
+                session,
+                'sha256:abc',
+                'some/repo',
+                'latest',
+                base_url='http://{0}:{1}'.format(server.host, server.port),
+            )
+    assert exc_info.value.reason == 'no such image'
+    assert exc_info.value.status_code == 404
+
+
+async def _collect_events(subscription):
+    return [event async for event in subscription]
+
+
+async def test_broadcast_fans_out_to_subscribers():
+    broadcast = docker.BroadcastConsumer()
+    first = broadcast.subscribe()
+    broadcast.message_received({'stream': 'abc'})
+    second = broadcast.subscribe(1)
+    broadcast.message_received({'aux': {'ID': 'ignored'}})
+    broadcast.message_received({'stream': 'de'})
+    await broadcast.last_message_received()
+
+    assert await _collect_events(first) == [
+        docker.LogChunk(0, b'abc'),
+        docker.LogChunk(3, b'de'),
+    ]
+    assert await _collect_events(second) == [
+        docker.LogChunk(1, b'bc'),
+        docker.LogChunk(3, b'de'),
+    ]
+    assert broadcast.subscriber_count == 0
+
+
+async def test_broadcast_slow_subscriber_skips_ahead():
+    broadcast = docker.BroadcastConsumer(max_subscriber_bytes=4)
+    slow = broadcast.subscribe()
+    for chunk in ['ab', 'cd', 'ef', 'gh']:
+        broadcast.message_received({'stream': chunk})
+    broadcast.close()
+    assert await _collect_events(slow) == [
+        docker.LogGap(0, 4),
+        docker.LogChunk(4, b'ef'),
+        docker.LogChunk(6, b'gh'),
+    ]
+    assert slow.skipped_bytes == 4
+
+
+async def test_broadcast_late_subscriber_gets_gap():
+    broadcast = docker.BroadcastConsumer(ring_bytes=2)
+    broadcast.message_received({'stream': 'ab'})
+    broadcast.message_received({'stream': 'cd'})
+    late = broadcast.subscribe()
+    broadcast.close()
+    assert await _collect_events(late) == [
+        docker.LogGap(0, 2),
+        docker.LogChunk(2, b'cd'),
+    ]
+
+
+class SlowWriteable:
+    def __init__(self):
+        self.writes = []
+        self.unblock = asyncio.Event()
+
+    async def write(self, data):
+        await self.unblock.wait()
+        self.writes.append(data)
+
+
+async def test_stream_only_consumer_batches_writes():
+    writeable = SlowWriteable()
+    writeable.unblock.set()
+    consumer = docker.StreamOnlyConsumer(writeable, flush_interval=10)
+    for text in ['a', 'b', 'c']:
+        consumer.message_received({'stream': text})
+        consumer.message_received({'status': 'not stream'})
+    await consumer.last_message_received()
+    assert writeable.writes == [b'abc']
+
+
+async def test_stream_only_consumer_applies_backpressure():
+    writeable = SlowWriteable()
+    consumer = docker.StreamOnlyConsumer(
+        writeable, max_buffer_bytes=4, flush_bytes=1)
+    consumer.message_received({'stream': 'ab'})
+    await consumer.drain()
+    await asyncio.sleep(0)
+    # The first write is stuck, and the buffer fills behind it.
+    consumer.message_received({'stream': 'cdef'})
+    drain = asyncio.ensure_future(consumer.drain())
+    await asyncio.sleep(0.01)
+    assert not drain.done()
+    assert consumer.buffered_bytes == 4
+    writeable.unblock.set()
+    await drain
+    await consumer.last_message_received()
+    assert b''.join(writeable.writes) == b'abcdef'
+
+
+async def test_imagebuild_waits_for_consumer_drain(aiohttp_server):
+    messages = [{'stream': str(i)} for i in range(5)]
+    build_endpoint = FakeBuildEndpoint(BuildResponse(messages), 0.01)
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.post('/build', build_endpoint.handle_request),
+    ])
+    server = await aiohttp_server(app)
+
+    class DrainingConsumer(StoringConsumer):
+        drained = 0
+
+        async def drain(self):
+            # Drains follow batches of messages.
+            assert len(self.messages) > self.drained
+            self.drained = len(self.messages)
+
+    async with aiohttp.ClientSession() as session:
+        build = docker.ImageBuild(
+            session,
+            b'tar',
+            image_name='harborpilottest/someimage',
+            base_url='http://{0}:{1}'.format(server.host, server.port),
+        )
+        await build.start()
+        consumer = DrainingConsumer()
+        await build.dispatch_messages(consumer)
+    assert consumer.drained == 5
+
+
+async def test_build_result_consumer_success():
+    consumer = docker.BuildResultConsumer()
+    clock = iter([0.0, 1.0, 3.0, 4.0, 10.0])
+    consumer._clock = lambda: next(clock)
+    consumer.messages_received([
+        {'stream': 'Step 1/2 : FROM'},
+        {'stream': ' scratch\n'},
+    ])
+    consumer.message_received({'stream': ' ---> abc\n'})
+    consumer.messages_received([{'stream': 'Step 2/2 : COPY . /\n'}])
+    consumer.messages_received([{'aux': {'ID': 'sha256:0123'}}])
+    await consumer.last_message_received()
+    assert consumer.result == docker.BuildResult(
+        status=docker.BuildResult.SUCCEEDED,
+        image_id='sha256:0123',
+        steps=[
+            docker.StepTiming(1, 2, 'FROM scratch', 3.0),
+            docker.StepTiming(2, 2, 'COPY . /', 7.0),
+        ],
+        seconds=10.0,
+    )
+
+
+async def test_build_result_consumer_failure():
+    consumer = docker.BuildResultConsumer()
+    consumer.messages_received([
+        {'stream': 'Step 1/1 : RUN false\n'},
+        {
+            'errorDetail': {'code': 1, 'message': 'returned a non-zero code'},
+            'error': 'The command returned a non-zero code: 1',
+        },
+    ])
+    await consumer.last_message_received()
+    assert consumer.result.status == docker.BuildResult.FAILED
+    assert consumer.result.error == 'The command returned a non-zero code: 1'
+    assert consumer.result.image_id is None
+
+
+async def test_build_result_consumer_legacy_success_line():
+    consumer = docker.BuildResultConsumer()
+    consumer.messages_received([{'stream': 'Successfully built 0123abcd\n'}])
+    await consumer.last_message_received()
+    assert consumer.result.status == docker.BuildResult.SUCCEEDED
+    assert consumer.result.image_id == '0123abcd'
+
+
+def _engines(count):
+    return [
+        docker.Engine(None, base_url='http://engine{0}'.format(index))
+        for index in range(count)
+    ]
+
+
+def test_engine_pool_least_loaded():
+    engines = _engines(3)
+    pool = docker.EnginePool(engines)
+    with pool.placed('a') as first:
+        with pool.placed('a') as second:
+            assert second is not first
+            assert engines[2] not in (first, second)
+            # The idle engine would be next, if it were up
+            engines[2].healthy = False
+            with pool.placed('b') as third:
+                assert third in (first, second)
+                assert third.active_builds == 2
+    assert [engine.active_builds for engine in engines] == [0, 0, 0]
+
+
+def test_engine_pool_consistent_hash():
+    engines = _engines(4)
+    pool = docker.EnginePool(engines, placement='consistent_hash')
+    names = ['build{0}'.format(index) for index in range(100)]
+    placed = {name: pool.place(name) for name in names}
+    assert len(set(placed.values())) == 4
+    engines[1].healthy = False
+    for name in names:
+        engine = pool.place(name)
+        if placed[name] is engines[1]:
+            assert engine is not engines[1]
+        else:
+            # Names on the other engines stay put
+            assert engine is placed[name]
+    for engine in engines:
+        engine.healthy = False
+    with pytest.raises(docker.NoEngineAvailable):
+        pool.place('build0')
+
+
+@pytest.mark.asyncio
+async def test_engine_pool_health_check(aiohttp_server):
+    async def ping(request):
+        return aiohttp.web.Response(text='OK')
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/_ping', ping)
+    server = await aiohttp_server(app)
+    up = docker.Engine.from_url(
+        'tcp://{0}:{1}'.format(server.host, server.port))
+    down = docker.Engine.from_url('unix:///nonexistent/docker.sock')
+    pool = docker.EnginePool([up, down], health_check_interval=1)
+    try:
+        await pool.check_health()
+        assert up.healthy
+        assert not down.healthy
+        assert pool.place('a') is up
+    finally:
+        await pool.close()
+
+
+@pytest.mark.parametrize('url,base_url', [
+    ('unix:///var/run/docker.sock', docker.DEFAULT_BASE_URL),
+    ('tcp://10.0.0.1:2375', 'http://10.0.0.1:2375'),
+    ('http://10.0.0.1:2375/', 'http://10.0.0.1:2375'),
+])
+def test_engine_base_url(url, base_url):
+    assert docker.engine_base_url(url) == base_url
@@ -0,0 +1,73 @@
+import pytest
+
+from harborpilot import dockerignore
+
+
+def test_parse():
+    text = '\n'.join([
+        '# comment',
+        '',
+        '  *.pyc  ',
+        '/build/',
+        '! keep.pyc',
+        'a/../b',
+    ])
+    assert dockerignore.parse(text) == ['*.pyc', 'build', '!keep.pyc', 'b']
+
+
+@pytest.mark.parametrize('patterns,path,excluded', [
+    (['*.pyc'], 'spam.pyc', True),
+    (['*.pyc'], 'sub/spam.pyc', False),
+    (['*/*.pyc'], 'sub/spam.pyc', True),
+    (['**/*.pyc'], 'spam.pyc', True),
+    (['**/*.pyc'], 'a/b/c/spam.pyc', True),
+    (['a/**/z'], 'a/z', True),
+    (['a/**/z'], 'a/b/c/z', True),
+    (['a/**'], 'a/b/c', True),
+    # Like the Docker CLI, ** within a name still only stands for whole
+    # directories, or none
+    (['a**b'], 'axb', False),
+    (['a**b'], 'ab', True),
+    (['a**b'], 'ax/b', True),
+    (['a**/z'], 'a/z', True),
+    (['a**/z'], 'ax/y/z', True),
+    (['a**/z'], 'az', True),
+    (['x/**b'], 'x/b', True),
+    (['x/**b'], 'x/ab', False),
+    (['x/**b'], 'xb', False),
+    (['te?t'], 'test', True),
+    (['te?t'], 'te/t', False),
+    (['[a-c]x'], 'bx', True),
+    (['[!a-c]x'], 'bx', False),
+    (['spam.txt'], 'spam_txt', False),
+    # Directories exclude what's in them
+    (['node_modules'], 'node_modules/left-pad/index.js', True),
+    (['*', '!src'], 'src/main.c', False),
+    (['*', '!src', 'src/*.o'], 'src/main.o', True),
+    # The last matching pattern wins
+    (['*.md', '!README.md'], 'README.md', False),
+    (['!README.md', '*.md'], 'README.md', True),
+    # What Docker needs is always sent
+    (['*'], 'Dockerfile', False),
+    (['*'], '.dockerignore', False),
+])
+def test_excludes(patterns, path, excluded):
+    ignore = dockerignore.DockerIgnore(
+        patterns, always_included=dockerignore.ALWAYS_INCLUDED)
+    assert ignore.excludes(path) == excluded
+
+
+def test_prunes():
+    ignore = dockerignore.DockerIgnore(['build'])
+    assert ignore.prunes(ignore.match('build'))
+    assert not ignore.prunes(ignore.match('src'))
+    # An exception might include something inside, so keep looking
+    ignore = dockerignore.DockerIgnore(['build', '!build/keep'])
+    assert not ignore.prunes(ignore.match('build'))
+
+
+def test_invalid_patterns():
+    with pytest.raises(dockerignore.InvalidPattern):
+        dockerignore.DockerIgnore(['!'])
+    with pytest.raises(dockerignore.InvalidPattern):
+        dockerignore.DockerIgnore(['[abc'])
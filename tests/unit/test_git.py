@@ -1,4 +1,5 @@
 import re
+import tarfile
 import pathlib
 import subprocess
 import os
@@ -10,13 +11,14 @@ from harborpilot import config
 
 
 @pytest.mark.asyncio
+@pytest.mark.parametrize('use_cache', [False, True])
 @pytest.mark.parametrize('branch,use_sub', [
     ('master', False),
     ('master', True),
     ('other', False),
     ('other', True),
 ])
-async def test_build_archive(request, tmpdir, branch, use_sub):
+async def test_build_archive(request, tmpdir, branch, use_sub, use_cache):
     root = pathlib.Path(tmpdir.strpath).resolve()
     repo_dir = root / 'source'
     repo_dir.mkdir()
@@ -38,7 +40,11 @@ async def test_build_archive(request, tmpdir, branch, use_sub):
             branch=branch,
             context_relpath=pathlib.PurePosixPath('.'),
         )
-    commit_hash, tar_file_path = await git.build_archive(cfg)
+    mirror_cache = None
+    if use_cache:
+        mirror_cache = git.MirrorCache(root / 'mirrors')
+    commit_hash, tar_file_path = await git.build_archive(
+        cfg, mirror_cache=mirror_cache)
     # Make sure the tar file is removed at the end of the test.
     @request.addfinalizer
     def remove_tarball():
@@ -90,6 +96,234 @@ async def test__revparse(tmpdir):
     assert revparsed == commit_hash
 
 
+@pytest.mark.asyncio
+async def test_mirror_cache_fetches_new_commits(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    first_commit = _make_git_repo(repo_dir, [], [('foo.txt', 'one\n')])
+    cache = git.MirrorCache(root / 'mirrors')
+    async with cache.mirror(str(repo_dir), 'master') as mirror:
+        assert mirror.commit_hash == first_commit
+        assert mirror.path.parent == root / 'mirrors'
+    second_commit = _add_git_commit(repo_dir, [('foo.txt', 'two\n')])
+    async with cache.mirror(str(repo_dir), 'master') as mirror:
+        assert mirror.commit_hash == second_commit
+    # One mirror, alongside its lock files
+    mirrors = [p for p in (root / 'mirrors').iterdir() if p.is_dir()]
+    assert len(mirrors) == 1
+
+
+@pytest.mark.asyncio
+async def test_mirror_cache_evicts_least_recently_used(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    remotes = []
+    for name in ['first', 'second']:
+        repo_dir = root / name
+        repo_dir.mkdir()
+        _make_git_repo(repo_dir, [], [('foo.txt', name + '\n')])
+        remotes.append(str(repo_dir))
+    cache = git.MirrorCache(root / 'mirrors', max_bytes=1)
+    first_path = cache.mirror_path(remotes[0])
+    second_path = cache.mirror_path(remotes[1])
+    async with cache.mirror(remotes[0], 'master'):
+        async with cache.mirror(remotes[1], 'master'):
+            pass
+        # The first mirror is still in use, so only the second can go.
+        assert first_path.is_dir()
+        assert not second_path.exists()
+    assert not first_path.exists()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('use_sub', [False, True])
+async def test_stream_archive(tmpdir, use_sub):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    expected_commit_hash = _make_git_repo(repo_dir, ['sub'], [
+        ('foo.txt', 'top level\n'),
+        ('sub/bar.txt', 'inside inner dir\n'),
+    ])
+    cfg = config.GitDockerBuildContextConfig(
+        remote=str(repo_dir),
+        branch='master',
+        context_relpath=pathlib.PurePosixPath('sub' if use_sub else '.'),
+    )
+    tar_file = root / 'streamed.tar'
+    cache = git.MirrorCache(root / 'mirrors')
+    async with git.stream_archive(cfg, mirror_cache=cache) as archive:
+        assert archive.commit_hash == expected_commit_hash
+        assert await archive.object_id('bar.txt') == (
+            _git_output(repo_dir, 'rev-parse', 'HEAD:sub/bar.txt')
+            if use_sub else None
+        )
+        with tar_file.open('wb') as f:
+            async for chunk in archive.chunks():
+                f.write(chunk)
+    extract_dir = root / 'extracted'
+    extract_dir.mkdir()
+    _untar_to(tar_file, extract_dir)
+    if use_sub:
+        assert sorted(p.name for p in extract_dir.iterdir()) == ['bar.txt']
+    else:
+        assert (
+            (extract_dir / 'sub' / 'bar.txt').read_text(encoding='ascii')
+        ) == 'inside inner dir\n'
+
+
+@pytest.mark.asyncio
+async def test_stream_archive_rejects_symlinks(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    (repo_dir / 'link.txt').symlink_to('/etc/passwd')
+    _make_git_repo(repo_dir, [], [('foo.txt', 'top level\n')])
+    cfg = config.GitDockerBuildContextConfig(
+        remote=str(repo_dir),
+        branch='master',
+        context_relpath=pathlib.PurePosixPath('.'),
+    )
+    cache = git.MirrorCache(root / 'mirrors')
+    with pytest.raises(
+            git.SymlinkDetected,
+            match=re.escape('relative_path={0!r}'.format('./link.txt')),
+        ):
+        async with git.stream_archive(cfg, mirror_cache=cache):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_stream_archive_honours_dockerignore(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    (repo_dir / 'junk.txt').symlink_to('/etc/passwd')
+    _make_git_repo(repo_dir, ['src', 'tests', 'tests/data'], [
+        ('.dockerignore', 'tests\n*.txt\n!src/*.txt\nDockerfile\n'),
+        ('Dockerfile', 'FROM scratch\n'),
+        ('notes.txt', 'not sent\n'),
+        ('src/main.txt', 'sent\n'),
+        ('src/main.c', 'int main;\n'),
+        ('tests/data/big.bin', 'x' * 100000),
+    ])
+    (repo_dir / 'run.sh').write_text('#!/bin/sh\n')
+    (repo_dir / 'run.sh').chmod(0o755)
+    _add_git_commit(repo_dir, [])
+    cfg = config.GitDockerBuildContextConfig(
+        remote=str(repo_dir),
+        branch='master',
+        context_relpath=pathlib.PurePosixPath('.'),
+    )
+    tar_file = root / 'streamed.tar'
+    cache = git.MirrorCache(root / 'mirrors')
+    async with git.stream_archive(cfg, mirror_cache=cache) as archive:
+        archive.chunk_size = 7
+        with tar_file.open('wb') as f:
+            async for chunk in archive.chunks():
+                f.write(chunk)
+    with tarfile.open(str(tar_file)) as tar:
+        assert sorted(tar.getnames()) == [
+            '.dockerignore', 'Dockerfile', 'run.sh',
+            'src', 'src/main.c', 'src/main.txt',
+        ]
+        assert tar.getmember('run.sh').mode == 0o775
+        assert tar.extractfile('src/main.txt').read() == b'sent\n'
+
+
+@pytest.mark.asyncio
+async def test__archive_honours_dockerignore(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    tar_root = root / 'tar_root'
+    (tar_root / 'build').mkdir(parents=True)
+    (tar_root / 'build' / 'out.o').write_text('junk\n')
+    (tar_root / 'build' / 'link').symlink_to('/etc/passwd')
+    (tar_root / '.dockerignore').write_text('build\n')
+    (tar_root / 'Dockerfile').write_text('FROM scratch\n')
+    tar_file = root / 'tarball.tar'
+    await git._archive(str(tar_root), str(tar_file))
+    with tarfile.open(str(tar_file)) as tar:
+        assert sorted(tar.getnames()) == [
+            '.', './.dockerignore', './Dockerfile']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('use_ignore', [False, True])
+async def test_stream_archive_internal_symlinks(tmpdir, use_ignore):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    (repo_dir / 'link.txt').symlink_to('foo.txt')
+    files = [('foo.txt', 'top level\n')]
+    if use_ignore:
+        files.append(('.dockerignore', 'nothing\n'))
+    _make_git_repo(repo_dir, [], files)
+    cfg = config.GitDockerBuildContextConfig(
+        remote=str(repo_dir),
+        branch='master',
+        context_relpath=pathlib.PurePosixPath('.'),
+        symlinks=config.SYMLINKS_INTERNAL,
+    )
+    tar_file = root / 'streamed.tar'
+    cache = git.MirrorCache(root / 'mirrors')
+    async with git.stream_archive(cfg, mirror_cache=cache) as archive:
+        with tar_file.open('wb') as f:
+            async for chunk in archive.chunks():
+                f.write(chunk)
+    with tarfile.open(str(tar_file)) as tar:
+        assert tar.getmember('link.txt').linkname == 'foo.txt'
+
+    (repo_dir / 'outside.txt').symlink_to('/etc/passwd')
+    _add_git_commit(repo_dir, [])
+    with pytest.raises(
+            git.SymlinkDetected,
+            match=re.escape('relative_path={0!r}'.format('./outside.txt')),
+        ):
+        async with git.stream_archive(cfg, mirror_cache=cache):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_partial_mirror_fetches_only_context_blobs(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    _make_git_repo(repo_dir, ['app', 'docs'], [
+        ('docs/manual.txt', 'not in the context\n'),
+        ('app/.dockerignore', 'notes.txt\n'),
+        ('app/Dockerfile', 'FROM scratch\n'),
+        ('app/notes.txt', 'excluded\n'),
+    ])
+    _git_output(repo_dir, 'config', 'uploadpack.allowFilter', 'true')
+    cfg = config.GitDockerBuildContextConfig(
+        remote=str(repo_dir),
+        branch='master',
+        context_relpath=pathlib.PurePosixPath('app'),
+    )
+    cache = git.MirrorCache(root / 'mirrors')
+    async with git.stream_archive(cfg, mirror_cache=cache) as archive:
+        async for chunk in archive.chunks():
+            pass
+    missing = _missing_objects(cache.mirror_path(str(repo_dir)))
+    assert sorted(missing) == sorted(
+        '?' + _git_output(repo_dir, 'rev-parse', 'HEAD:' + path)
+        for path in ['docs/manual.txt', 'app/notes.txt']
+    )
+
+    # Checking out the context fetches just what's in it too
+    commit_hash, tar_file = await git.build_archive(
+        cfg, mirror_cache=cache)
+    try:
+        with tarfile.open(tar_file) as tar:
+            assert sorted(tar.getnames()) == [
+                '.', './.dockerignore', './Dockerfile']
+    finally:
+        os.unlink(tar_file)
+    missing = _missing_objects(cache.mirror_path(str(repo_dir)))
+    assert missing == [
+        '?' + _git_output(repo_dir, 'rev-parse', 'HEAD:docs/manual.txt')]
+
+
 @pytest.mark.asyncio
 async def test__archive_tars_at_given_root(tmpdir):
     root = pathlib.Path(tmpdir.strpath).resolve()
@@ -123,9 +357,54 @@ async def test__archive_rejects_symlinks(tmpdir):
             git.SymlinkDetected,
             match=re.escape('relative_path={0!r}'.format('./' + link_name)),
         ):
-        await git._archive(str(tar_root_path), None)
+        await git._archive(str(tar_root_path), str(root / 'tarball.tar'))
 
 
+@pytest.mark.asyncio
+async def test__archive_internal_symlinks(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    tar_root = root / 'tar_root'
+    (tar_root / 'sub').mkdir(parents=True)
+    big = os.urandom(200000)
+    (tar_root / 'big.bin').write_bytes(big)
+    (tar_root / 'sub' / 'link').symlink_to('../big.bin')
+    tar_file = root / 'tarball.tar'
+    await git._archive(
+        str(tar_root), str(tar_file), symlinks=config.SYMLINKS_INTERNAL)
+    with tarfile.open(str(tar_file)) as tar:
+        assert tar.getnames() == ['.', './big.bin', './sub', './sub/link']
+        assert tar.getmember('./sub/link').linkname == '../big.bin'
+        assert tar.extractfile('./big.bin').read() == big
+
+    (tar_root / 'escape').symlink_to('../../etc/passwd')
+    with pytest.raises(
+            git.SymlinkDetected,
+            match=re.escape('relative_path={0!r}'.format('./escape')),
+        ):
+        await git._archive(
+            str(tar_root), str(tar_file), symlinks=config.SYMLINKS_INTERNAL)
+
+
+
+@pytest.mark.asyncio
+async def test__archive_long_and_non_ascii_names(tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    tar_root = root / 'tar_root'
+    # Long enough to need the ustar prefix field, and then a pax header
+    split = tar_root / ('d' * 60) / ('e' * 60)
+    split.mkdir(parents=True)
+    (split / 'f.txt').write_bytes(b'split\n')
+    (split / ('g' * 120)).write_bytes(b'pax\n')
+    (tar_root / 'caf\u00e9.txt').write_bytes(b'accent\n')
+    tar_file = root / 'tarball.tar'
+    await git._archive(str(tar_root), str(tar_file))
+    with tarfile.open(str(tar_file)) as tar:
+        base = './' + 'd' * 60 + '/' + 'e' * 60
+        assert tar.extractfile(base + '/f.txt').read() == b'split\n'
+        assert tar.extractfile(base + '/' + 'g' * 120).read() == b'pax\n'
+        assert tar.extractfile('./caf\u00e9.txt').read() == b'accent\n'
+        assert tar.getmember(base).isdir()
+
 def _make_git_repo(root, dirs, files_with_contents, *, branch='master'):
     """
     Create directories under ``root``, writing a file for each entry
@@ -168,6 +447,44 @@ def _make_git_repo(root, dirs, files_with_contents, *, branch='master'):
     ).stdout.strip().decode('ascii')
 
 
+def _add_git_commit(root, files_with_contents):
+    """
+    Write the files in ``files_with_contents`` under the existing Git
+    repo at ``root`` and commit them. Return the commit hash as a str.
+    """
+    root = pathlib.Path(root)
+    for filepath, contents in files_with_contents:
+        (root / filepath).write_text(contents)
+    runkwargs = dict(
+        cwd=str(root),
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    subprocess.run(['git', 'add', '.'], **runkwargs)
+    subprocess.run(['git', 'commit', '-m', 'another commit'], **runkwargs)
+    runkwargs['stdout'] = subprocess.PIPE
+    return subprocess.run(
+        ['git', 'rev-parse', 'HEAD'],
+        **runkwargs,
+    ).stdout.strip().decode('ascii')
+
+
+def _git_output(root, *args):
+    return subprocess.run(
+        ['git'] + list(args),
+        cwd=str(root),
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.strip().decode('ascii')
+
+
+def _missing_objects(git_dir):
+    listing = _git_output(
+        git_dir, 'rev-list', '--objects', '--missing=print', '--all')
+    return [line for line in listing.split() if line.startswith('?')]
+
+
 def _untar_to(tar_file, extract_dir):
     subprocess.run(
         ['tar', '-x', '-f', str(tar_file), '-C', str(extract_dir)],
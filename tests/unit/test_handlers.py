@@ -0,0 +1,369 @@
+import re
+import json
+import asyncio
+import pathlib
+
+import aiohttp
+import pytest
+
+import aiohttp.web as aweb
+
+from harborpilot import application
+from harborpilot import config
+from harborpilot import logstore
+from harborpilot import workers
+
+from tests.unit.test_builds import FakeEngine
+from tests.unit.test_git import _make_git_repo
+
+
+async def _start_app(aiohttp_server, aiohttp_client, tmpdir, messages, **cfg):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    _make_git_repo(repo_dir, [], [('Dockerfile', 'FROM scratch\n')])
+    engine = FakeEngine(messages)
+    engine_server = await aiohttp_server(engine.make_app())
+    cfg = config.HarborPilotConfigSchema().load(dict({
+        'state_dir': str(root / 'state'),
+        'builds': {
+            'spam': {'image_name': 'spam', 'git': {'remote': str(repo_dir)}},
+        },
+    }, **cfg))
+    app = await application.build_app(
+        cfg,
+        client_session=aiohttp.ClientSession(),
+        base_url='http://{0}:{1}'.format(
+            engine_server.host, engine_server.port),
+    )
+    client = await aiohttp_client(app)
+    return engine, client
+
+
+@pytest.fixture
+async def engine_and_client(aiohttp_server, aiohttp_client, tmpdir):
+    return await _start_app(
+        aiohttp_server, aiohttp_client, tmpdir,
+        [{'stream': 'Step 1/1\n'}, {'stream': 'done\n'}],
+    )
+
+
+async def test_unknown_build(engine_and_client):
+    engine, client = engine_and_client
+    response = await client.post('/apis/builds/eggs')
+    assert response.status == 404
+
+
+async def test_build_job_api(engine_and_client):
+    engine, client = engine_and_client
+    response = await client.post('/apis/builds/spam')
+    assert response.status == 202
+    body = await response.json()
+    assert body['status'] == 'queued'
+    assert response.headers['Location'] == body['status_url']
+    build_id = body['build_id']
+    assert body['log_url'] == '/apis/builds/spam/{0}/log'.format(build_id)
+
+    # Nothing is logged until the engine gets going.
+    response = await client.get(body['log_url'])
+    assert await response.read() == b''
+    assert response.headers['X-Next-Offset'] == '0'
+
+    follow = asyncio.ensure_future(
+        client.get(body['log_url'], params={'follow': '1', 'offset': '5'}))
+    engine.release.set()
+    response = await follow
+    assert await response.read() == b'1/1\ndone\n'
+
+    response = await client.get(body['status_url'])
+    status = await response.json()
+    assert status['build_id'] == build_id
+    assert status['status'] == 'succeeded'
+    assert status['log_bytes'] == len(b'Step 1/1\ndone\n')
+
+    response = await client.get(body['log_url'], params={'offset': '9'})
+    assert await response.read() == b'done\n'
+    assert response.headers['X-Next-Offset'] == '14'
+
+
+async def test_unknown_build_id(engine_and_client):
+    engine, client = engine_and_client
+    response = await client.get('/apis/builds/spam/0123abcd')
+    assert response.status == 404
+
+
+async def test_build_events(engine_and_client):
+    engine, client = engine_and_client
+    response = await client.post('/apis/builds/spam')
+    build_id = (await response.json())['build_id']
+    engine.release.set()
+    response = await client.get(
+        '/apis/builds/spam/{0}/events'.format(build_id),
+        headers={'Last-Event-ID': '5'},
+    )
+    assert response.headers['Content-Type'] == 'text/event-stream'
+    text = await response.text()
+    events = [_parse_sse_event(event) for event in text.split('\n\n')[:-1]]
+    log_events = events[:-1]
+    assert all(event['event'] == 'log' for event in log_events)
+    assert ''.join(event['data'] for event in log_events) == '1/1\ndone\n'
+    assert log_events[-1]['id'] == '14'
+    assert events[-1]['event'] == 'end'
+    assert json.loads(events[-1]['data'])['status'] == 'succeeded'
+
+
+async def test_build_events_carriage_returns(
+        aiohttp_server, aiohttp_client, tmpdir):
+    engine, client = await _start_app(
+        aiohttp_server, aiohttp_client, tmpdir,
+        [{'stream': 'Downloading 10%\r50%\r100%\r\n'}, {'stream': 'done\n'}],
+    )
+    engine.release.set()
+    response = await client.post('/apis/builds/spam')
+    build_id = (await response.json())['build_id']
+    response = await client.get(
+        '/apis/builds/spam/{0}/events'.format(build_id))
+    text = await response.text()
+    events = [_parse_sse_event(event) for event in text.split('\n\n')[:-1]]
+    assert ''.join(event['data'] for event in events[:-1]) == (
+        'Downloading 10%\n50%\n100%\ndone\n')
+
+
+def _parse_sse_event(text):
+    event = {}
+    for line in re.split(r'\r\n|\r|\n', text):
+        assert line.startswith(('event: ', 'id: ', 'data: '))
+        field, _, value = line.partition(': ')
+        if field == 'data' and 'data' in event:
+            event['data'] += '\n' + value
+        else:
+            event[field] = value
+    return event
+
+
+async def test_build_websocket(engine_and_client):
+    engine, client = engine_and_client
+    response = await client.post('/apis/builds/spam')
+    build_id = (await response.json())['build_id']
+    ws = await client.ws_connect('/apis/builds/spam/{0}/ws'.format(build_id))
+    engine.release.set()
+    messages = [message.json() async for message in ws]
+    assert messages[0]['offset'] == 0
+    output = ''.join(message['data'] for message in messages[:-1])
+    assert output == 'Step 1/1\ndone\n'
+    assert messages[-1]['end']['status'] == 'succeeded'
+
+
+
+async def test_build_history(engine_and_client):
+    engine, client = engine_and_client
+    engine.release.set()
+    build_ids = []
+    for _ in range(3):
+        response = await client.post('/apis/builds/spam')
+        build_id = (await response.json())['build_id']
+        build_ids.append(build_id)
+        response = await client.get(
+            '/apis/builds/spam/{0}/log'.format(build_id),
+            params={'follow': '1'},
+        )
+        await response.read()
+
+    response = await client.get(
+        '/apis/builds/spam/history', params={'limit': '2'})
+    assert response.status == 200
+    page = await response.json()
+    assert [b['build_id'] for b in page['builds']] == build_ids[:0:-1]
+    assert page['builds'][0]['status'] in {'succeeded', 'reused'}
+    response = await client.get(page['next'])
+    page = await response.json()
+    assert [b['build_id'] for b in page['builds']] == build_ids[:1]
+    assert page['next'] is None
+
+    response = await client.get('/apis/builds/eggs/history')
+    assert response.status == 404
+    response = await client.get(
+        '/apis/builds/spam/history', params={'limit': 'lots'})
+    assert response.status == 400
+
+
+async def test_build_log_from_store(aiohttp_server, aiohttp_client, tmpdir):
+    lines = ['line {0}\n'.format(i) for i in range(1000)]
+    engine, client = await _start_app(
+        aiohttp_server, aiohttp_client, tmpdir,
+        [{'stream': line} for line in lines],
+        logs={'max_memory_bytes': 1024},
+    )
+    expected = ''.join(lines).encode('utf-8')
+    engine.release.set()
+    response = await client.post('/apis/builds/spam')
+    log_url = (await response.json())['log_url']
+    response = await client.get(log_url, params={'follow': '1'})
+    assert await response.read() == expected
+    assert response.headers['X-Log-Start-Offset'] == '0'
+
+    # Older output than is kept in memory comes from the log store
+    response = await client.get(
+        log_url, params={'offset': '10', 'length': '20'})
+    assert await response.read() == expected[10:30]
+    response = await client.get(log_url, params={'tail': '9'})
+    assert await response.read() == b'line 999\n'
+    assert response.headers['X-Next-Offset'] == str(len(expected))
+
+    # Without the store, polling moves on to what's kept in memory.
+    for path in (pathlib.Path(tmpdir.strpath) / 'state' / 'logs').iterdir():
+        path.unlink()
+    response = await client.get(log_url, params={'offset': '10'})
+    data = await response.read()
+    assert data and expected.endswith(data)
+    assert response.headers['X-Next-Offset'] == str(len(expected))
+
+
+async def test_stored_build_log_gone_or_damaged(
+        engine_and_client, tmpdir, monkeypatch):
+    engine, client = engine_and_client
+    logs_dir = pathlib.Path(tmpdir.strpath) / 'state' / 'logs'
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    (logs_dir / 'damaged.idx').write_bytes(b'junk')
+    (logs_dir / 'damaged.log').write_bytes(b'')
+    response = await client.get('/apis/builds/spam/damaged/log')
+    assert response.status == 404
+
+    # Evicted between looking up its size and reading it
+    async def size(self, build_name, build_id):
+        return 100
+
+    async def read(self, build_name, build_id, offset=0, length=None):
+        return None
+
+    monkeypatch.setattr(logstore.LogStore, 'size', size)
+    monkeypatch.setattr(logstore.LogStore, 'read', read)
+    response = await client.get('/apis/builds/spam/evicted/log')
+    assert response.status == 404
+
+
+async def test_metrics(engine_and_client):
+    engine, client = engine_and_client
+    engine.release.set()
+    response = await client.post('/apis/builds/spam')
+    log_url = (await response.json())['log_url']
+    response = await client.get(log_url, params={'follow': '1'})
+    await response.read()
+
+    response = await client.get('/metrics')
+    assert response.status == 200
+    text = await response.text()
+    assert (
+        'harborpilot_builds_total{build_name="spam",status="succeeded"} 1'
+    ) in text
+    assert (
+        'harborpilot_build_phase_seconds_count'
+        '{build_name="spam",phase="stream"} 1'
+    ) in text
+    assert 'harborpilot_build_log_bytes_total{build_name="spam"} 14' in text
+    assert 'harborpilot_builds_running 0' in text
+    assert (
+        '# HELP harborpilot_builds_queued '
+        'Builds waiting in the queue for a slot to run in.\n'
+    ) in text
+    assert 'harborpilot_builds_queued 0' in text
+
+
+async def test_requests_forwarded_between_workers(
+        aiohttp_server, aiohttp_client, tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    repo_dir = root / 'source'
+    repo_dir.mkdir()
+    _make_git_repo(repo_dir, [], [('Dockerfile', 'FROM scratch\n')])
+    engine = FakeEngine([{'stream': 'Step 1/1\n'}, {'stream': 'done\n'}])
+    engine_server = await aiohttp_server(engine.make_app())
+    cfg = config.HarborPilotConfigSchema().load({
+        'state_dir': str(root / 'state'),
+        'builds': {
+            'spam': {'image_name': 'spam', 'git': {'remote': str(repo_dir)}},
+        },
+    })
+    clients = []
+    for index in range(2):
+        worker = workers.Worker(cfg.state_dir, index, 2)
+        app = await application.build_app(
+            cfg,
+            client_session=aiohttp.ClientSession(),
+            base_url='http://{0}:{1}'.format(
+                engine_server.host, engine_server.port),
+            worker=worker,
+        )
+        client = await aiohttp_client(app)
+        # What the other worker forwards to
+        worker.socket_path().parent.mkdir(parents=True, exist_ok=True)
+        await aweb.UnixSite(
+            client.server.runner, str(worker.socket_path())).start()
+        clients.append(client)
+
+    response = await clients[1].post('/apis/builds/spam')
+    assert response.status == 202
+    body = await response.json()
+    # Worker 1 runs the builds of spam now, so worker 0 passes it on
+    response = await clients[0].post('/apis/builds/spam')
+    assert response.status == 202
+    other_id = (await response.json())['build_id']
+    shared_state = clients[0].server.app['worker'].shared_state
+    assert shared_state.locate(other_id) == 1
+
+    ws = await clients[0].ws_connect(
+        '/apis/builds/spam/{0}/ws'.format(body['build_id']))
+    engine.release.set()
+    response = await clients[0].get(body['log_url'], params={'follow': '1'})
+    assert await response.read() == b'Step 1/1\ndone\n'
+    messages = [message.json() async for message in ws]
+    assert messages[-1]['end']['build_id'] == body['build_id']
+    response = await clients[0].get(body['status_url'])
+    assert (await response.json())['status'] == 'succeeded'
+
+    response = await clients[0].get('/metrics')
+    text = await response.text()
+    assert text.count('# TYPE harborpilot_builds_total counter') == 1
+    assert (
+        'harborpilot_builds_total'
+        '{worker="1",build_name="spam",status="succeeded"} 1'
+    ) in text
+    assert 'harborpilot_builds_running{worker="0"} 0' in text
+
+
+async def test_reloaded_builds_are_served(
+        aiohttp_server, aiohttp_client, tmpdir):
+    root = pathlib.Path(tmpdir.strpath).resolve()
+    cfg_path = root / 'harborpilot.conf'
+    structure = {
+        'state_dir': str(root / 'state'),
+        'builds': {
+            'spam': {'image_name': 'spam', 'git': {'remote': '/repo'}},
+        },
+    }
+    cfg_path.write_text(json.dumps(structure))
+    with cfg_path.open() as conffile:
+        cfg = config.from_yaml_file(conffile)
+    engine = FakeEngine([])
+    engine_server = await aiohttp_server(engine.make_app())
+    app = await application.build_app(
+        cfg,
+        client_session=aiohttp.ClientSession(),
+        base_url='http://{0}:{1}'.format(
+            engine_server.host, engine_server.port),
+        config_path=cfg_path,
+    )
+    client = await aiohttp_client(app)
+    response = await client.post('/apis/builds/eggs')
+    assert response.status == 404
+
+    structure['builds']['eggs'] = {
+        'image_name': 'eggs', 'git': {'remote': '/repo'}}
+    cfg_path.write_text(json.dumps(structure))
+    assert await app['config_reloader'].reload()
+    response = await client.post('/apis/builds/eggs')
+    assert response.status == 202
+    # There's no /repo, so the build fails; it must end before the test
+    # does, as cancelling it while it starts git can hang the loop.
+    response = await client.get(
+        (await response.json())['log_url'], params={'follow': '1'})
+    await response.read()
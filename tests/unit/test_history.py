@@ -0,0 +1,89 @@
+import pytest
+
+from harborpilot import history
+
+
+def _row(build_id, created_at, **overrides):
+    row = {column: None for column in history.COLUMNS}
+    row.update({
+        'build_id': build_id,
+        'build_name': 'spam',
+        'commit_hash': 'c0ffee',
+        'status': 'succeeded',
+        'created_at': created_at,
+        'stream_seconds': 1.5,
+    })
+    row.update(overrides)
+    return row
+
+
+@pytest.fixture
+async def build_history(tmpdir):
+    build_history = history.BuildHistory(tmpdir.join('history.sqlite'))
+    yield build_history
+    await build_history.close()
+
+
+async def test_record_and_query(build_history):
+    for i in range(5):
+        build_history.record(_row('b{0}'.format(i), 1000.0 + i))
+    build_history.record(_row('other', 1003.5, build_name='eggs'))
+    build_history.record(_row('beef', 1004.5, commit_hash='beef'))
+
+    rows = await build_history.query('spam', limit=3)
+    assert [row['build_id'] for row in rows] == ['beef', 'b4', 'b3']
+    rows = await build_history.query('spam', limit=3, before=1003.0)
+    assert [row['build_id'] for row in rows] == ['b2', 'b1', 'b0']
+    rows = await build_history.query('spam', commit='beef')
+    assert [row['build_id'] for row in rows] == ['beef']
+    # Builds created at the same time aren't skipped between pages
+    build_history.record(_row('b2a', 1002.0))
+    build_history.record(_row('b2b', 1002.0))
+    seen = []
+    before = before_id = None
+    while True:
+        rows = await build_history.query(
+            'spam', limit=2, before=before, before_id=before_id)
+        seen.extend(row['build_id'] for row in rows)
+        if len(rows) < 2:
+            break
+        before, before_id = rows[-1]['created_at'], rows[-1]['build_id']
+    assert seen == ['beef', 'b4', 'b3', 'b2b', 'b2a', 'b2', 'b1', 'b0']
+
+    row = await build_history.get('b1')
+    assert row['created_at'] == 1001.0
+    assert await build_history.get('nope') is None
+
+
+async def test_last_image(build_history):
+    assert await build_history.last_image('spam') is None
+    build_history.record(_row('b0', 1000.0, image_id='sha256:old'))
+    build_history.record(_row('b1', 1001.0, image_id='sha256:reused',
+                              status='reused'))
+    build_history.record(_row('b2', 1002.0, image_id='sha256:bad',
+                              status='failed'))
+    build_history.record(_row('b3', 1003.0, build_name='eggs',
+                              image_id='sha256:eggs'))
+    assert await build_history.last_image('spam') == 'sha256:reused'
+
+
+async def test_rows_survive_reopening(tmpdir):
+    path = tmpdir.join('history.sqlite')
+    build_history = history.BuildHistory(path)
+    build_history.record(_row('b0', 1000.0))
+    await build_history.close()
+
+    build_history = history.BuildHistory(path)
+    try:
+        rows = await build_history.query('spam')
+    finally:
+        await build_history.close()
+    assert [row['build_id'] for row in rows] == ['b0']
+
+
+def test_describe_row():
+    description = history.describe_row(_row('b0', 0.0))
+    assert description['build_id'] == 'b0'
+    assert description['created_at'] == '1970-01-01T00:00:00+00:00'
+    assert description['started_at'] is None
+    assert description['phase_seconds'] == {'stream': 1.5}
@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+
+from harborpilot import logstore
+
+
+@pytest.fixture
+async def log_store(tmpdir):
+    store = logstore.LogStore(tmpdir.join('logs'))
+    store.chunk_size = 16
+    yield store
+    await store.close()
+
+
+async def test_write_and_read_ranges(log_store):
+    output = bytes(range(256)) * 10
+    writer = log_store.open_writer('spam', 'b0')
+    for start in range(0, len(output), 100):
+        writer.write(output[start:start + 100])
+        # Reads see the written output, flushed to disk or not
+        assert await log_store.read('spam', 'b0', 0) == output[:start + 100]
+    await writer.close()
+
+    assert await log_store.size('spam', 'b0') == len(output)
+    assert await log_store.read('spam', 'b0') == output
+    assert await log_store.read('spam', 'b0', 1000, 37) == output[1000:1037]
+    assert await log_store.read('spam', 'b0', 2550) == output[2550:]
+    assert await log_store.read('spam', 'b0', 5000) == b''
+    # Logs belong to their build name
+    assert await log_store.read('eggs', 'b0') is None
+    assert await log_store.size('spam', 'nope') is None
+
+
+async def test_chunks_are_compressed(log_store):
+    log_store.chunk_size = 64 * 1024
+    writer = log_store.open_writer('spam', 'b0')
+    writer.write(b'Step 1/1 : RUN make\n' * 10000)
+    await writer.close()
+    log_path = log_store.root / 'b0.log'
+    assert log_path.stat().st_size < 10000
+    assert await log_store.read('spam', 'b0', 199980) == (
+        b'Step 1/1 : RUN make\n')
+
+
+async def test_eviction(tmpdir):
+    store = logstore.LogStore(tmpdir.join('logs'), max_age_seconds=3600)
+    try:
+        for build_id in ['old', 'b1', 'b2', 'b3']:
+            writer = store.open_writer('spam', build_id)
+            writer.write(os.urandom(100))
+            await writer.close()
+        day_ago = time.time() - 24 * 60 * 60
+        os.utime(str(store.root / 'old.idx'), (day_ago, day_ago))
+        # Room for two of the logs
+        store.max_total_bytes = 2 * (
+            os.path.getsize(str(store.root / 'b1.log'))
+            + os.path.getsize(str(store.root / 'b1.idx'))
+        )
+        await store.evict()
+        # Too old, then the oldest of what's over the size limit
+        assert await store.size('spam', 'old') is None
+        assert await store.size('spam', 'b1') is None
+        assert await store.size('spam', 'b2') == 100
+        assert await store.size('spam', 'b3') == 100
+    finally:
+        await store.close()
+
+
+async def test_eviction_skips_logs_written_elsewhere(tmpdir):
+    # Two workers sharing the directory
+    writing = logstore.LogStore(tmpdir.join('logs'))
+    evicting = logstore.LogStore(tmpdir.join('logs'), max_total_bytes=0)
+    try:
+        writer = writing.open_writer('spam', 'b1')
+        writer.write(os.urandom(writing.chunk_size))
+        await writing.read('spam', 'b1')
+        await evicting.evict()
+        assert await evicting.size('spam', 'b1') == writing.chunk_size
+
+        await writer.close()
+        await evicting.evict()
+        assert await evicting.size('spam', 'b1') is None
+        assert sorted(os.listdir(str(evicting.root))) == []
+    finally:
+        await writing.close()
+        await evicting.close()
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from harborpilot import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter('spam_total', 'Spam.', ['kind'])
+    counter.inc(('eggs',))
+    counter.inc(('eggs',), 2)
+    counter.inc(('ham "and" eggs',))
+    registry.gauge('running', 'Running now.', function=lambda: {(): 3})
+    histogram = registry.histogram(
+        'wait_seconds', 'Waits.', ['name'], buckets=[1.0, 5.0])
+    for value in [0.5, 1.0, 2.0, 10.0]:
+        histogram.observe(value, ('spam',))
+
+    assert registry.render() == '\n'.join([
+        '# HELP spam_total Spam.',
+        '# TYPE spam_total counter',
+        'spam_total{kind="eggs"} 3',
+        'spam_total{kind="ham \\"and\\" eggs"} 1',
+        '# HELP running Running now.',
+        '# TYPE running gauge',
+        'running 3',
+        '# HELP wait_seconds Waits.',
+        '# TYPE wait_seconds histogram',
+        'wait_seconds_bucket{name="spam",le="1.0"} 2',
+        'wait_seconds_bucket{name="spam",le="5.0"} 3',
+        'wait_seconds_bucket{name="spam",le="+Inf"} 4',
+        'wait_seconds_sum{name="spam"} 13.5',
+        'wait_seconds_count{name="spam"} 4',
+    ]) + '\n'
+
+
+def test_wrong_labels():
+    registry = metrics.Registry()
+    counter = registry.counter('spam_total', 'Spam.', ['kind'])
+    with pytest.raises(ValueError):
+        counter.inc(('eggs', 'ham'))
+
+
+async def test_loop_lag_monitor():
+    histogram = metrics.Registry().histogram('lag', 'Lag.')
+    monitor = metrics.LoopLagMonitor(histogram, interval=0.01)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    await monitor.stop()
+    assert histogram._values[()][-1] >= 0
+    assert sum(histogram._values[()][:-1]) >= 2
@@ -0,0 +1,144 @@
+import os
+import asyncio
+import signal
+import logging
+import pathlib
+
+import yaml
+
+from harborpilot import config
+from harborpilot import configfiles
+from harborpilot import reloader
+
+
+def _write_config(path, build_names, **settings):
+    structure = dict(settings, builds={
+        build_name: {'image_name': build_name, 'git': {'remote': '/repo'}}
+        for build_name in build_names
+    })
+    path.write_text(yaml.safe_dump(structure))
+
+
+def _write_builds(path, build_names):
+    path.write_text(yaml.safe_dump({
+        build_name: {'image_name': build_name, 'git': {'remote': '/repo'}}
+        for build_name in build_names
+    }))
+
+
+def _reloader(tmpdir, **kwargs):
+    path = pathlib.Path(tmpdir.strpath) / 'harborpilot.conf'
+    _write_config(path, ['spam'])
+    with path.open() as conffile:
+        current = config.from_yaml_file(conffile)
+    config_reloader = reloader.ConfigReloader(path, current, **kwargs)
+    applied = []
+    config_reloader.listeners.append(applied.append)
+    return path, config_reloader, applied
+
+
+async def test_reload(tmpdir, caplog):
+    caplog.set_level(logging.INFO, logger='harborpilot.reloader')
+    path, config_reloader, applied = _reloader(tmpdir)
+    _write_config(path, ['spam', 'eggs'], port=18081)
+    assert await config_reloader.reload()
+    assert sorted(config_reloader.config.builds) == ['eggs', 'spam']
+    assert applied == [config_reloader.config]
+    assert 'builds added: eggs; changed: none; removed: none' in caplog.text
+    assert 'The port setting changed' in caplog.text
+
+
+async def test_bad_config_is_ignored(tmpdir, caplog):
+    path, config_reloader, applied = _reloader(tmpdir)
+    original = config_reloader.config
+    path.write_text('builds: {}\n')
+    assert not await config_reloader.reload()
+    path.write_text('builds: [\n')
+    assert not await config_reloader.reload()
+    assert config_reloader.config is original
+    assert applied == []
+    assert caplog.text.count('Keeping the current config') == 2
+
+
+async def test_reload_on_change_and_sighup(tmpdir):
+    path, config_reloader, applied = _reloader(tmpdir, poll_interval=0.01)
+    config_reloader.start()
+    try:
+        _write_config(path, ['eggs'])
+        for _ in range(100):
+            if applied:
+                break
+            await asyncio.sleep(0.01)
+        assert list(applied[-1].builds) == ['eggs']
+        os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(100):
+            if len(applied) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert len(applied) == 2
+    finally:
+        await config_reloader.stop()
+
+
+async def test_unexpected_errors_are_logged(tmpdir, monkeypatch, caplog):
+    path, config_reloader, applied = _reloader(tmpdir, poll_interval=0.01)
+    load = configfiles.load
+    failures = []
+
+    def failing_load(path):
+        if not failures:
+            failures.append(path)
+            raise RuntimeError('pool broke')
+        return load(path)
+
+    monkeypatch.setattr(configfiles, 'load', failing_load)
+    config_reloader.start()
+    try:
+        os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(100):
+            if 'pool broke' in caplog.text:
+                break
+            await asyncio.sleep(0.01)
+        assert 'Failed to reload' in caplog.text
+        caplog.clear()
+
+        # A failure while polling doesn't stop it picking up changes
+        failures.clear()
+        _write_config(path, ['eggs'])
+        for _ in range(100):
+            if 'pool broke' in caplog.text:
+                break
+            await asyncio.sleep(0.01)
+        assert 'Failed to reload' in caplog.text
+        _write_config(path, ['eggs', 'ham'])
+        for _ in range(100):
+            if applied:
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(applied[-1].builds) == ['eggs', 'ham']
+    finally:
+        await config_reloader.stop()
+
+
+async def test_reload_on_builds_dir_change(tmpdir):
+    root = pathlib.Path(tmpdir.strpath)
+    path = root / 'harborpilot.conf'
+    _write_config(path, [], builds_dir='builds.d', state_dir=str(root))
+    builds_dir = root / 'builds.d'
+    builds_dir.mkdir()
+    _write_builds(builds_dir / 'a.yaml', ['spam'])
+    current = configfiles.load(path)
+    config_reloader = reloader.ConfigReloader(
+        path, current, poll_interval=0.01)
+    applied = []
+    config_reloader.listeners.append(applied.append)
+    config_reloader.start()
+    try:
+        _write_builds(builds_dir / 'b.yaml', ['eggs'])
+        for _ in range(100):
+            if applied:
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(applied[-1].builds) == ['eggs', 'spam']
+    finally:
+        await config_reloader.stop()
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from harborpilot import scheduler
+from harborpilot import workers
+
+
+def _scheduler(
+        max_concurrent=2, max_per_build=1, max_queued=10, shared_state=None):
+    return scheduler.BuildScheduler(
+        max_concurrent=max_concurrent,
+        max_per_build=max_per_build,
+        max_queued=max_queued,
+        shared_state=shared_state,
+    )
+
+
+async def _hold(ticket, started, release):
+    async with ticket:
+        started.append(ticket.build_name)
+        await release.wait()
+
+
+async def test_limits_and_fair_order():
+    sched = _scheduler()
+    started = []
+    release = asyncio.Event()
+    names = ['spam', 'spam', 'spam', 'eggs', 'ham']
+    tasks = [
+        asyncio.ensure_future(_hold(sched.reserve(name), started, release))
+        for name in names
+    ]
+    await asyncio.sleep(0)
+    # One spam at a time, two in total.
+    assert started == ['spam', 'eggs']
+    assert sched.running == 2
+    assert sched.queued == 3
+    assert sched.stats()['waiting_by_build'] == {'spam': 2, 'ham': 1}
+
+    release.set()
+    await asyncio.gather(*tasks)
+    # Once slots free up, ham gets a turn before the second spam build
+    # is joined by the third.
+    assert started == ['spam', 'eggs', 'ham', 'spam', 'spam']
+    assert sched.running == 0
+    assert sched.queued == 0
+    assert sched.stats()['total_started'] == 5
+
+
+async def test_queue_full():
+    sched = _scheduler(max_queued=1)
+    ticket = sched.reserve('spam')
+    with pytest.raises(scheduler.QueueFull) as exc_info:
+        sched.reserve('eggs')
+    assert exc_info.value.queued == 1
+    assert exc_info.value.retry_after >= 1
+    ticket.cancel()
+    sched.reserve('eggs')
+
+
+async def test_cancelled_wait_frees_place():
+    sched = _scheduler(max_concurrent=1)
+    release = asyncio.Event()
+    started = []
+    holder = asyncio.ensure_future(
+        _hold(sched.reserve('spam'), started, release))
+    waiter = asyncio.ensure_future(
+        _hold(sched.reserve('eggs'), started, release))
+    await asyncio.sleep(0)
+    assert sched.queued == 1
+    waiter.cancel()
+    await asyncio.sleep(0)
+    assert sched.queued == 0
+    assert sched.stats()['waiting_by_build'] == {}
+    release.set()
+    await holder
+    assert started == ['spam']
+
+
+async def test_limits_shared_between_workers(tmpdir):
+    path = tmpdir.join('workers.sqlite')
+    first, second = [
+        _scheduler(max_queued=2, shared_state=workers.SharedState(path, i))
+        for i in range(2)
+    ]
+    second.poll_interval = 0.01
+    started = []
+    release = asyncio.Event()
+    holders = [
+        asyncio.ensure_future(_hold(first.reserve(name), started, release))
+        for name in ['spam', 'eggs']
+    ]
+    await asyncio.sleep(0)
+    # The other worker has both slots, and its own don't count
+    waiter = asyncio.ensure_future(
+        _hold(second.reserve('ham'), started, release))
+    await asyncio.sleep(0.05)
+    assert started == ['spam', 'eggs']
+    assert second.stats()['running_by_build'] == {'spam': 1, 'eggs': 1}
+    assert second.stats()['waiting_by_build'] == {'ham': 1}
+
+    second.reserve('ham')
+    with pytest.raises(scheduler.QueueFull) as exc_info:
+        first.reserve('spam')
+    assert exc_info.value.queued == 2
+
+    release.set()
+    await asyncio.gather(*holders)
+    # Picked up by polling, since the first worker can't tell the second
+    await asyncio.wait_for(waiter, 1)
+    assert started == ['spam', 'eggs', 'ham']
@@ -0,0 +1,43 @@
+import gzip
+import pathlib
+
+from harborpilot import trace
+
+
+async def test_round_trip(tmpdir):
+    path = pathlib.Path(tmpdir.strpath) / 'traces' / 'a.jsonl.gz'
+    recorder = trace.TraceRecorder(path, max_stream_bytes=8)
+    recorder.request('spam', 1000.0, 503)
+    recorder.request('spam', 1001.0, 202, build_id='b1')
+    recording = recorder.stream('spam', 'b1')
+    snowman = '☃'.encode('utf-8')
+    # A character split between chunks, and more than is kept
+    recording.chunk_received(b'ab' + snowman[:1])
+    recording.chunk_received(snowman[1:] + b'cdefg')
+    recording.chunk_received(b'hij')
+    recording.close()
+    recording.close()
+    await recorder.close()
+
+    events = trace.read_events([path])
+    assert [event['type'] for event in events] == [
+        'request', 'request', 'start', 'stream']
+    assert events[0]['status'] == 503
+    assert events[0]['build_id'] is None
+    assert events[1]['build_id'] == 'b1'
+    assert events[2]['version'] == trace.TRACE_VERSION
+    stream = events[3]
+    assert ''.join(text for seconds, text in stream['chunks']) == 'ab☃cde'
+    assert stream['truncated']
+
+
+async def test_truncated_trace(tmpdir):
+    path = pathlib.Path(tmpdir.strpath) / 'a.jsonl.gz'
+    recorder = trace.TraceRecorder(path)
+    recorder.request('spam', 1000.0, 202, build_id='b1')
+    await recorder.close()
+    # As if the recording process died writing a second batch
+    with path.open('ab') as trace_file:
+        trace_file.write(gzip.compress(b'{"type": "request"}\n')[:20])
+    events = trace.read_events([path])
+    assert [event['type'] for event in events] == ['request', 'start']
@@ -0,0 +1,33 @@
+from harborpilot import workers
+
+
+def test_shared_state(tmpdir):
+    path = tmpdir.join('workers.sqlite')
+    first = workers.SharedState(path, 0)
+    second = workers.SharedState(path, 1)
+    assert first.claim('spam', 'master') == 0
+    assert second.claim('spam', 'master') == 0
+    assert second.claim('spam', 'develop') == 1
+    # Only the owner can give it up
+    second.release('spam', 'master')
+    assert second.claim('spam', 'master') == 0
+    first.release('spam', 'master')
+    assert second.claim('spam', 'master') == 1
+
+    first.add_build('b0')
+    assert second.locate('b0') == 0
+    assert second.locate('b1') is None
+
+    assert first.reserve_ticket('t0', 'spam', 10)
+    assert first.start_ticket('t0', 'spam', 2, 1)
+    assert second.reserve_ticket('t1', 'spam', 10)
+    assert not second.start_ticket('t1', 'spam', 2, 1)
+    assert second.ticket_counts() == ({'spam': 1}, {'spam': 1})
+
+    # Once the first worker exits, its builds and slots are gone
+    first.clear_worker()
+    assert second.locate('b0') is None
+    assert second.start_ticket('t1', 'spam', 2, 1)
+    assert second.ticket_counts() == ({'spam': 1}, {})
+    first.close()
+    second.close()